@@ -0,0 +1,4 @@
+from .response_cache import *
+from .inflight import *
+from .history_cache import *
+from .semantic_cache import *
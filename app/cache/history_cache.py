@@ -0,0 +1,239 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from ..configs import HISTORY_CACHE
+from ..metrics import metrics_registry
+
+__all__ = ["HistoryCache", "history_cache"]
+
+# dicts, and the langchain messages memoized on them
+ROW_OVERHEAD = 512
+
+history_cache_lookups = metrics_registry.counter(
+    "history_cache_lookups_total",
+    "Conversation history lookups by result (hit, miss, stale)",
+    ["result"],
+)
+history_cache_evictions = metrics_registry.counter(
+    "history_cache_evictions_total",
+    "Conversation windows evicted to stay under max_bytes",
+)
+history_cache_invalidations = metrics_registry.counter(
+    "history_cache_invalidations_total",
+    "Conversation windows dropped because another writer changed the conversation",
+)
+
+
+def _row_size(row: Dict[str, Any]) -> int:
+    return len(row["query"].encode("utf-8")) + len(row["response"].encode("utf-8")) + ROW_OVERHEAD
+
+
+class _Window:
+    __slots__ = ("rows", "version", "capacity", "complete", "size")
+
+    def __init__(self, version: int, capacity: int, complete: bool):
+        # message_id -> row, oldest first, including rows whose response is still empty
+        self.rows: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.version = version
+        self.capacity = capacity
+        # holds every message of the conversation
+        self.complete = complete
+        self.size = 0
+
+
+class HistoryCache:
+    """
+    The newest `window` messages of recently active conversations, rows as filter_message
+    returns them (with token counts), in LRU order bounded by `max_bytes`.
+
+    Writes update the cached window in place (write-through) and every committed write
+    bumps the conversation's version in the db. A window is served only while the version
+    read from the db matches its own, and a write only advances it when it is the next
+    version: a write from another worker, or one this cache did not see, drops the window.
+    The rows handed out are shared, callers must not change them.
+    """
+
+    def __init__(self, enabled: bool = False, max_bytes: int = 32 * 1024 * 1024, window: int = 50):
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.window = window
+        self._windows: "OrderedDict[str, _Window]" = OrderedDict()
+        # message_id -> conversation_id of the cached rows
+        self._owners: Dict[str, str] = {}
+        self._bytes = 0
+        # written from the db threads and the event loop
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, conversation_id: str, limit: int, version: int) -> Optional[List[Dict[str, Any]]]:
+        """
+        the newest `limit` answered messages, newest first, or None if they are not cached
+        """
+        with self._lock:
+            window = self._windows.get(conversation_id)
+            if window is not None and window.version != version:
+                self._drop(conversation_id)
+                self.stale += 1
+                history_cache_lookups.labels("stale").inc()
+                return None
+            if window is not None:
+                messages = []
+                for row in reversed(window.rows.values()):
+                    if row["response"] != "":
+                        messages.append(row)
+                        if len(messages) == limit:
+                            break
+                if len(messages) == limit or window.complete:
+                    self._windows.move_to_end(conversation_id)
+                    self.hits += 1
+                    history_cache_lookups.labels("hit").inc()
+                    return messages
+            self.misses += 1
+            history_cache_lookups.labels("miss").inc()
+            return None
+
+    def put(self, conversation_id: str, rows: List[Dict[str, Any]], limit: int, version: int) -> None:
+        """
+        cache the rows (newest first) of a conversation loaded with `limit` at `version`
+        """
+        window = _Window(version, limit, complete=len(rows) < limit)
+        for row in reversed(rows):
+            window.rows[row["id"]] = row
+            window.size += _row_size(row)
+        if window.size > self.max_bytes:
+            return
+        with self._lock:
+            current = self._windows.get(conversation_id)
+            if current is not None and current.version > version:
+                # a newer window was stored while this one was loading
+                return
+            self._drop(conversation_id)
+            self._windows[conversation_id] = window
+            self._bytes += window.size
+            for message_id in window.rows:
+                self._owners[message_id] = conversation_id
+            self._evict()
+
+    def add(self, conversation_id: str, row: Dict[str, Any]) -> None:
+        """
+        write-through of a new message
+        """
+        with self._lock:
+            window = self._windows.get(conversation_id)
+            if window is None:
+                return
+            if row["id"] in window.rows:
+                self._remove_row(window, row["id"])
+            window.rows[row["id"]] = row
+            window.size += _row_size(row)
+            self._bytes += _row_size(row)
+            self._owners[row["id"]] = conversation_id
+            while len(window.rows) > window.capacity:
+                self._remove_row(window, next(iter(window.rows)))
+                window.complete = False
+            self._evict()
+
+    def set_response(self, message_id: str, response: str, response_tokens: Optional[int] = None) -> None:
+        """
+        write-through of a response update
+        """
+        with self._lock:
+            conversation_id = self._owners.get(message_id)
+            window = self._windows.get(conversation_id) if conversation_id else None
+            if window is None:
+                return
+            row = window.rows[message_id]
+            new_row = dict(row, response=response, response_tokens=response_tokens)
+            # memoized messages hold the old response
+            new_row.pop("_messages", None)
+            window.rows[message_id] = new_row
+            window.size += _row_size(new_row) - _row_size(row)
+            self._bytes += _row_size(new_row) - _row_size(row)
+            self._evict()
+
+    def advance(self, conversation_id: str, version: int, message_ids: Iterable[str]) -> None:
+        """
+        a write of `message_ids` was committed as `version` of the conversation
+        """
+        with self._lock:
+            window = self._windows.get(conversation_id)
+            if window is None:
+                return
+            if window.version + 1 == version and all(
+                self._owners.get(message_id) == conversation_id for message_id in message_ids
+            ):
+                window.version = version
+            else:
+                self._drop(conversation_id)
+                self.invalidations += 1
+                history_cache_invalidations.inc()
+
+    def invalidate(self, conversation_id: str) -> None:
+        with self._lock:
+            if self._drop(conversation_id):
+                self.invalidations += 1
+                history_cache_invalidations.inc()
+
+    def _remove_row(self, window: _Window, message_id: str) -> None:
+        row = window.rows.pop(message_id)
+        size = _row_size(row)
+        window.size -= size
+        self._bytes -= size
+        self._owners.pop(message_id, None)
+
+    def _drop(self, conversation_id: str) -> bool:
+        window = self._windows.pop(conversation_id, None)
+        if window is None:
+            return False
+        self._bytes -= window.size
+        for message_id in window.rows:
+            self._owners.pop(message_id, None)
+        return True
+
+    def _evict(self) -> None:
+        while self._bytes > self.max_bytes and self._windows:
+            self._drop(next(iter(self._windows)))
+            self.evictions += 1
+            history_cache_evictions.inc()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._windows.clear()
+            self._owners.clear()
+            self._bytes = 0
+
+    def _usage(self) -> Iterable[Tuple[Tuple[str], float]]:
+        yield ("bytes",), self._bytes
+        yield ("conversations",), len(self._windows)
+        yield ("messages",), len(self._owners)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses + self.stale
+            return {
+                "enabled": self.enabled,
+                "conversations": len(self._windows),
+                "messages": len(self._owners),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+history_cache = HistoryCache(**HISTORY_CACHE)
+
+metrics_registry.gauge(
+    "history_cache_usage",
+    "Size of the conversation history cache",
+    ["kind"],
+    collect=history_cache._usage,
+)
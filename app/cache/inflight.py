@@ -0,0 +1,218 @@
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from langchain.callbacks import AsyncIteratorCallbackHandler
+
+from ..configs import logger, log_verbose, SINGLE_FLIGHT, DISCONNECT_GRACE_PERIOD
+from ..utils import wrap_done
+
+__all__ = ["InflightGeneration", "SingleFlight", "single_flight"]
+
+
+class InflightGeneration:
+    """
+    One upstream generation shared by every identical request that arrives while it runs.
+    Tokens are kept as a catch-up buffer, so late subscribers first receive what has
+    already been generated and then follow the live stream.
+    The upstream call is cancelled once its last subscriber goes away, after
+    `grace_period` seconds if the subscriber disconnected (a client may resume).
+    """
+
+    def __init__(
+        self, key: Optional[str] = None, grace_period: float = DISCONNECT_GRACE_PERIOD
+    ):
+        self.key = key
+        self.grace_period = grace_period
+        self.tokens: List[str] = []
+        self.done = False
+        self.ok = False
+        # "stop", "error", or the reason it was cancelled
+        self.finish_reason: Optional[str] = None
+        self.subscribers = 0
+        self._queues: List[asyncio.Queue] = []
+        self._task: Optional[asyncio.Task] = None
+        self._cancel_reason: Optional[str] = None
+        self._hooks: List[Callable[["InflightGeneration"], Awaitable]] = []
+
+    def publish(self, token: str) -> None:
+        self.tokens.append(token)
+        for queue in self._queues:
+            queue.put_nowait(token)
+
+    def finish(self, ok: bool) -> None:
+        self.done = True
+        self.ok = ok
+        for queue in self._queues:
+            queue.put_nowait(None)
+
+    def cancel(self, reason: str) -> None:
+        """
+        cancel the upstream call, the tokens received so far are kept
+        """
+        if self.done or self._task is None or self._task.done():
+            return
+        self._cancel_reason = reason
+        self._task.cancel()
+
+    def _cancel_orphaned(self, reason: str) -> None:
+        if self.subscribers == 0:
+            self.cancel(reason)
+
+    def on_finish(self, hook: Callable[["InflightGeneration"], Awaitable]) -> None:
+        """
+        await hook(generation) once it is finished, whether it succeeded or not.
+        Hooks run in the background task, so they are not cancelled with the request.
+        """
+        if self.done:
+            asyncio.create_task(self._run_hook(hook))
+        else:
+            self._hooks.append(hook)
+
+    async def _run_hook(self, hook: Callable[["InflightGeneration"], Awaitable]) -> None:
+        try:
+            await hook(self)
+        except Exception as e:
+            msg = f"generation finish hook failed: {e}"
+            logger.error(
+                f"{e.__class__.__name__}: {msg}",
+                exc_info=e if log_verbose else None,
+            )
+
+    async def run(self, fn: Awaitable, callback: AsyncIteratorCallbackHandler) -> bool:
+        """
+        drive the upstream call and publish its tokens, independent of any single client
+        """
+        ok = False
+        try:
+            self._task = asyncio.create_task(wrap_done(fn, callback.done))
+            await self._publish_from(callback)
+            try:
+                ok = await self._task
+            except asyncio.CancelledError:
+                if self._cancel_reason is None:
+                    raise
+            return ok
+        finally:
+            self.finish_reason = "stop" if ok else self._cancel_reason or "error"
+            self.finish(ok)
+            for hook in self._hooks:
+                await self._run_hook(hook)
+
+    async def _publish_from(self, callback: AsyncIteratorCallbackHandler) -> None:
+        # not callback.aiter(): it drops the tokens queued in the loop turn the call ends in
+        queue = callback.queue
+        while True:
+            get = asyncio.ensure_future(queue.get())
+            try:
+                await asyncio.wait({get, self._task}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                if not get.done():
+                    get.cancel()
+            if not get.done():
+                break
+            self.publish(get.result())
+        while not queue.empty():
+            self.publish(queue.get_nowait())
+
+    async def aiter(
+        self, deadline: Optional[float] = None, passive: bool = False
+    ) -> AsyncIterator[str]:
+        """
+        Iterate the tokens from the start. Stops early once the event loop time passes `deadline`.
+        Passive subscribers (e.g. loggers) do not keep the upstream call alive.
+        """
+        loop = asyncio.get_running_loop()
+        # snapshot and subscribe without awaiting in between, so no token is missed
+        queue: asyncio.Queue = asyncio.Queue()
+        backlog = list(self.tokens)
+        done = self.done
+        if not done:
+            self._queues.append(queue)
+        if not passive:
+            self.subscribers += 1
+        completed = done
+        reason = "client_disconnected"
+        try:
+            for token in backlog:
+                yield token
+            if done:
+                return
+            while True:
+                timeout = None if deadline is None else deadline - loop.time()
+                try:
+                    if timeout is not None and timeout <= 0:
+                        raise asyncio.TimeoutError
+                    token = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    reason = "deadline_exceeded"
+                    break
+                if token is None:
+                    completed = True
+                    break
+                yield token
+        finally:
+            if queue in self._queues:
+                self._queues.remove(queue)
+            if not passive:
+                self.subscribers -= 1
+                if not completed and self.subscribers == 0:
+                    if reason == "client_disconnected" and self.grace_period > 0:
+                        loop.call_later(self.grace_period, self._cancel_orphaned, reason)
+                    else:
+                        self.cancel(reason)
+
+
+class SingleFlight:
+    """
+    Registry of in-flight generations keyed on the prompt fingerprint.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._calls: Dict[str, InflightGeneration] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def join(self, key: Optional[str]) -> Optional[InflightGeneration]:
+        """
+        return the running generation for `key`, if any
+        """
+        if not (self.enabled and key):
+            return None
+        generation = self._calls.get(key)
+        if generation is not None and not generation.done:
+            self.followers += 1
+            return generation
+        return None
+
+    def start(
+        self,
+        key: Optional[str],
+        fn: Awaitable,
+        callback: AsyncIteratorCallbackHandler,
+    ) -> InflightGeneration:
+        """
+        start a new generation in the background and register it under `key`
+        """
+        generation = InflightGeneration(key)
+        if self.enabled and key:
+            self.leaders += 1
+            self._calls[key] = generation
+        task = asyncio.create_task(generation.run(fn, callback))
+        task.add_done_callback(lambda _: self._forget(generation))
+        return generation
+
+    def _forget(self, generation: InflightGeneration) -> None:
+        if generation.key and self._calls.get(generation.key) is generation:
+            del self._calls[generation.key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "followers": self.followers,
+        }
+
+
+single_flight = SingleFlight(**SINGLE_FLIGHT)
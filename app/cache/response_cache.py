@@ -0,0 +1,123 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from ..configs import RESPONSE_CACHE
+
+__all__ = ["ResponseCache", "response_cache", "normalize_prompt"]
+
+
+def normalize_prompt(text: str) -> str:
+    """
+    collapse whitespace so trivially different prompts share a cache entry
+    """
+    return re.sub(r"\s+", " ", text or "").strip()
+
+
+class ResponseCache:
+    """
+    Exact-match cache of llm answers, keyed on the normalized prompt.
+    Entries are evicted in LRU order when `max_entries` or `max_bytes` is exceeded,
+    and expire `ttl` seconds after they were stored.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        max_entries: int = 1024,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl: float = 3600,
+    ):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data: "OrderedDict[str, Tuple[float, Tuple[str, ...], int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(
+        model_name: str,
+        prompt_name: str,
+        query: str,
+        history: List[Any] = [],
+        **params: Any,
+    ) -> str:
+        history_data = []
+        for h in history or []:
+            if hasattr(h, "role"):
+                h = {"role": h.role, "content": h.content}
+            elif isinstance(h, (list, tuple)):
+                h = {"role": h[0], "content": h[1]}
+            history_data.append([h["role"], normalize_prompt(h["content"])])
+        payload = {
+            "model_name": model_name,
+            "prompt_name": prompt_name,
+            "history": history_data,
+            "query": normalize_prompt(query),
+            "params": params,
+        }
+        raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[str, ...]]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expire_at, tokens, _ = item
+            if expire_at < time.monotonic():
+                self._pop(key)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return tokens
+
+    def set(self, key: str, tokens: List[str]) -> None:
+        tokens = tuple(tokens)
+        size = len(key) + sum(len(t.encode("utf-8")) for t in tokens)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (time.monotonic() + self.ttl, tokens, size)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                self._pop(next(iter(self._data)))
+                self.evictions += 1
+
+    def _pop(self, key: str) -> None:
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+response_cache = ResponseCache(**RESPONSE_CACHE)
@@ -0,0 +1,289 @@
+import asyncio
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from ..configs import logger, SEMANTIC_CACHE
+from ..memory.embeddings import HashingEmbedder, embedder
+from ..memory.vector_index import VectorIndex
+from ..metrics import metrics_registry
+from .response_cache import normalize_prompt
+
+__all__ = ["SemanticCache", "semantic_cache"]
+
+semantic_cache_lookups = metrics_registry.counter(
+    "semantic_cache_lookups_total",
+    "Semantic cache lookups by prompt template and result (hit, miss)",
+    ["prompt_name", "result"],
+)
+semantic_cache_false_hits = metrics_registry.counter(
+    "semantic_cache_false_hits_total",
+    "Semantic cache hits reported as wrong answers",
+    ["prompt_name"],
+)
+
+Scope = Tuple[str, str, Optional[int]]
+
+
+class _Entry:
+    __slots__ = ("id", "scope", "text", "tokens", "expire_at", "hits")
+
+    def __init__(self, scope: Scope, text: str, tokens: Tuple[str, ...], expire_at: float):
+        self.id = uuid.uuid4().hex
+        self.scope = scope
+        self.text = text
+        self.tokens = tokens
+        self.expire_at = expire_at
+        self.hits = 0
+
+
+class SemanticCache:
+    """
+    Answers of prior prompts, found again by the similarity of their embeddings, so
+    paraphrases of a cached prompt get its answer. Entries are scoped by model_name,
+    prompt_name and max_tokens, each scope has its own VectorIndex, and only the query
+    is embedded. A hit needs the threshold of its prompt template (`thresholds`, else
+    `threshold`).
+    The cache is not enabled with the HashingEmbedder: word overlap scores a query with
+    another entity or operand above most paraphrases, no threshold separates them.
+    Entries expire `ttl` seconds after they were stored, the oldest are evicted past
+    `max_entries`. The last `review_size` hits are kept with both prompts for review,
+    a hit reported as wrong (false_hit) drops its entry.
+    On the event loop use aget / aset, they embed in an executor thread: the embedder
+    is pluggable and a model embedder takes milliseconds per text.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        threshold: float = 0.9,
+        thresholds: Dict[str, float] = {},
+        ttl: float = 24 * 3600,
+        max_entries: int = 10000,
+        review_size: int = 1000,
+    ):
+        if enabled and isinstance(embedder, HashingEmbedder):
+            logger.warning(
+                "semantic cache disabled: it needs a semantic EMBEDDING, the hashing "
+                "embedder matches queries by their words"
+            )
+            enabled = False
+        self.enabled = enabled
+        self.threshold = threshold
+        self.thresholds = dict(thresholds)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._indexes: Dict[Scope, VectorIndex] = {}
+        # entry id -> entry, oldest first: expiry and eviction order
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._hits: Deque[Dict[str, Any]] = deque(maxlen=review_size)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.false_hits: Dict[str, int] = {}
+
+    @staticmethod
+    def query_text(query: str) -> str:
+        """
+        the text embedded for a request, its normalized query: the template is the same
+        for the whole scope and would dominate the vector
+        """
+        return normalize_prompt(query)
+
+    def threshold_of(self, prompt_name: str) -> float:
+        return self.thresholds.get(prompt_name, self.threshold)
+
+    def get(
+        self,
+        model_name: str,
+        prompt_name: str,
+        max_tokens: Optional[int],
+        text: str,
+        vector: Optional[np.ndarray] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        the closest cached answer over the threshold, as a review record with its
+        "tokens", or None. `vector` is the embedding of `text` if already known.
+        """
+        scope = (model_name, prompt_name, max_tokens)
+        if vector is None:
+            vector = embedder.embed_one(text)
+        with self._lock:
+            self._expire()
+            index = self._indexes.get(scope)
+            hits = index.search(vector, 1, min_score=self.threshold_of(prompt_name)) if index else []
+            if not hits:
+                self.misses += 1
+                semantic_cache_lookups.labels(prompt_name, "miss").inc()
+                return None
+            position, score = hits[0]
+            entry = self._entries[index.ids[position]]
+            entry.hits += 1
+            self.hits += 1
+            semantic_cache_lookups.labels(prompt_name, "hit").inc()
+            hit = {
+                "hit_id": uuid.uuid4().hex,
+                "entry_id": entry.id,
+                "time": time.time(),
+                "model_name": model_name,
+                "prompt_name": prompt_name,
+                "score": round(score, 4),
+                "threshold": self.threshold_of(prompt_name),
+                "query": text,
+                "cached_query": entry.text,
+                "answer": "".join(entry.tokens),
+                "message_id": None,
+            }
+            self._hits.append(hit)
+            return dict(hit, tokens=entry.tokens)
+
+    def set(
+        self,
+        model_name: str,
+        prompt_name: str,
+        max_tokens: Optional[int],
+        text: str,
+        tokens: List[str],
+        vector: Optional[np.ndarray] = None,
+    ) -> None:
+        scope = (model_name, prompt_name, max_tokens)
+        entry = _Entry(scope, text, tuple(tokens), time.monotonic() + self.ttl)
+        if vector is None:
+            vector = embedder.embed_one(text)
+        with self._lock:
+            index = self._indexes.get(scope)
+            if index is None:
+                index = self._indexes[scope] = VectorIndex(embedder.dim)
+            index.add([entry.id], [vector])
+            self._entries[entry.id] = entry
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    async def aget(
+        self, model_name: str, prompt_name: str, max_tokens: Optional[int], text: str
+    ) -> Optional[Dict[str, Any]]:
+        vector = await asyncio.get_running_loop().run_in_executor(None, embedder.embed_one, text)
+        return self.get(model_name, prompt_name, max_tokens, text, vector)
+
+    async def aset(
+        self, model_name: str, prompt_name: str, max_tokens: Optional[int], text: str, tokens: List[str]
+    ) -> None:
+        vector = await asyncio.get_running_loop().run_in_executor(None, embedder.embed_one, text)
+        self.set(model_name, prompt_name, max_tokens, text, tokens, vector)
+
+    def _remove(self, entry_id: str) -> Optional[_Entry]:
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return None
+        index = self._indexes[entry.scope]
+        index.remove(entry_id)
+        if not len(index):
+            del self._indexes[entry.scope]
+        return entry
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        while self._entries:
+            entry = next(iter(self._entries.values()))
+            if entry.expire_at > now:
+                break
+            self._remove(entry.id)
+            self.expirations += 1
+
+    def link_message(self, hit_id: str, message_id: str) -> None:
+        """
+        remember the message a hit answered, to find the hit from a reported message
+        """
+        with self._lock:
+            for hit in reversed(self._hits):
+                if hit["hit_id"] == hit_id:
+                    hit["message_id"] = message_id
+                    return
+
+    def recent_hits(self, limit: int = 50, prompt_name: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        the last hits, newest first, with both prompts side by side for review
+        """
+        with self._lock:
+            hits = [h for h in reversed(self._hits) if prompt_name is None or h["prompt_name"] == prompt_name]
+            return [dict(h) for h in hits[:limit]]
+
+    def false_hit(self, id: str) -> Optional[Dict[str, Any]]:
+        """
+        report the hit `id` (hit id or message id) as a wrong answer: its entry is dropped
+        and counted against the template's threshold. Return the hit, None if unknown.
+        """
+        with self._lock:
+            hit = next(
+                (h for h in reversed(self._hits) if id in (h["hit_id"], h["message_id"])), None
+            )
+            if hit is None:
+                return None
+            if not hit.get("false_hit"):
+                hit["false_hit"] = True
+                prompt_name = hit["prompt_name"]
+                self.false_hits[prompt_name] = self.false_hits.get(prompt_name, 0) + 1
+                semantic_cache_false_hits.labels(prompt_name).inc()
+                self._remove(hit["entry_id"])
+            return dict(hit)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._indexes.clear()
+            self._entries.clear()
+
+    def _review(self) -> Dict[str, Dict[str, Any]]:
+        """
+        per prompt template: hits, reported false hits, and the lowest threshold that
+        would have refused all of those that are still kept for review
+        """
+        templates: Dict[str, Dict[str, Any]] = {}
+        for hit in self._hits:
+            t = templates.setdefault(
+                hit["prompt_name"], {"hits": 0, "false_hits": 0, "max_false_hit_score": None}
+            )
+            t["hits"] += 1
+            if hit.get("false_hit"):
+                t["false_hits"] += 1
+                t["max_false_hit_score"] = max(t["max_false_hit_score"] or -1.0, hit["score"])
+        for prompt_name, t in templates.items():
+            t["threshold"] = self.threshold_of(prompt_name)
+            t["false_hit_rate"] = t["false_hits"] / t["hits"] if t["hits"] else 0.0
+            t["suggested_threshold"] = (
+                round(min(t["max_false_hit_score"] + 0.005, 1.0), 4)
+                if t["max_false_hit_score"] is not None
+                else t["threshold"]
+            )
+        return templates
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "scopes": len(self._indexes),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "false_hits": sum(self.false_hits.values()),
+                "templates": self._review(),
+            }
+
+
+semantic_cache = SemanticCache(**SEMANTIC_CACHE)
+
+metrics_registry.gauge(
+    "semantic_cache_entries",
+    "Answers in the semantic cache",
+    collect=lambda: [((), len(semantic_cache._entries))],
+)
@@ -1,18 +1,21 @@
 from typing import Any, Dict, List, Union, Optional
 
-from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.base import AsyncCallbackHandler
 from langchain.schema import LLMResult
-from ..db.repository.message_repository import update_message
+from ..db.repository.message_repository import aupdate_message
+from ..upstream.rate_limiter import Reservation
 
 
-class ConversationCallbackHandler(BaseCallbackHandler):
+class ConversationCallbackHandler(AsyncCallbackHandler):
     raise_error: bool = True
 
-    def __init__(self, conversation_id: str, message_id: str, chat_type: str, query: str):
+    def __init__(self, conversation_id: str, message_id: str, chat_type: str, query: str,
+                 reservation: Optional[Reservation] = None):
         self.conversation_id = conversation_id
         self.message_id = message_id
         self.chat_type = chat_type
         self.query = query
+        self.reservation = reservation
         self.start_at = None
 
     @property
@@ -20,12 +23,21 @@ class ConversationCallbackHandler(BaseCallbackHandler):
         """Whether to call verbose callbacks even if verbose is False."""
         return True
 
-    def on_llm_start(
+    async def on_llm_start(
             self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
     ) -> None:
         # 如果想存更多信息，则prompts 也需要持久化
         pass
 
-    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+    async def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
         answer = response.generations[0][0].text
-        update_message(self.message_id, answer)
+        if self.message_id:
+            await aupdate_message(self.message_id, answer)
+        if self.reservation is not None:
+            # correct the rate limit reservation with the real usage
+            token_usage = (response.llm_output or {}).get("token_usage") or {}
+            if token_usage.get("total_tokens"):
+                await self.reservation.settle(token_usage["total_tokens"])
+            else:
+                # streamed responses carry no usage
+                await self.reservation.settle_text(answer)
@@ -0,0 +1,44 @@
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+
+from langchain.callbacks.base import AsyncCallbackHandler
+from langchain.schema import LLMResult
+from ..tracing import Span, tracer
+
+
+class TracingCallbackHandler(AsyncCallbackHandler):
+    """
+    One span per LLM run of the current trace, with its first token as an event
+    """
+
+    def __init__(self, backend: str = ""):
+        self.backend = backend
+        self.spans: Dict[UUID, Span] = {}
+        self.tokens: Dict[UUID, int] = {}
+
+    async def on_llm_start(
+            self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        span = tracer.start_span("llm", backend=self.backend, prompt_chars=sum(len(p) for p in prompts))
+        if span is not None:
+            self.spans[run_id] = span
+            self.tokens[run_id] = 0
+
+    async def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        span = self.spans.get(run_id)
+        if span is not None:
+            if self.tokens[run_id] == 0:
+                span.event("first_token")
+            self.tokens[run_id] += 1
+
+    def _finish(self, run_id: UUID, error: Optional[BaseException] = None) -> None:
+        span = self.spans.pop(run_id, None)
+        if span is not None:
+            span.set(tokens=self.tokens.pop(run_id, 0))
+            span.finish(error)
+
+    async def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        self._finish(run_id)
+
+    async def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._finish(run_id, error)
@@ -1 +1,2 @@
-from .chat import *
\ No newline at end of file
+from .chat import *
+from .batch import *
@@ -0,0 +1,208 @@
+import asyncio
+import json
+from typing import Any, AsyncIterable, AsyncIterator, Dict, List, Literal, Optional, Union
+
+import pydantic
+from fastapi import Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+
+from app.configs import (
+    BATCH_CHAT,
+    LLM_MODELS,
+    TEMPERATURE,
+    SSE_FLUSH_INTERVAL,
+    SSE_FLUSH_BYTES,
+    logger,
+    log_verbose,
+)
+from app.schemas import History, BaseResponse
+from app.db.repository.message_write_queue import message_write_queue
+from app.chat.chat import chat_stream
+
+__all__ = ["BatchChatItem", "chat_batch"]
+
+
+class BatchChatItem(BaseModel):
+    """
+    One request of a batch, same fields as the /chat body (the answer is never streamed)
+    """
+
+    query: str = Field(..., description="User input")
+    conversation_id: str = Field("", description="Dialog ID")
+    history_len: int = Field(-1, description="Get the number of historical messages from the database")
+    history: Union[int, List[History]] = Field([], description="Historical conversation")
+    model_name: str = Field(LLM_MODELS[0], description="LLM Model name")
+    temperature: float = Field(TEMPERATURE, description="LLM Temperature", ge=0.0, le=1.0)
+    max_tokens: Optional[int] = Field(None, description="Limit the number of tokens generated by LLM")
+    prompt_name: str = Field("default", description="Prompt template name to use")
+    timeout: Optional[float] = Field(None, description="Deadline of this item in seconds", gt=0)
+    lane: Literal["interactive", "batch"] = Field("batch", description="Scheduling lane of the item")
+    memory_type: Literal["buffer", "summary", "retrieval"] = Field("buffer", description="How history is loaded from the database")
+
+
+async def _iter_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[str]:
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8")
+    if buffer:
+        yield buffer.decode("utf-8")
+
+
+async def _read_upload(upload, size: int = 65536) -> AsyncIterator[bytes]:
+    while chunk := await upload.read(size):
+        yield chunk
+
+
+async def _iter_items(lines: AsyncIterable[str]) -> AsyncIterator[Any]:
+    async for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            # reported as the error of this item
+            yield e
+
+
+async def _iter_list(items: List[Any]) -> AsyncIterator[Any]:
+    for item in items:
+        yield item
+
+
+async def run_batch_item(request: Request, item: Any) -> Dict[str, Any]:
+    """
+    run one item through the /chat pipeline and return its result line
+    """
+    if isinstance(item, Exception):
+        return BaseResponse(code=422, msg=f"invalid json: {item}").model_dump()
+    try:
+        item = BatchChatItem.model_validate(item)
+    except pydantic.ValidationError as e:
+        return BaseResponse(code=422, msg=str(e)).model_dump()
+
+    response = await chat_stream(
+        request,
+        stream=False,
+        flush_interval=SSE_FLUSH_INTERVAL,
+        flush_bytes=SSE_FLUSH_BYTES,
+        x_request_timeout=None,
+        **item.model_dump(),
+    )
+    if isinstance(response, JSONResponse):
+        # rejected by admission control or the rate limiter
+        return json.loads(response.body)
+    body = "".join([chunk async for chunk in response.body_iterator])
+    data = json.loads(body)
+    if data.get("finish_reason") == "error":
+        return BaseResponse(code=500, msg="generation failed", data=data).model_dump()
+    return BaseResponse(data=data).model_dump()
+
+
+async def chat_batch(
+    request: Request,
+    parallelism: int = Query(
+        BATCH_CHAT["parallelism"],
+        description="Number of items run at the same time",
+        ge=1,
+        le=BATCH_CHAT["max_parallelism"],
+    ),
+):
+    """
+    Run many independent chat requests. The body is a JSON array of /chat bodies, a JSONL
+    body (Content-Type: application/x-ndjson) or a multipart upload of a JSONL `file`.
+    Results are streamed as NDJSON, one line per item in completion order, tagged with the
+    item's index; a failed item gets an error line and does not stop the batch.
+    """
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file")
+        if upload is None or isinstance(upload, str):
+            return BaseResponse(code=422, msg="no JSONL file uploaded as `file`")
+        items = _iter_items(_iter_lines(_read_upload(upload)))
+    elif "ndjson" in content_type or "jsonl" in content_type:
+        # read before responding, the streaming response listens on the same channel for disconnects
+        body = await request.body()
+        items = _iter_items(_iter_lines(_iter_list([body])))
+    else:
+        try:
+            data = await request.json()
+        except ValueError as e:
+            return BaseResponse(code=422, msg=f"invalid json: {e}")
+        if not isinstance(data, list):
+            return BaseResponse(code=422, msg="expected a JSON array of chat requests")
+        items = _iter_list(data)
+
+    async def batch_iterator() -> AsyncIterable[str]:
+        # message rows of the whole batch are written in bulk transactions
+        message_write_queue.enable_for_context()
+        results: asyncio.Queue = asyncio.Queue()
+        read_lock = asyncio.Lock()
+        next_index = 0
+        max_items = BATCH_CHAT["max_items"]
+        truncated = False
+
+        async def next_item():
+            nonlocal next_index, truncated
+            # workers pull from the input, so only `parallelism` items are read ahead
+            async with read_lock:
+                if truncated:
+                    return None, None
+                try:
+                    item = await items.__anext__()
+                except StopAsyncIteration:
+                    return None, None
+                if max_items and next_index >= max_items:
+                    truncated = True
+                    return None, None
+                next_index += 1
+                return next_index - 1, item
+
+        async def worker() -> None:
+            while True:
+                try:
+                    index, item = await next_item()
+                except Exception as e:
+                    await results.put(
+                        BaseResponse(code=400, msg=f"failed to read the batch: {e}").model_dump()
+                    )
+                    return
+                if index is None:
+                    return
+                try:
+                    result = await run_batch_item(request, item)
+                except Exception as e:
+                    msg = f"batch item {index} failed: {e}"
+                    logger.error(
+                        f"{e.__class__.__name__}: {msg}",
+                        exc_info=e if log_verbose else None,
+                    )
+                    result = BaseResponse(code=500, msg=str(e)).model_dump()
+                await results.put({"index": index, **result})
+
+        workers = [asyncio.create_task(worker()) for _ in range(parallelism)]
+        done = asyncio.gather(*workers)
+        try:
+            while not (done.done() and results.empty()):
+                getter = asyncio.ensure_future(results.get())
+                await asyncio.wait({getter, done}, return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    yield json.dumps(getter.result(), ensure_ascii=False) + "\n"
+                else:
+                    getter.cancel()
+            if truncated:
+                yield json.dumps(
+                    BaseResponse(code=413, msg=f"batch is limited to {max_items} items, the rest was skipped").model_dump()
+                ) + "\n"
+            # the batch is over once its rows are committed
+            await message_write_queue.flush()
+        finally:
+            for task in workers:
+                task.cancel()
+
+    return StreamingResponse(batch_iterator(), media_type="application/x-ndjson")
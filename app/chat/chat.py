@@ -1,25 +1,126 @@
-from fastapi import Body
-from fastapi.responses import StreamingResponse
-from app.configs import LLM_MODELS, TEMPERATURE
-from app.utils import wrap_done, get_ChatOpenAI, get_prompt_template
+from fastapi import Body, Header, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from app.configs import LLM_MODELS, TEMPERATURE, SSE_FLUSH_INTERVAL, SSE_FLUSH_BYTES
+from app.utils import get_ChatOpenAI, get_prompt_template, get_model_worker_config
 from langchain.chains import LLMChain
 from langchain.callbacks import AsyncIteratorCallbackHandler
-from typing import AsyncIterable
+from typing import AsyncIterable, Awaitable, Iterable
 import asyncio
 import json
 from langchain.prompts.chat import ChatPromptTemplate
-from typing import List, Optional, Union
-from app.schemas import History
-from langchain.prompts import PromptTemplate
+from typing import List, Literal, Optional, Tuple, Union
+from app.schemas import History, BaseResponse
+from langchain.prompts import BasePromptTemplate, PromptTemplate
 
 from app.memory.conversation_db_buffer_memory import ConversationBufferDBMemory
-from app.db.repository.message_repository import add_message_to_db
+from app.memory.conversation_summary_db_memory import ConversationSummaryDBMemory
+from app.memory.conversation_retrieval_db_memory import ConversationRetrievalDBMemory
+from app.memory.context_budget import context_budgeter, ContextWindowExceeded
+from app.db.repository.message_repository import aadd_message_to_db, aupdate_message
+from app.cache import response_cache, semantic_cache, single_flight, InflightGeneration
+from app.chat.sse import SSEWriter
+from app.chat.stream_log import stream_logs, skip_chars
+from app.upstream import (
+    chat_scheduler,
+    get_flow_id,
+    SchedulerRejected,
+    rate_limiter,
+    estimate_tokens,
+    model_router,
+)
+from app.db.repository.message_chunk_repository import aget_message_text
+from app.metrics import chat_stage_seconds, chat_inflight_streams
+from app.tracing import tracer
 from app.callback_handler.conversation_callback_handler import (
     ConversationCallbackHandler,
 )
+from app.callback_handler.tracing_callback_handler import TracingCallbackHandler
+
+
+async def replay(tokens: Iterable[str]) -> AsyncIterable[str]:
+    """
+    Replay stored tokens as if they came from the model
+    """
+    for token in tokens:
+        yield token
+
+
+def get_finish_reason(generation: Optional[InflightGeneration]) -> str:
+    if generation is None:
+        # replayed from the response cache
+        return "stop"
+    if not generation.done:
+        # this request's deadline passed, the shared generation goes on
+        return "deadline_exceeded"
+    return generation.finish_reason
+
+
+def build_chat_prompt(
+    model,
+    history: Union[int, List[History]],
+    conversation_id: str,
+    history_len: int,
+    prompt_name: str,
+    history_token_limit: Optional[int] = None,
+    budget=None,
+    memory_type: str = "buffer",
+    model_name: Optional[str] = None,
+) -> Tuple[BasePromptTemplate, Optional[ConversationBufferDBMemory]]:
+    """
+    The prompt of a chat request, and the memory loading its history from the db if it has to.
+    `history_token_limit` and `budget` (a ContextBudget) apply to the history loaded from the db,
+    `memory_type` picks how it is loaded: the newest messages ("buffer"), a running summary
+    and the messages since ("summary") or the turns most similar to the query and the
+    newest ones ("retrieval"). `model_name` is the request's, summaries are made by it.
+    """
+    memory = None
+    if history:  # Prioritize the use of historical messages incoming from the front end
+        history = [History.from_data(h) for h in history]
+        prompt_template = get_prompt_template("llm_chat", prompt_name)
+        input_msg = History(role="user", content=prompt_template).to_msg_template(False)
+        chat_prompt = ChatPromptTemplate.from_messages(
+            [i.to_msg_template() for i in history] + [input_msg]
+        )
+    elif (
+        conversation_id and history_len > 0
+    ):  # The front end requires fetching historical messages from the database
+        #
+        # When using memory, prompt must contain the variable corresponding to memory.memory_key
+        prompt = get_prompt_template("llm_chat", "with_history")
+        chat_prompt = PromptTemplate.from_template(prompt)
+        # Get the message list based on conversation_id and piece together the memory
+        if memory_type == "summary":
+            # loads the messages since the summary, up to SUMMARY_MEMORY["message_limit"]
+            memory = ConversationSummaryDBMemory(
+                conversation_id=conversation_id,
+                llm=model,
+                budget=budget,
+                model_name=model_name,
+            )
+        elif memory_type == "retrieval":
+            memory = ConversationRetrievalDBMemory(
+                conversation_id=conversation_id,
+                llm=model,
+                budget=budget,
+            )
+        else:
+            memory = ConversationBufferDBMemory(
+                conversation_id=conversation_id,
+                llm=model,
+                message_limit=history_len,
+                budget=budget,
+            )
+        if history_token_limit is not None:
+            memory.max_token_limit = history_token_limit
+    else:
+        prompt_template = get_prompt_template("llm_chat", prompt_name)
+        input_msg = History(role="user", content=prompt_template).to_msg_template(False)
+        chat_prompt = ChatPromptTemplate.from_messages([input_msg])
+    return chat_prompt, memory
 
 
 async def chat_stream(
+    request: Request,
     query: str = Body(..., description="User input", examples=["angry"]),
     conversation_id: str = Body("", description="Dialog ID"),
     history_len: int = Body(
@@ -51,88 +152,373 @@ async def chat_stream(
         "default",
         description="Prompt template name to use(Configure in configs/prompt_config.py",
     ),
+    flush_interval: int = Body(
+        SSE_FLUSH_INTERVAL,
+        description="Streaming only: flush coalesced tokens at least every N ms",
+        ge=0,
+    ),
+    flush_bytes: int = Body(
+        SSE_FLUSH_BYTES,
+        description="Streaming only: flush coalesced tokens once M bytes are buffered",
+        ge=1,
+    ),
+    timeout: Optional[float] = Body(
+        None,
+        description="End-to-end deadline in seconds, generation is cancelled when it passes",
+        gt=0,
+    ),
+    x_request_timeout: Optional[float] = Header(
+        None, description="Same as the timeout body field", gt=0
+    ),
+    lane: Literal["interactive", "batch"] = Body(
+        "interactive", description="Scheduling lane of the request"
+    ),
+    memory_type: Literal["buffer", "summary", "retrieval"] = Body(
+        "buffer",
+        description="History loaded from the database: the last history_len messages (buffer), "
+        "a running summary plus the messages since (summary), "
+        "or the past turns most relevant to the query plus the last few (retrieval)",
+    ),
 ):
-    async def chat_iterator() -> AsyncIterable[str]:
-        nonlocal history, max_tokens
-        callback = AsyncIteratorCallbackHandler()
-        callbacks = [callback]
-        memory = None
+    loop = asyncio.get_running_loop()
+    timeout = timeout or x_request_timeout
+    deadline = loop.time() + timeout if timeout else None
+
+    if isinstance(max_tokens, int) and max_tokens <= 0:
+        max_tokens = None
 
+    if get_prompt_template("llm_chat", prompt_name) is None:
+        return JSONResponse(
+            status_code=400,
+            content={"code": 400, "msg": f"unknown prompt_name {prompt_name}", "data": None},
+        )
+
+    # Whether history is loaded from the db, decided before the budget may trim
+    # the history sent by the client down to nothing
+    db_history = bool(conversation_id and history_len > 0 and not history)
+
+    # A prompt fully described by the request (no history loaded from the db)
+    # can be shared with identical requests
+    fingerprint = None
+    if not db_history:
+        fingerprint = response_cache.make_key(
+            model_name=model_name,
+            prompt_name=prompt_name,
+            query=query,
+            history=history,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+
+    # Only deterministic calls are cacheable
+    cache_key = None
+    tokens = None
+    if response_cache.enabled and temperature == 0 and fingerprint:
+        cache_key = fingerprint
+        tokens = response_cache.get(cache_key)
+
+    # A paraphrase of a prompt answered before gets the same answer
+    semantic_text = None
+    semantic_hit = None
+    semantic_max_tokens = max_tokens
+    if (
+        tokens is None
+        and semantic_cache.enabled
+        and temperature == 0
+        and not history
+        and not db_history
+    ):
+        semantic_text = semantic_cache.query_text(query)
+        semantic_hit = await semantic_cache.aget(model_name, prompt_name, max_tokens, semantic_text)
+        if semantic_hit is not None:
+            tokens = semantic_hit.pop("tokens")
+
+    # Fit history and output to the model's context window before anything is reserved
+    budget = None
+    if tokens is None and context_budgeter.enabled:
+        try:
+            history, budget = await context_budgeter.afit(
+                model_name,
+                get_prompt_template("llm_chat", "with_history" if db_history else prompt_name)
+                + query,
+                [History.from_data(h) for h in history] if isinstance(history, list) else [],
+                max_tokens,
+                ConversationBufferDBMemory.__fields__["max_token_limit"].default
+                if db_history
+                else None,
+            )
+        except ContextWindowExceeded as e:
+            return JSONResponse(
+                status_code=e.status_code,
+                content={"code": e.status_code, "msg": e.msg, "data": None},
+            )
+        max_tokens = budget.max_tokens
+
+    # Attach to an identical generation that is already running,
+    # otherwise wait for a slot to start a new one
+    generation = None
+    ticket = None
+    reservation = None
+    if tokens is None:
+        generation = single_flight.join(fingerprint)
+        if generation is None:
+            flow = get_flow_id(
+                request.headers,
+                conversation_id,
+                request.client.host if request.client else "",
+            )
+            prompt_tokens = estimate_tokens(
+                query + "".join(str(h) for h in history or [])
+            )
+            if db_history:
+                prompt_tokens += (
+                    budget.history_limit
+                    if budget is not None
+                    else ConversationBufferDBMemory.__fields__["max_token_limit"].default
+                )
+            try:
+                with tracer.span("rate_limit.reserve"):
+                    reservation = await rate_limiter.reserve(
+                        model_name,
+                        # the model's budget, whichever backend ends up serving the call
+                        rate_limiter.model_limits(
+                            model_name,
+                            [
+                                get_model_worker_config(model_name, backend)
+                                for backend in model_router.backends(model_name)
+                            ],
+                        ),
+                        flow,
+                        prompt_tokens,
+                        max_tokens,
+                    )
+                with tracer.span("scheduler.acquire", lane=lane):
+                    ticket = await chat_scheduler.acquire(model_name, flow, lane, deadline)
+            except SchedulerRejected as e:
+                if reservation is not None:
+                    await reservation.settle(0)
+                return JSONResponse(
+                    status_code=e.status_code,
+                    content={"code": e.status_code, "msg": e.msg, "data": None},
+                    headers={"Retry-After": str(e.retry_after)},
+                )
+            # an identical generation may have started while this request was queued
+            generation = single_flight.join(fingerprint)
+            if generation is not None:
+                ticket.release()
+                ticket = None
+                await reservation.settle(0)
+                reservation = None
+    is_follower = generation is not None
+    tracer.annotate(
+        model_name=model_name,
+        cache_hit=tokens is not None,
+        semantic_hit=semantic_hit is not None,
+        follower=is_follower,
+    )
+
+    callback = AsyncIteratorCallbackHandler()
+    callbacks = []
+    memory = None
+    message_id = ""
+
+    try:
         if conversation_id:
-            message_id = add_message_to_db(
+            message_id = await aadd_message_to_db(
                 chat_type="llm_chat", query=query, conversation_id=conversation_id
             )
             print(f"message_id {message_id}")
+            tracer.add_message_id(message_id)
+            if semantic_hit is not None:
+                semantic_cache.link_message(semantic_hit["hit_id"], message_id)
+        if message_id or reservation is not None:
             # Responsible for saving llm response to message db
             conversation_callback = ConversationCallbackHandler(
                 conversation_id=conversation_id,
                 message_id=message_id,
                 chat_type="llm_chat",
                 query=query,
+                reservation=reservation,
             )
             callbacks.append(conversation_callback)
 
-        if isinstance(max_tokens, int) and max_tokens <= 0:
-            max_tokens = None
+        if tokens is not None:
+            if message_id:
+                await aupdate_message(message_id, "".join(tokens))
+        elif not is_follower:
+            # only used by the memory to count tokens, each call builds its own model
+            model = get_ChatOpenAI(
+                model_name=model_name,
+                temperature=temperature,
+                max_tokens=max_tokens,
+            )
+            with chat_stage_seconds.labels("prompt_build").time(), tracer.span("prompt_build"):
+                chat_prompt, memory = build_chat_prompt(
+                    model,
+                    history,
+                    conversation_id,
+                    history_len if db_history else 0,
+                    prompt_name,
+                    history_token_limit=budget.history_limit if budget is not None else None,
+                    budget=budget,
+                    memory_type=memory_type,
+                    model_name=model_name,
+                )
 
-        model = get_ChatOpenAI(
-            model_name=model_name,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            callbacks=callbacks,
-        )
+            def call(backend: str, attempt_callbacks: List) -> Awaitable:
+                if tracer.current() is not None:
+                    attempt_callbacks = attempt_callbacks + [TracingCallbackHandler(backend)]
+                model = get_ChatOpenAI(
+                    model_name=model_name,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    callbacks=attempt_callbacks + callbacks,
+                    timeout=deadline - loop.time() if deadline else None,
+                    backend=backend,
+                    # fail over to the next backend rather than retrying this one
+                    max_retries=0 if len(model_router.backends(model_name)) > 1 else None,
+                )
+                chain = LLMChain(prompt=chat_prompt, llm=model, memory=memory)
+                return chain.acall({"input": query})
 
-        if (
-            history
-        ):  # Prioritize the use of historical messages incoming from the front end
-            history = [History.from_data(h) for h in history]
-            prompt_template = get_prompt_template("llm_chat", prompt_name)
-            input_msg = History(role="user", content=prompt_template).to_msg_template(
-                False
-            )
-            chat_prompt = ChatPromptTemplate.from_messages(
-                [i.to_msg_template() for i in history] + [input_msg]
-            )
-        elif (
-            conversation_id and history_len > 0
-        ):  # The front end requires fetching historical messages from the database
-            #
-            # When using memory, prompt must contain the variable corresponding to memory.memory_key
-            prompt = get_prompt_template("llm_chat", "with_history")
-            chat_prompt = PromptTemplate.from_template(prompt)
-            # Get the message list based on conversation_id and piece together the memory
-            memory = ConversationBufferDBMemory(
-                conversation_id=conversation_id, llm=model, message_limit=history_len
+            # Begin a task that runs in the background, on the backend picked by the router.
+            generation = single_flight.start(
+                fingerprint, model_router.acall(model_name, call, callback), callback
             )
+    except BaseException:
+        if ticket is not None:
+            ticket.release()
+        if reservation is not None:
+            await reservation.settle(0)
+        raise
+
+    if generation is not None:
+        if ticket is not None:
+            # the concurrency slot is held until the upstream call is over
+            async def release_slot(generation: InflightGeneration) -> None:
+                ticket.release()
+
+            generation.on_finish(release_slot)
+        if reservation is not None:
+            # cancelled or failed calls never reach on_llm_end
+            async def settle_reservation(generation: InflightGeneration) -> None:
+                await reservation.settle_text("".join(generation.tokens))
+
+            generation.on_finish(settle_reservation)
+        stream_logs.start(message_id, generation)
+
+        async def save_response(generation: InflightGeneration) -> None:
+            text = "".join(generation.tokens)
+            if generation.ok:
+                # The leader's ConversationCallbackHandler only saves the leader's message
+                if is_follower and message_id:
+                    await aupdate_message(message_id, text)
+                if cache_key and generation.tokens:
+                    response_cache.set(cache_key, generation.tokens)
+                if semantic_text is not None and generation.tokens and not is_follower:
+                    await semantic_cache.aset(
+                        model_name, prompt_name, semantic_max_tokens, semantic_text, generation.tokens
+                    )
+            elif message_id:
+                # keep what was generated before it was cancelled or failed
+                await aupdate_message(
+                    message_id,
+                    text,
+                    metadata={
+                        "truncated": True,
+                        "finish_reason": generation.finish_reason,
+                    },
+                )
+
+        generation.on_finish(save_response)
+
+    # lets clients report a wrong answer, POST /chat/semantic_cache/false_hit/{hit_id}
+    semantic_info = None
+    if semantic_hit is not None:
+        semantic_info = {k: semantic_hit[k] for k in ("hit_id", "score", "cached_query")}
+
+    async def chat_iterator() -> AsyncIterable[str]:
+        if generation is None:
+            token_iter = replay(tokens)
         else:
-            prompt_template = get_prompt_template("llm_chat", prompt_name)
-            input_msg = History(role="user", content=prompt_template).to_msg_template(
-                False
-            )
-            chat_prompt = ChatPromptTemplate.from_messages([input_msg])
-        
-        #message_id =1
-        chain = LLMChain(prompt=chat_prompt, llm=model, memory=memory)
-
-        # Begin a task that runs in the background.
-        task = asyncio.create_task(
-            wrap_done(chain.acall({"input": query}), callback.done),
-        )
+            token_iter = generation.aiter(deadline)
 
-        if stream:
-            async for token in callback.aiter():
+        chat_inflight_streams.inc()
+        try:
+            if stream:
                 # Use server-sent-events to stream the response
+                writer = SSEWriter(flush_interval, flush_bytes)
+                yield writer.meta(message_id=message_id, conversation_id=conversation_id)
+                async for frame in writer.stream(token_iter):
+                    yield frame
+                yield writer.done(
+                    message_id=message_id,
+                    finish_reason=get_finish_reason(generation),
+                    budget=budget.to_dict() if budget is not None else None,
+                    semantic_cache=semantic_info,
+                )
+            else:
+                answer = "".join([token async for token in token_iter])
                 yield json.dumps(
-                    {"text": token, "message_id": message_id}, ensure_ascii=False
+                    {
+                        "text": answer,
+                        "message_id": message_id,
+                        "finish_reason": get_finish_reason(generation),
+                        "budget": budget.to_dict() if budget is not None else None,
+                        "semantic_cache": semantic_info,
+                    },
+                    ensure_ascii=False,
                 )
-        else:
-            answer = ""
-            async for token in callback.aiter():
-                answer += token
-            yield json.dumps(
-                {"text": answer, "message_id": message_id}, ensure_ascii=False
-            )
+        finally:
+            chat_inflight_streams.dec()
 
-        await task
+    return StreamingResponse(
+        chat_iterator(),
+        media_type="text/event-stream" if stream else "application/json",
+    )
+
+
+async def chat_resume(
+    message_id: str,
+    last_event_id: Optional[str] = Header(
+        None, description="Event id (response offset) of the last event received"
+    ),
+    flush_interval: int = Query(
+        SSE_FLUSH_INTERVAL, description="flush coalesced tokens at least every N ms", ge=0
+    ),
+    flush_bytes: int = Query(
+        SSE_FLUSH_BYTES, description="flush coalesced tokens once M bytes are buffered", ge=1
+    ),
+):
+    """
+    Reconnect to the stream of an in-progress or finished message, continuing after Last-Event-ID
+    """
+    try:
+        offset = max(int(last_event_id or 0), 0)
+    except ValueError:
+        offset = 0
+
+    live = stream_logs.get(message_id)
+    text = None
+    if live is None:
+        text = await aget_message_text(message_id)
+        if text is None:
+            return BaseResponse(code=404, msg=f"message {message_id} not found")
+
+    async def resume_iterator() -> AsyncIterable[str]:
+        if live is not None:
+            # attach to the running generation
+            token_iter = skip_chars(live.generation.aiter(), offset)
+        else:
+            token_iter = replay([text[offset:]] if text[offset:] else [])
+        writer = SSEWriter(flush_interval, flush_bytes, offset=offset)
+        chat_inflight_streams.inc()
+        try:
+            yield writer.meta(message_id=message_id, offset=offset, live=live is not None)
+            async for frame in writer.stream(token_iter):
+                yield frame
+            yield writer.done(message_id=message_id)
+        finally:
+            chat_inflight_streams.dec()
 
-    return StreamingResponse(chat_iterator(), media_type="text/event-stream")
+    return StreamingResponse(resume_iterator(), media_type="text/event-stream")
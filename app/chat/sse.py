@@ -0,0 +1,129 @@
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Optional
+
+from app.configs import SSE_FLUSH_INTERVAL, SSE_FLUSH_BYTES
+
+_END = object()
+
+
+def sse_event(data: Any, event: Optional[str] = None, id: Optional[str] = None) -> str:
+    """
+    Format one server-sent-event frame
+    """
+    frame = ""
+    if id is not None:
+        frame += f"id: {id}\n"
+    if event is not None:
+        frame += f"event: {event}\n"
+    frame += f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return frame
+
+
+class SSEWriter:
+    """
+    Write a token stream as server-sent-events.
+    Metadata is sent once in a `meta` event, tokens are coalesced into frames flushed
+    every `flush_interval` ms or `flush_bytes` bytes, and a final `done` event carries usage.
+    The first token is always flushed immediately to keep time-to-first-token low.
+    Each frame's event id is the character offset of the response after it,
+    so a client can resume with Last-Event-ID.
+    """
+
+    def __init__(
+        self,
+        flush_interval: int = SSE_FLUSH_INTERVAL,
+        flush_bytes: int = SSE_FLUSH_BYTES,
+        offset: int = 0,
+    ):
+        self.flush_interval = max(flush_interval, 0) / 1000
+        self.flush_bytes = max(flush_bytes, 1)
+        self.start_at = time.monotonic()
+        self.first_token_at = None
+        self.tokens = 0
+        self.chars = 0
+        self.frames = 0
+        self.offset = offset
+
+    def meta(self, **data: Any) -> str:
+        return sse_event(data, event="meta")
+
+    def done(self, **data: Any) -> str:
+        return sse_event({"usage": self.usage(), **data}, event="done")
+
+    def usage(self) -> Dict[str, Any]:
+        elapsed = time.monotonic() - self.start_at
+        ttft = self.first_token_at - self.start_at if self.first_token_at else None
+        return {
+            "completion_tokens": self.tokens,
+            "chars": self.chars,
+            "frames": self.frames,
+            "ttft": round(ttft, 4) if ttft is not None else None,
+            "elapsed": round(elapsed, 4),
+        }
+
+    def _frame(self, buffer: list) -> str:
+        text = "".join(buffer)
+        buffer.clear()
+        self.frames += 1
+        self.offset += len(text)
+        return sse_event({"text": text}, id=str(self.offset))
+
+    async def stream(self, tokens: AsyncIterable[str]) -> AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def pump():
+            try:
+                async for token in tokens:
+                    queue.put_nowait(token)
+            except Exception as e:
+                queue.put_nowait(e)
+            finally:
+                queue.put_nowait(_END)
+
+        task = asyncio.create_task(pump())
+        buffer = []
+        size = 0
+        deadline = None
+        try:
+            while True:
+                if buffer:
+                    try:
+                        item = await asyncio.wait_for(
+                            queue.get(), max(deadline - loop.time(), 0)
+                        )
+                    except asyncio.TimeoutError:
+                        yield self._frame(buffer)
+                        size = 0
+                        continue
+                else:
+                    item = await queue.get()
+
+                if item is _END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                if self.first_token_at is None:
+                    self.first_token_at = time.monotonic()
+                    self.tokens += 1
+                    self.chars += len(item)
+                    yield self._frame([item])
+                    continue
+
+                self.tokens += 1
+                self.chars += len(item)
+                if not buffer:
+                    deadline = loop.time() + self.flush_interval
+                buffer.append(item)
+                size += len(item.encode("utf-8"))
+                if size >= self.flush_bytes:
+                    yield self._frame(buffer)
+                    size = 0
+
+            if buffer:
+                yield self._frame(buffer)
+        finally:
+            task.cancel()
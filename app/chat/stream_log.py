@@ -0,0 +1,130 @@
+import asyncio
+import time
+from typing import AsyncIterable, AsyncIterator, Dict, Optional
+
+from app.cache import InflightGeneration
+from app.configs import logger, log_verbose, STREAM_LOG
+from app.db.repository.message_chunk_repository import aadd_message_chunk
+
+
+class MessageStreamLog:
+    """
+    Records the tokens of one message's generation into its chunk log.
+    Tokens are buffered in memory and checkpointed to the db every
+    `checkpoint_interval` seconds or `checkpoint_bytes` bytes, so partial
+    responses survive a dropped client connection. The last checkpoint is
+    retried `final_retries` times, `retry_delay` seconds apart (growing).
+    """
+
+    def __init__(
+        self,
+        message_id: str,
+        generation: InflightGeneration,
+        checkpoint_interval: float = 1.0,
+        checkpoint_bytes: int = 4096,
+        final_retries: int = 3,
+        retry_delay: float = 0.5,
+    ):
+        self.message_id = message_id
+        self.generation = generation
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_bytes = checkpoint_bytes
+        self.final_retries = final_retries
+        self.retry_delay = retry_delay
+        self.seq = 0
+        self.offset = 0
+        self._buffer = []
+        self._buffer_bytes = 0
+
+    async def checkpoint(self) -> bool:
+        """
+        write the buffered tokens as the next chunk. The buffer is only cleared once
+        the chunk is written, a failed write is retried with the next checkpoint so
+        the chunk log never has a gap. Return False if the write failed.
+        """
+        if not self._buffer:
+            return True
+        count = len(self._buffer)
+        text = "".join(self._buffer[:count])
+        try:
+            await aadd_message_chunk(self.message_id, self.seq, text)
+        except Exception as e:
+            msg = f"failed to checkpoint chunk log of message {self.message_id}: {e}"
+            logger.error(
+                f"{e.__class__.__name__}: {msg}",
+                exc_info=e if log_verbose else None,
+            )
+            return False
+        self.seq += 1
+        del self._buffer[:count]
+        self._buffer_bytes = sum(len(t.encode("utf-8")) for t in self._buffer)
+        return True
+
+    async def record(self) -> None:
+        last_checkpoint = time.monotonic()
+        async for token in self.generation.aiter(passive=True):
+            self._buffer.append(token)
+            self._buffer_bytes += len(token.encode("utf-8"))
+            self.offset += len(token)
+            now = time.monotonic()
+            if (
+                self._buffer_bytes >= self.checkpoint_bytes
+                or now - last_checkpoint >= self.checkpoint_interval
+            ):
+                last_checkpoint = now
+                await self.checkpoint()
+        for attempt in range(self.final_retries + 1):
+            if await self.checkpoint():
+                break
+            await asyncio.sleep(self.retry_delay * (attempt + 1))
+
+
+class StreamLogRegistry:
+    """
+    Live message stream logs by message_id
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        checkpoint_interval: float = 1.0,
+        checkpoint_bytes: int = 4096,
+    ):
+        self.enabled = enabled
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_bytes = checkpoint_bytes
+        self._logs: Dict[str, MessageStreamLog] = {}
+
+    def start(self, message_id: str, generation: InflightGeneration) -> None:
+        if not (self.enabled and message_id):
+            return
+        log = MessageStreamLog(
+            message_id,
+            generation,
+            checkpoint_interval=self.checkpoint_interval,
+            checkpoint_bytes=self.checkpoint_bytes,
+        )
+        self._logs[message_id] = log
+        task = asyncio.create_task(log.record())
+        # keep the live entry until the final checkpoint is written
+        task.add_done_callback(lambda _: self._logs.pop(message_id, None))
+
+    def get(self, message_id: str) -> Optional[MessageStreamLog]:
+        return self._logs.get(message_id)
+
+
+stream_logs = StreamLogRegistry(**STREAM_LOG)
+
+
+async def skip_chars(tokens: AsyncIterable[str], offset: int) -> AsyncIterator[str]:
+    """
+    drop the first `offset` characters of a token stream
+    """
+    async for token in tokens:
+        if offset >= len(token):
+            offset -= len(token)
+            continue
+        if offset:
+            token = token[offset:]
+            offset = 0
+        yield token
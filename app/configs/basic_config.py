@@ -26,6 +26,9 @@ ONLINE_LLM_MODEL = {
         "openai_proxy": "",
         "temperature": 0,
         "max_tokens": None,
+        "rpm": None,  # requests per minute budget, None means unlimited
+        "tpm": None,  # tokens per minute budget, None means unlimited
+        "context_length": 16385,  # tokens of prompt and completion together
     },
     # Azure API
     "azure-api": {
@@ -66,5 +69,201 @@ PROMPT_TEMPLATES = {
         "AI:",
         "py": "You are a smart code assistant, please write me simple py code. \n"
         "{{ input }}",
-    }
+    },
+    "summary": {
+        "default": "Progressively summarize the lines of conversation provided, "
+        "adding onto the previous summary and returning a new, concise summary.\n\n"
+        "Current summary:\n"
+        "{summary}\n\n"
+        "New lines of conversation:\n"
+        "{new_lines}\n\n"
+        "New summary:",
+    },
+}
+
+# Exact-match response cache for deterministic (temperature 0) /chat calls
+RESPONSE_CACHE = {
+    "enabled": False,
+    "max_entries": 1024,
+    "max_bytes": 64 * 1024 * 1024,  # bytes
+    "ttl": 3600,  # seconds
+}
+
+# Near-duplicate answer cache for deterministic /chat calls without history: the query is
+# embedded (EMBEDDING) and a prior answer of the same model, prompt template and max_tokens
+# is returned when their cosine similarity reaches the template's threshold. Needs a
+# semantic EMBEDDING model, it stays disabled with the "hashing" embedder
+SEMANTIC_CACHE = {
+    "enabled": False,
+    "threshold": 0.9,
+    "thresholds": {},  # prompt_name -> threshold
+    "ttl": 24 * 3600,  # seconds
+    "max_entries": 10000,
+    "review_size": 1000,  # recent hits kept for review
+}
+
+# Coalesce concurrent identical /chat requests onto one upstream generation
+SINGLE_FLIGHT = {
+    "enabled": False,
+}
+
+# Server-sent-events token coalescing defaults, can be overridden per /chat request
+SSE_FLUSH_INTERVAL = 50  # ms
+SSE_FLUSH_BYTES = 1024  # bytes
+
+# Shared upstream HTTP connection pool, one per model config
+UPSTREAM_POOL = {
+    "pool_size": 100,
+    "timeout": 120.0,  # seconds, default upstream timeout when a request sets no deadline
+    "connect_timeout": 5.0,  # seconds
+    "keepalive_expiry": 60,  # seconds
+    "warmup_connections": 2,  # keep-alive connections opened at startup
+}
+
+# Per-message chunk log of streamed responses, lets clients resume by Last-Event-ID
+STREAM_LOG = {
+    "enabled": False,
+    "checkpoint_interval": 1.0,  # seconds
+    "checkpoint_bytes": 4096,  # bytes
+}
+
+# Seconds a generation keeps running after its last client disconnected, so it can be resumed
+DISCONNECT_GRACE_PERIOD = 0.0
+
+# Admission control and weighted fair queuing in front of upstream generations
+SCHEDULER = {
+    "enabled": False,
+    "max_concurrency": {"default": 16},  # concurrent generations per model_name
+    "max_queue": 256,  # queued requests per model_name before answering 503
+    "max_queue_per_flow": 32,  # queued requests per api key / conversation before 429
+    "lanes": {"interactive": 4, "batch": 1},  # lane weights
+    "flow_weights": {},  # "key:<api key>" -> weight, default 1
+    "retry_after": 1,  # seconds
+}
+
+# Requests/tokens per minute budgets. Model budgets are the "rpm"/"tpm" of its ONLINE_LLM_MODEL entry
+RATE_LIMIT = {
+    "enabled": False,
+    "models": {},  # model name -> {"rpm": .., "tpm": ..}, default: the sum over its backends
+    "keys": {},  # "key:<api key>" -> {"rpm": 60, "tpm": 40000}, shown as a digest of the key
+    "default_key_limits": {},  # budgets of any other client, empty means unlimited
+    "default_max_tokens": 512,  # output tokens reserved when a request sets no max_tokens
+    "shared_db": None,  # sqlite file to share budgets between worker processes
+    "bucket_idle_ttl": 300,  # seconds before an unused, refilled in-process bucket is dropped
+}
+
+# Routing of a model name to the ONLINE_LLM_MODEL entries (backends) serving it
+MODEL_ROUTER = {
+    # model name -> ONLINE_LLM_MODEL keys, e.g. {"gpt-3.5-turbo": ["openai-api", "openai-api-2"]}.
+    # Models not listed are served by the entries whose "model_name" matches
+    "routes": {},
+    "ewma_alpha": 0.3,
+    "error_penalty": 4.0,  # how much the error rate weighs against latency
+    "failure_threshold": 3,  # consecutive failures that eject a backend
+    "cooldown": 30,  # seconds before an ejected backend is probed again
+    "max_attempts": 2,  # backends tried per request (failover and hedging)
+    "hedge": False,  # race a second backend when the first token is late
+    "hedge_percentile": 95,  # of the backend's time to first token
+    "hedge_min_delay": 0.5,  # seconds
+}
+
+# /chat/batch
+BATCH_CHAT = {
+    "parallelism": 8,  # default number of items run at the same time
+    "max_parallelism": 64,
+    "max_items": 10000,  # items read from one batch, 0 means unlimited
+}
+
+# Opt-in capture of incoming requests for local replay (python -m benchmarks.replay)
+TRAFFIC_CAPTURE = {
+    "enabled": False,
+    "path": "logs/capture.jsonl",  # rotated to capture.jsonl.1, .2, ...
+    "paths": ["/chat"],
+    "sample_rate": 1.0,
+    "max_bytes": 64 * 1024 * 1024,
+    "backup_count": 5,
+    "queue_size": 10000,  # records waiting to be written, more are dropped
+    "redact_fields": [],  # body fields replaced by "[REDACTED]", e.g. ["query", "history"]
+    "redact_headers": ["authorization", "x-api-key", "cookie"],
+    "headers": ["user-agent", "x-request-timeout"],  # other headers kept as is
+}
+
+# Per-request span tracing, tail sampled: slow and failed requests are kept, plus a random sample
+TRACING = {
+    "enabled": False,
+    "paths": ["/chat", "/chat/batch"],
+    "slow_threshold": 2.0,  # seconds, slower requests are always kept
+    "sample_rate": 0.01,  # share of the other requests kept
+    "max_traces": 1000,  # ring buffer of kept traces
+    "max_spans": 512,  # per trace, more are dropped
+    "otlp_path": None,  # e.g. "logs/traces.otlp.jsonl", kept traces as OTLP/JSON lines
+}
+
+# On-demand profiling endpoints under /debug/profile, off unless enabled
+PROFILING = {
+    "enabled": False,
+    "admin_token": "",  # when set, required in the X-Admin-Token header
+    "max_duration": 60,  # seconds, cpu profiles and memory sessions are cut there
+    "interval": 0.01,  # seconds between cpu samples
+    "tracemalloc_frames": 1,  # frames kept per allocation, more costs more memory
+    "request_header": "x-debug-profile",  # a /chat request carrying it is cpu profiled
+    "max_results": 20,  # finished profiles kept for download
+}
+
+# Watchdog thread measuring event loop lag and reporting what blocked it
+LOOP_WATCHDOG = {
+    "enabled": False,
+    "interval": 0.05,  # seconds between probes
+    "threshold": 0.1,  # seconds, a longer lag is a stall and its stack is captured
+    "max_blockers": 100,  # distinct call sites kept
+}
+
+# tiktoken encoding of the token counts stored per message. Without it (e.g. offline,
+# encodings are downloaded on first use) counts fall back to ~4 characters per token
+TOKEN_ENCODING = "cl100k_base"
+
+# Fits history to each model's context window ("context_length" of its ONLINE_LLM_MODEL entry)
+CONTEXT_BUDGET = {
+    "enabled": False,
+    "default_context_length": 4096,  # models without a context_length
+    "default_output_tokens": 512,  # reserved for the answer when a request sets no max_tokens
+    "min_output_tokens": 16,  # a prompt leaving less room than this is rejected
+    "safety_margin": 64,  # tokens left free for the chat message framing
+    "cache_size": 100000,  # memoized token counts, by content hash
+}
+
+# In-process LRU of recent conversation history windows, in front of the message table.
+# Every write bumps a per-conversation version in the db, a window is only served while
+# its version is current, so several workers can run with it.
+HISTORY_CACHE = {
+    "enabled": False,
+    "max_bytes": 32 * 1024 * 1024,  # bytes
+    "window": 50,  # messages loaded and kept per conversation
+}
+
+# Rolling summary memory (/chat memory_type "summary"): a stored summary of the older turns
+# plus a verbatim tail, the tail is folded into the summary in the background once it grows
+SUMMARY_MEMORY = {
+    "message_limit": 20,  # newest messages loaded for the tail
+    "tail_token_threshold": 1000,  # tail tokens that start a background summary
+    "keep_turns": 2,  # newest turns never folded into the summary
+    "summary_max_tokens": 256,
+    "summary_model": None,  # model_name of the summarizer, default the model of the chat
+}
+
+# Text embedder of the retrieval memory: "hashing" (offline feature hashing of words and
+# word pairs, no model needed) or "package.module:Class" of an app.memory.embeddings.Embedder
+EMBEDDING = {
+    "embedder": "hashing",
+    "dim": 128,  # searches read the whole index, 10k turns x 128 floats are 5 MB
+}
+
+# Retrieval memory (/chat memory_type "retrieval"): the past turns most similar to the query,
+# searched in a per-conversation vector index, plus the last few turns verbatim
+RETRIEVAL_MEMORY = {
+    "top_k": 4,
+    "recent_turns": 2,
+    "min_score": 0.1,  # cosine similarity below which a turn is not retrieved
+    "max_turns": 10000,  # newest turns indexed per conversation
+    "max_bytes": 256 * 1024 * 1024,  # bytes, all loaded indexes (vectors and texts)
 }
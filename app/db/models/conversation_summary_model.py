@@ -0,0 +1,20 @@
+from sqlalchemy import Column, Integer, String, Text, DateTime, func
+
+from ..base import Base
+
+
+class ConversationSummaryModel(Base):
+    """
+    Running summary of the older messages of a conversation
+    """
+
+    __tablename__ = "conversation_summary"
+    conversation_id = Column(String(32), primary_key=True, comment="Conversation ID")
+    summary = Column(Text, default="", comment="Summary")
+    summary_tokens = Column(Integer, default=0, comment="Summary token count")
+    covered_message_id = Column(String(32), comment="Newest message folded into the summary")
+    covered_messages = Column(Integer, default=0, comment="Number of messages folded into the summary")
+    update_time = Column(DateTime, default=func.now(), onupdate=func.now(), comment="Update Time")
+
+    def __repr__(self):
+        return f"<conversation_summary(conversation_id='{self.conversation_id}', covered_message_id='{self.covered_message_id}', covered_messages='{self.covered_messages}', summary='{self.summary}')>"
@@ -0,0 +1,16 @@
+from sqlalchemy import Column, Integer, String
+
+from ..base import Base
+
+
+class ConversationVersionModel(Base):
+    """
+    Bumped by every message write of a conversation, validates cached history across workers
+    """
+
+    __tablename__ = "conversation_version"
+    conversation_id = Column(String(32), primary_key=True, comment="Conversation ID")
+    version = Column(Integer, default=0, comment="Number of committed message writes")
+
+    def __repr__(self):
+        return f"<conversation_version(conversation_id='{self.conversation_id}', version='{self.version}')>"
@@ -0,0 +1,19 @@
+from sqlalchemy import Column, Integer, String, Text, DateTime, func
+
+from ..base import Base
+
+
+class MessageChunkModel(Base):
+    """
+    Streamed response chunks of a message, in order
+    """
+
+    __tablename__ = "message_chunk"
+    id = Column(Integer, primary_key=True, autoincrement=True, comment="ID")
+    message_id = Column(String(32), index=True, comment="Message ID")
+    seq = Column(Integer, comment="Chunk sequence number")
+    text = Column(Text, comment="Chunk text")
+    create_time = Column(DateTime, default=func.now(), comment="Creation Time")
+
+    def __repr__(self):
+        return f"<message_chunk(id='{self.id}', message_id='{self.message_id}', seq='{self.seq}', text='{self.text}', create_time='{self.create_time}')>"
@@ -16,6 +16,8 @@ class MessageModel(Base):
     chat_type = Column(String(50), comment="Chat Type")
     query = Column(String(4096), comment="Query")
     response = Column(String(4096), comment="Response")
+    query_tokens = Column(Integer, default=None, comment="Query token count")
+    response_tokens = Column(Integer, default=None, comment="Response token count")
     meta_data = Column(JSON, default={})
     feedback_score = Column(Integer, default=-1, comment="Feedback score")
     feedback_reason = Column(String(255), default="", comment="Feedback Reason")
@@ -0,0 +1,67 @@
+from typing import Dict, Optional
+
+from sqlalchemy.exc import IntegrityError
+
+from ..session import with_session, run_in_db
+from ..models.conversation_summary_model import ConversationSummaryModel
+
+
+@with_session
+def get_summary(session, conversation_id: str) -> Optional[Dict]:
+    m = session.query(ConversationSummaryModel).filter_by(conversation_id=conversation_id).first()
+    if m is None:
+        return None
+    return {
+        "summary": m.summary,
+        "summary_tokens": m.summary_tokens,
+        "covered_message_id": m.covered_message_id,
+        "covered_messages": m.covered_messages,
+    }
+
+
+@with_session
+def save_summary(
+    session,
+    conversation_id: str,
+    summary: str,
+    summary_tokens: int,
+    covered_message_id: str,
+    covered_messages: int,
+    expected_message_id: Optional[str],
+) -> bool:
+    """
+    store a new summary unless another writer replaced the one it was built from
+    (`expected_message_id`, None for the first summary). Return whether it was stored.
+    """
+    values = {
+        "summary": summary,
+        "summary_tokens": summary_tokens,
+        "covered_message_id": covered_message_id,
+        "covered_messages": covered_messages,
+    }
+    if expected_message_id is None:
+        if session.query(ConversationSummaryModel).filter_by(conversation_id=conversation_id).first():
+            return False
+        session.add(ConversationSummaryModel(conversation_id=conversation_id, **values))
+        try:
+            session.commit()
+        except IntegrityError:
+            # inserted by another worker meanwhile
+            session.rollback()
+            return False
+        return True
+    updated = (
+        session.query(ConversationSummaryModel)
+        .filter_by(conversation_id=conversation_id, covered_message_id=expected_message_id)
+        .update(values, synchronize_session=False)
+    )
+    session.commit()
+    return bool(updated)
+
+
+async def aget_summary(conversation_id: str) -> Optional[Dict]:
+    return await run_in_db(get_summary, conversation_id=conversation_id)
+
+
+async def asave_summary(**kwargs) -> bool:
+    return await run_in_db(save_summary, **kwargs)
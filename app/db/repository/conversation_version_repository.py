@@ -0,0 +1,35 @@
+from ..session import with_session
+from ..models.conversation_version_model import ConversationVersionModel
+
+
+def bump_conversation_version(session, conversation_id: str) -> int:
+    """
+    count a write of the conversation in the session's transaction, return the new version
+    """
+    updated = (
+        session.query(ConversationVersionModel)
+        .filter_by(conversation_id=conversation_id)
+        .update(
+            {ConversationVersionModel.version: ConversationVersionModel.version + 1},
+            synchronize_session=False,
+        )
+    )
+    if not updated:
+        session.add(ConversationVersionModel(conversation_id=conversation_id, version=1))
+        session.flush()
+        return 1
+    return (
+        session.query(ConversationVersionModel.version)
+        .filter_by(conversation_id=conversation_id)
+        .scalar()
+    )
+
+
+@with_session
+def get_conversation_version(session, conversation_id: str) -> int:
+    version = (
+        session.query(ConversationVersionModel.version)
+        .filter_by(conversation_id=conversation_id)
+        .scalar()
+    )
+    return version or 0
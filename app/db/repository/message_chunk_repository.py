@@ -0,0 +1,42 @@
+from typing import List, Optional
+
+from ..session import with_session, run_in_db
+from ..models.message_model import MessageModel
+from ..models.message_chunk_model import MessageChunkModel
+
+
+@with_session
+def add_message_chunk(session, message_id: str, seq: int, text: str):
+    """
+    append one checkpointed chunk to the message's chunk log
+    """
+    session.add(MessageChunkModel(message_id=message_id, seq=seq, text=text))
+    session.commit()
+
+
+@with_session
+def get_message_text(session, message_id: str) -> Optional[str]:
+    """
+    full response text of a message: its chunk log if there is one, else the response column.
+    Return None if the message does not exist.
+    """
+    chunks = (
+        session.query(MessageChunkModel.text)
+        .filter_by(message_id=message_id)
+        .order_by(MessageChunkModel.seq)
+        .all()
+    )
+    if chunks:
+        return "".join(c.text for c in chunks)
+    m = session.query(MessageModel).filter_by(id=message_id).first()
+    if m is not None:
+        return m.response or ""
+    return None
+
+
+async def aadd_message_chunk(message_id: str, seq: int, text: str):
+    return await run_in_db(add_message_chunk, message_id=message_id, seq=seq, text=text)
+
+
+async def aget_message_text(message_id: str) -> Optional[str]:
+    return await run_in_db(get_message_text, message_id=message_id)
@@ -1,7 +1,15 @@
-from ..session import with_session
+from ..session import with_session, run_in_db
 from typing import Dict, List
+from sqlalchemy import or_
 import uuid
 from ..models.message_model import MessageModel
+from .message_write_queue import message_write_queue
+from .conversation_version_repository import bump_conversation_version, get_conversation_version
+from ...cache.history_cache import history_cache
+from ...memory.retrieval_index import conversation_indexes
+from ...metrics import chat_stage_seconds
+from ...tracing import tracer
+from ...memory.token_counter import count_tokens
 
 
 @with_session
@@ -22,18 +30,28 @@ def add_message_to_db(
         message_id = uuid.uuid4().hex
     if not conversation_id:
         conversation_id = uuid.uuid4().hex
-    m = MessageModel(
-        id=message_id,
-        chat_type=chat_type,
-        conversation_id=conversation_id,
-        query=query,
-        response=response,
-        meta_data=meta_data,
-    )
-    session.add(m)
-    session.commit()
+    with chat_stage_seconds.labels("db_insert").time():
+        m = MessageModel(
+            id=message_id,
+            chat_type=chat_type,
+            conversation_id=conversation_id,
+            query=query,
+            response=response,
+            query_tokens=count_tokens(query),
+            response_tokens=count_tokens(response),
+            meta_data=meta_data,
+        )
+        session.add(m)
+        version = None
+        if history_cache.enabled:
+            version = bump_conversation_version(session, conversation_id)
+            row = _history_row(m)
+        session.commit()
+    if version is not None:
+        history_cache.add(conversation_id, row)
+        history_cache.advance(conversation_id, version, [message_id])
 
-    return m.id
+    return message_id
 
 
 @with_session
@@ -58,14 +76,36 @@ def feedback_message_to_db(session, message_id, feedback_score, feedback_reason)
     return m.id
 
 
+def _history_row(m: MessageModel) -> Dict:
+    return {
+        "id": m.id,
+        "query": m.query,
+        "response": m.response,
+        # rows written before token counts were stored (see app.jobs.backfill_token_counts)
+        "query_tokens": m.query_tokens if m.query_tokens is not None else count_tokens(m.query),
+        "response_tokens": m.response_tokens if m.response_tokens is not None else count_tokens(m.response),
+    }
+
+
 @with_session
-def filter_message(session, conversation_id: str, limit: int = 10):
+def filter_message(
+    session,
+    conversation_id: str,
+    limit: int = 10,
+    include_ids: List[str] = (),
+    include_unanswered: bool = False,
+):
+    # 用户最新的query 也会插入到db，忽略这个message record
+    # unless its response is known to be pending in include_ids
+    # (the history cache keeps them, their response is written through later)
+    query = session.query(MessageModel).filter_by(conversation_id=conversation_id)
+    if not include_unanswered:
+        condition = MessageModel.response != ""
+        if include_ids:
+            condition = or_(condition, MessageModel.id.in_(include_ids))
+        query = query.filter(condition)
     messages = (
-        session.query(MessageModel)
-        .filter_by(conversation_id=conversation_id)
-        .
-        # 用户最新的query 也会插入到db，忽略这个message record
-        filter(MessageModel.response != "")
+        query
         .
         # 返回最近的limit 条记录
         order_by(MessageModel.create_time.desc())
@@ -73,10 +113,24 @@ def filter_message(session, conversation_id: str, limit: int = 10):
         .all()
     )
     # 直接返回 List[MessageModel] 报错
-    data = []
-    for m in messages:
-        data.append({"query": m.query, "response": m.response})
-    return data
+    return [_history_row(m) for m in messages]
+
+
+@with_session
+def filter_message_since(session, conversation_id: str, offset: int, limit: int):
+    """
+    answered messages of a conversation oldest first, past the first `offset`
+    """
+    messages = (
+        session.query(MessageModel)
+        .filter_by(conversation_id=conversation_id)
+        .filter(MessageModel.response != "")
+        .order_by(MessageModel.create_time.asc())
+        .offset(offset)
+        .limit(limit)
+        .all()
+    )
+    return [_history_row(m) for m in messages]
 
 
 @with_session
@@ -84,12 +138,139 @@ def update_message(session, message_id, response: str = None, metadata: Dict = N
     """
     更新已有的聊天记录
     """
-    m = get_message_by_id(message_id)
-    if m is not None:
-        if response is not None:
-            m.response = response
-        if isinstance(metadata, dict):
-            m.meta_data = metadata
-        session.add(m)
-        session.commit()
-        return m.id
+    with chat_stage_seconds.labels("db_update").time():
+        m = session.query(MessageModel).filter_by(id=message_id).first()
+        if m is not None:
+            if response is not None:
+                m.response = response
+                m.response_tokens = count_tokens(response)
+            if isinstance(metadata, dict):
+                m.meta_data = metadata
+            session.add(m)
+            version = None
+            conversation_id = m.conversation_id
+            row = _history_row(m)
+            if history_cache.enabled and response is not None:
+                version = bump_conversation_version(session, conversation_id)
+            session.commit()
+            if version is not None:
+                history_cache.set_response(message_id, response, row["response_tokens"])
+                history_cache.advance(conversation_id, version, [message_id])
+            if response is not None:
+                conversation_indexes.on_write(conversation_id, row)
+            return message_id
+
+
+@tracer.traced("db.add_message")
+async def aadd_message_to_db(
+    conversation_id: str,
+    chat_type,
+    query,
+    response="",
+    message_id=None,
+    meta_data: dict = {},
+):
+    """
+    async version of add_message_to_db, runs in the db thread pool
+    or goes through the write-behind queue when it is active
+    """
+    if message_write_queue.active:
+        if history_cache.enabled and conversation_id:
+            # advanced once the write is committed
+            message_id = message_id or uuid.uuid4().hex
+            history_cache.add(
+                conversation_id,
+                {"id": message_id, "query": query, "response": response,
+                 "query_tokens": None, "response_tokens": None},
+            )
+        return message_write_queue.add_message(
+            conversation_id=conversation_id,
+            chat_type=chat_type,
+            query=query,
+            response=response,
+            message_id=message_id,
+            meta_data=meta_data,
+        )
+    return await run_in_db(
+        add_message_to_db,
+        conversation_id=conversation_id,
+        chat_type=chat_type,
+        query=query,
+        response=response,
+        message_id=message_id,
+        meta_data=meta_data,
+    )
+
+
+@tracer.traced("db.filter_message")
+async def afilter_message(conversation_id: str, limit: int = 10):
+    """
+    async version of filter_message, served from the history cache when it is enabled,
+    otherwise run in the db thread pool.
+    """
+    if not history_cache.enabled:
+        return await _afilter_message(conversation_id, limit)
+    version = await run_in_db(get_conversation_version, conversation_id)
+    messages = history_cache.get(conversation_id, limit, version)
+    if messages is None:
+        window = max(limit, history_cache.window)
+        rows = await _afilter_message(conversation_id, window, include_unanswered=True)
+        history_cache.put(conversation_id, rows, window, version)
+        messages = [m for m in rows if m["response"] != ""][:limit]
+    return messages
+
+
+async def _afilter_message(conversation_id: str, limit: int, include_unanswered: bool = False):
+    """
+    Turns still waiting in the write-behind queue are merged in, newest first.
+    """
+    if not (message_write_queue.active or message_write_queue.is_pending()):
+        return await run_in_db(
+            filter_message,
+            conversation_id=conversation_id,
+            limit=limit,
+            include_unanswered=include_unanswered,
+        )
+    # snapshot before reading, a row committed during the read is then still seen once
+    inserts = message_write_queue.pending_inserts(conversation_id)
+    responses = message_write_queue.pending_responses()
+    data = await run_in_db(
+        filter_message,
+        conversation_id=conversation_id,
+        limit=limit + len(inserts),
+        include_ids=list(responses),
+        include_unanswered=include_unanswered,
+    )
+    insert_ids = {m["id"] for m in inserts}
+    merged = list(reversed(inserts)) + [m for m in data if m["id"] not in insert_ids]
+    merged = [
+        dict(m, response=responses[m["id"]], response_tokens=None) if m["id"] in responses else m
+        for m in merged
+    ]
+    if include_unanswered:
+        return merged[:limit]
+    return [m for m in merged if m["response"] != ""][:limit]
+
+
+async def afilter_message_since(conversation_id: str, offset: int, limit: int):
+    return await run_in_db(
+        filter_message_since, conversation_id=conversation_id, offset=offset, limit=limit
+    )
+
+
+@tracer.traced("db.update_message")
+async def aupdate_message(message_id, response: str = None, metadata: Dict = None):
+    """
+    async version of update_message, runs in the db thread pool
+    or goes through the write-behind queue when it is active or the row is still queued
+    """
+    if message_write_queue.active or message_write_queue.is_pending(message_id):
+        if history_cache.enabled and response is not None:
+            # advanced once the write is committed
+            history_cache.set_response(message_id, response)
+        return message_write_queue.update_message(
+            message_id, response=response, metadata=metadata
+        )
+    return await run_in_db(
+        update_message, message_id=message_id, response=response, metadata=metadata
+    )
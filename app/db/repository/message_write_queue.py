@@ -0,0 +1,366 @@
+import asyncio
+import time
+import uuid
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from ..models.message_model import MessageModel
+from ..session import with_session, run_in_db
+from .conversation_version_repository import bump_conversation_version
+from ...cache.history_cache import history_cache
+from ...memory.retrieval_index import conversation_indexes
+from ...configs import logger, log_verbose, WRITE_BEHIND
+from ...memory.token_counter import count_tokens
+
+
+# writes of a context (e.g. a batch request) forced through the queue
+_write_behind: ContextVar[bool] = ContextVar("message_write_behind", default=False)
+
+
+@with_session
+def _write_batch(
+    session, inserts: List[Dict], updates: List[Dict], conversation_ids: Dict[str, str] = {}
+) -> Dict[str, Tuple[int, List[str]]]:
+    """
+    write one batch of message inserts and updates in a single transaction.
+    With the history cache, the new version and written message ids of each conversation
+    are returned, `conversation_ids` are those of the updated rows if known.
+    """
+    # token counts are computed here, in the db thread
+    for values in inserts:
+        values["query_tokens"] = count_tokens(values.get("query"))
+        values["response_tokens"] = count_tokens(values.get("response"))
+    for values in updates:
+        if "response" in values:
+            values["response_tokens"] = count_tokens(values["response"])
+    if inserts:
+        session.bulk_insert_mappings(MessageModel, inserts)
+    if updates:
+        session.bulk_update_mappings(MessageModel, updates)
+
+    if not conversation_indexes.empty:
+        _index_turns(session, inserts, updates)
+
+    written: Dict[str, List[str]] = {}
+    if history_cache.enabled:
+        for values in inserts:
+            written.setdefault(values["conversation_id"], []).append(values["id"])
+        unknown = [v["id"] for v in updates if not conversation_ids.get(v["id"])]
+        if unknown:
+            rows = session.query(MessageModel.id, MessageModel.conversation_id).filter(
+                MessageModel.id.in_(unknown)
+            )
+            conversation_ids = dict(conversation_ids, **{id: cid for id, cid in rows})
+        for values in updates:
+            conversation_id = conversation_ids.get(values["id"])
+            if conversation_id:
+                written.setdefault(conversation_id, []).append(values["id"])
+    return {
+        conversation_id: (bump_conversation_version(session, conversation_id), message_ids)
+        for conversation_id, message_ids in written.items()
+    }
+
+
+def _write_rows(
+    inserts: List[Dict], updates: List[Dict], conversation_ids: Dict[str, str] = {}
+) -> Tuple[List[Dict[str, Tuple[int, List[str]]]], Dict[str, Exception]]:
+    """
+    write rows one transaction each, so one bad row does not fail the others.
+    Return the result of every committed write in order, and the error of every failed row.
+    """
+    written, failed = [], {}
+    for batch in [([values], []) for values in inserts] + [([], [values]) for values in updates]:
+        try:
+            written.append(_write_batch(*batch, conversation_ids))
+        except Exception as e:
+            failed[(batch[0] or batch[1])[0]["id"]] = e
+    return written, failed
+
+
+def _index_turns(session, inserts: List[Dict], updates: List[Dict]) -> None:
+    """
+    add the written responses to the loaded retrieval indexes
+    """
+    turns = [(v["conversation_id"], v) for v in inserts if v.get("response")]
+    responses = {v["id"]: v for v in updates if v.get("response")}
+    if responses:
+        rows = session.query(MessageModel.id, MessageModel.conversation_id, MessageModel.query).filter(
+            MessageModel.id.in_(list(responses))
+        )
+        turns += [(cid, dict(responses[id], query=query)) for id, cid, query in rows]
+    for conversation_id, values in turns:
+        conversation_indexes.on_write(
+            conversation_id,
+            {key: values.get(key) for key in ("id", "query", "response", "query_tokens", "response_tokens")},
+        )
+
+
+class MessageWriteQueue:
+    """
+    Write-behind queue for message rows.
+    Inserts and response updates are buffered and written in bulk transactions,
+    flushed once `batch_size` rows are pending or every `flush_interval` seconds.
+    Pending rows stay visible through `pending()` until their write is committed.
+    When a batch fails its rows are written one by one, a row that still fails is
+    retried after `retry_backoff` seconds (doubled every attempt) and dropped into
+    `dead_letters` after `max_attempts` writes.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        batch_size: int = 64,
+        flush_interval: float = 0.2,
+        max_attempts: int = 5,
+        retry_backoff: float = 1.0,
+        dead_letter_size: int = 1000,
+    ):
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.dead_letters: Deque[Dict[str, Any]] = deque(maxlen=dead_letter_size)
+        # message_id -> row, including rows being flushed right now
+        self._rows: Dict[str, Dict[str, Any]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.flush_errors = 0
+        self.rows_failed = 0
+        self.rows_dropped = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self._total_flush_latency = 0.0
+
+    @property
+    def active(self) -> bool:
+        """
+        whether the writes of the current context go through the queue
+        """
+        return self.enabled or _write_behind.get()
+
+    def enable_for_context(self) -> None:
+        """
+        route the writes of the current task, and of the tasks it starts, through the queue
+        """
+        _write_behind.set(True)
+
+    def is_pending(self, message_id: Optional[str] = None) -> bool:
+        """
+        whether the row, or any row if no id is given, is not committed yet
+        """
+        return message_id in self._rows if message_id else bool(self._rows)
+
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._run())
+
+    def _dirty(self) -> List[Dict[str, Any]]:
+        return [r for r in self._rows.values() if r["_dirty"]]
+
+    def _due(self, now: float) -> List[Dict[str, Any]]:
+        return [r for r in self._rows.values() if r["_dirty"] and r.get("_retry_at", 0.0) <= now]
+
+    def _notify(self) -> None:
+        self._ensure_started()
+        if len(self._dirty()) >= self.batch_size:
+            self._wakeup.set()
+
+    def add_message(
+        self,
+        conversation_id: str,
+        chat_type,
+        query,
+        response="",
+        message_id=None,
+        meta_data: dict = {},
+    ) -> str:
+        if not message_id:
+            message_id = uuid.uuid4().hex
+        if not conversation_id:
+            conversation_id = uuid.uuid4().hex
+        self._rows[message_id] = {
+            "id": message_id,
+            "conversation_id": conversation_id,
+            "chat_type": chat_type,
+            "query": query,
+            "response": response,
+            "meta_data": meta_data,
+            "_inserted": False,
+            "_dirty": True,
+            "_version": 0,
+        }
+        self._notify()
+        return message_id
+
+    def update_message(
+        self, message_id, response: str = None, metadata: Dict = None
+    ) -> str:
+        row = self._rows.get(message_id)
+        if row is None:
+            # the row is already in the db, only the changed columns are written
+            row = {
+                "id": message_id,
+                "conversation_id": None,
+                "_inserted": True,
+                "_version": 0,
+            }
+            self._rows[message_id] = row
+        if response is not None:
+            row["response"] = response
+        if isinstance(metadata, dict):
+            row["meta_data"] = metadata
+        row["_dirty"] = True
+        row["_version"] += 1
+        self._notify()
+        return message_id
+
+    def pending_inserts(self, conversation_id: str) -> List[Dict[str, Any]]:
+        """
+        rows of the conversation whose insert may not be committed yet, oldest first
+        """
+        return [
+            # token counts are only computed once written
+            {"id": r["id"], "query": r["query"], "response": r["response"],
+             "query_tokens": None, "response_tokens": None}
+            for r in self._rows.values()
+            if not r["_inserted"] and r["conversation_id"] == conversation_id
+        ]
+
+    def pending_responses(self) -> Dict[str, str]:
+        """
+        responses that may not be committed yet, by message id
+        """
+        return {r["id"]: r["response"] for r in self._rows.values() if "response" in r}
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self, force: bool = False) -> None:
+        """
+        write the dirty rows, those waiting to be retried too if `force`
+        """
+        if self._flush_lock is None:
+            return
+        async with self._flush_lock:
+            batch = [(r, r["_version"]) for r in (self._dirty() if force else self._due(time.monotonic()))]
+            if not batch:
+                return
+            inserts, updates, conversation_ids = [], [], {}
+            for row, _ in batch:
+                values = {k: v for k, v in row.items() if not k.startswith("_")}
+                if row["_inserted"]:
+                    conversation_ids[row["id"]] = values.pop("conversation_id")
+                    updates.append(values)
+                else:
+                    inserts.append(values)
+
+            start = time.perf_counter()
+            failed: Dict[str, Exception] = {}
+            try:
+                written = [await run_in_db(_write_batch, inserts, updates, conversation_ids)]
+            except Exception as e:
+                self.flush_errors += 1
+                msg = f"failed to flush {len(batch)} message rows: {e}"
+                logger.error(
+                    f"{e.__class__.__name__}: {msg}",
+                    exc_info=e if log_verbose else None,
+                )
+                if len(batch) == 1:
+                    written, failed = [], {batch[0][0]["id"]: e}
+                else:
+                    # find the rows that fail on their own
+                    written, failed = await run_in_db(_write_rows, inserts, updates, conversation_ids)
+            latency = time.perf_counter() - start
+            self.flushes += 1
+            self.rows_flushed += len(batch) - len(failed)
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            self._total_flush_latency += latency
+            for versions in written:
+                for conversation_id, (version, message_ids) in versions.items():
+                    history_cache.advance(conversation_id, version, message_ids)
+
+            for row, version in batch:
+                error = failed.get(row["id"])
+                if error is not None:
+                    self._failed(row, error)
+                    continue
+                row["_inserted"] = True
+                row.pop("_attempts", None)
+                row.pop("_retry_at", None)
+                if row["_version"] == version:
+                    # not changed while flushing, the db is up to date
+                    row["_dirty"] = False
+                    self._rows.pop(row["id"], None)
+
+    def _failed(self, row: Dict[str, Any], error: Exception) -> None:
+        """
+        schedule the retry of a row that failed on its own, or drop it
+        """
+        self.rows_failed += 1
+        row["_attempts"] = row.get("_attempts", 0) + 1
+        if row["_attempts"] < self.max_attempts:
+            row["_retry_at"] = time.monotonic() + self.retry_backoff * 2 ** (row["_attempts"] - 1)
+            return
+        self._rows.pop(row["id"], None)
+        self.rows_dropped += 1
+        self.dead_letters.append(
+            dict(
+                {k: v for k, v in row.items() if not k.startswith("_")},
+                error=f"{error.__class__.__name__}: {error}",
+                time=time.time(),
+            )
+        )
+        if row.get("conversation_id"):
+            # the history cache may hold the row that was never written
+            history_cache.invalidate(row["conversation_id"])
+        msg = f"dropped message row {row['id']} after {row['_attempts']} failed writes: {error}"
+        logger.error(f"{error.__class__.__name__}: {msg}")
+
+    async def close(self) -> None:
+        """
+        stop the background flusher and write everything that is still pending
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # every failed row is tried again until it is written or dead-lettered
+        while self._dirty() and self._flush_lock is not None:
+            await self.flush(force=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "queue_depth": len(self._dirty()),
+            "pending_rows": len(self._rows),
+            "flushes": self.flushes,
+            "rows_flushed": self.rows_flushed,
+            "flush_errors": self.flush_errors,
+            "rows_failed": self.rows_failed,
+            "rows_dropped": self.rows_dropped,
+            "last_flush_latency": round(self.last_flush_latency, 6),
+            "max_flush_latency": round(self.max_flush_latency, 6),
+            "avg_flush_latency": round(self._total_flush_latency / self.flushes, 6)
+            if self.flushes
+            else 0.0,
+        }
+
+
+message_write_queue = MessageWriteQueue(**WRITE_BEHIND)
@@ -1,12 +1,22 @@
-from functools import wraps
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
 from contextlib import contextmanager
 from .base import SessionLocal
+from ..configs import DB_EXECUTOR_WORKERS
+from ..metrics import db_active_sessions
 from sqlalchemy.orm import session
 
+# Dedicated, bounded pool for db work so commits never stall the event loop
+db_executor = ThreadPoolExecutor(
+    max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db"
+)
+
 
 @contextmanager
 def session_scope() -> session:
     session = SessionLocal()
+    db_active_sessions.inc()
     try:
         yield session
         session.commit()
@@ -15,6 +25,7 @@ def session_scope() -> session:
         raise
     finally:
         session.close()
+        db_active_sessions.dec()
 
 
 def with_session(f):
@@ -32,6 +43,14 @@ def with_session(f):
     return wrapper
 
 
+async def run_in_db(f, *args, **kwargs):
+    """
+    Run a blocking db function in db_executor and await its result
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, partial(f, *args, **kwargs))
+
+
 def get_db() -> SessionLocal:
     db = SessionLocal()
     return db
@@ -0,0 +1,76 @@
+"""
+Store the token counts of messages written before they were computed on write:
+
+    python -m app.jobs.backfill_token_counts --batch-size 500
+
+Adds the query_tokens/response_tokens columns to an existing message table if they
+are missing, then fills the rows where they are NULL, one transaction per batch.
+Safe to interrupt and run again.
+"""
+import argparse
+import time
+
+from sqlalchemy import inspect, or_, text
+
+from ..db.base import engine
+from ..db.models.message_model import MessageModel
+from ..db.session import session_scope
+from ..memory.token_counter import count_tokens
+
+__all__ = ["ensure_token_columns", "backfill_token_counts"]
+
+
+def ensure_token_columns() -> None:
+    columns = {c["name"] for c in inspect(engine).get_columns(MessageModel.__tablename__)}
+    with engine.begin() as conn:
+        for name in ("query_tokens", "response_tokens"):
+            if name not in columns:
+                conn.execute(text(f"ALTER TABLE {MessageModel.__tablename__} ADD COLUMN {name} INTEGER"))
+
+
+def backfill_token_counts(batch_size: int = 500) -> int:
+    """
+    fill the missing token counts, return the number of rows updated
+    """
+    updated = 0
+    last_id = ""
+    while True:
+        with session_scope() as session:
+            rows = (
+                session.query(MessageModel.id, MessageModel.query, MessageModel.response)
+                .filter(MessageModel.id > last_id)
+                .filter(or_(MessageModel.query_tokens.is_(None), MessageModel.response_tokens.is_(None)))
+                .order_by(MessageModel.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not rows:
+                return updated
+            session.bulk_update_mappings(
+                MessageModel,
+                [
+                    {
+                        "id": row.id,
+                        "query_tokens": count_tokens(row.query),
+                        "response_tokens": count_tokens(row.response),
+                    }
+                    for row in rows
+                ],
+            )
+        updated += len(rows)
+        last_id = rows[-1].id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="backfill message token counts")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    ensure_token_columns()
+    updated = backfill_token_counts(args.batch_size)
+    print(f"updated {updated} messages in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
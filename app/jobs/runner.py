@@ -0,0 +1,229 @@
+"""
+Run a JSONL file of chat requests offline and write the answers to a JSONL file:
+
+    python -m app.jobs.runner prompts.jsonl -o answers.jsonl -w 16
+
+Every input line is a /chat body ({"query": ..., "model_name": ..., ...}); with
+--query-field another field is used as the query. Answers are appended to the output
+as {"line": n, "id": ..., "text": ..., "latency": ...}, failed lines go to
+<output>.failed.jsonl. Re-running the same command resumes: lines already in the
+output are skipped, failed ones are tried again.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import Any, Dict, Iterator, Optional, Set, Tuple
+
+from langchain.callbacks import AsyncIteratorCallbackHandler
+from langchain.chains import LLMChain
+
+from ..configs import logger, log_verbose
+from ..chat.batch import BatchChatItem
+from ..chat.chat import build_chat_prompt
+from ..upstream import model_router
+from ..utils import get_ChatOpenAI
+
+__all__ = ["JobRunner", "load_checkpoint", "percentile"]
+
+
+def percentile(samples, q: float) -> Optional[float]:
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * q / 100), len(samples) - 1)]
+
+
+def load_checkpoint(output: str) -> Set[int]:
+    """
+    Line numbers already answered in `output`. A last line cut off by a killed run
+    is removed so the file stays valid JSONL.
+    """
+    done = set()
+    if not os.path.exists(output):
+        return done
+    valid_size = 0
+    with open(output, "rb") as f:
+        for raw in f:
+            try:
+                done.add(json.loads(raw)["line"])
+            except (ValueError, KeyError):
+                break
+            valid_size += len(raw)
+    if valid_size < os.path.getsize(output):
+        with open(output, "rb+") as f:
+            f.truncate(valid_size)
+    return done
+
+
+def iter_input(path: str, done: Set[int]) -> Iterator[Tuple[int, str]]:
+    """
+    (line number, line) of the input lines still to run, read lazily
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            if n not in done and line.strip():
+                yield n, line
+
+
+class JobRunner:
+    """
+    Fans the lines of a JSONL input out over `workers` asyncio workers. Prompts are
+    built like chat_stream does and calls go through the model router.
+    """
+
+    def __init__(
+        self,
+        input: str,
+        output: str,
+        workers: int = 8,
+        query_field: str = "query",
+        timeout: Optional[float] = None,
+        fsync_interval: float = 1.0,
+    ):
+        self.input = input
+        self.output = output
+        self.failed_output = f"{output}.failed.jsonl"
+        self.workers = workers
+        self.query_field = query_field
+        self.timeout = timeout
+        self.fsync_interval = fsync_interval
+        self.latencies = []
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.errors: Dict[str, int] = {}
+        self.output_chars = 0
+
+    async def run_line(self, line: str) -> Tuple[Any, str]:
+        """
+        answer one input line, return (its id, the answer)
+        """
+        data = json.loads(line)
+        if self.query_field != "query":
+            data = dict(data, query=data.get(self.query_field))
+        item = BatchChatItem.model_validate(
+            {k: v for k, v in data.items() if k in BatchChatItem.model_fields}
+        )
+        timeout = item.timeout or self.timeout
+        model = get_ChatOpenAI(
+            model_name=item.model_name,
+            temperature=item.temperature,
+            max_tokens=item.max_tokens,
+            streaming=False,
+            verbose=False,
+        )
+        chat_prompt, memory = build_chat_prompt(
+            model, item.history, item.conversation_id, item.history_len, item.prompt_name
+        )
+
+        def call(backend, callbacks):
+            model = get_ChatOpenAI(
+                model_name=item.model_name,
+                temperature=item.temperature,
+                max_tokens=item.max_tokens,
+                streaming=False,
+                verbose=False,
+                callbacks=callbacks,
+                timeout=timeout,
+                backend=backend,
+            )
+            chain = LLMChain(prompt=chat_prompt, llm=model, memory=memory)
+            return chain.acall({"input": item.query})
+
+        result = await model_router.acall(
+            item.model_name, call, AsyncIteratorCallbackHandler()
+        )
+        return data.get("id", data.get("request_id")), result["text"]
+
+    async def run(self) -> Dict[str, Any]:
+        done = load_checkpoint(self.output)
+        self.skipped = len(done)
+        lines = iter_input(self.input, done)
+        start = time.perf_counter()
+        last_sync = start
+
+        with open(self.output, "a", encoding="utf-8") as out, open(
+            self.failed_output, "w", encoding="utf-8"
+        ) as failed:
+
+            def write(f, record: Dict[str, Any]) -> None:
+                nonlocal last_sync
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                now = time.perf_counter()
+                if now - last_sync >= self.fsync_interval:
+                    # the output is the checkpoint, make it survive a crash
+                    os.fsync(out.fileno())
+                    last_sync = now
+
+            async def worker() -> None:
+                # the input iterator is shared, each worker takes the next line
+                for n, line in lines:
+                    t = time.perf_counter()
+                    try:
+                        item_id, text = await self.run_line(line)
+                    except Exception as e:
+                        self.failed += 1
+                        error = f"{e.__class__.__name__}: {e}"
+                        self.errors[e.__class__.__name__] = self.errors.get(e.__class__.__name__, 0) + 1
+                        logger.error(
+                            f"line {n} failed: {error}",
+                            exc_info=e if log_verbose else None,
+                        )
+                        write(failed, {"line": n, "error": error})
+                        continue
+                    latency = time.perf_counter() - t
+                    self.latencies.append(latency)
+                    self.succeeded += 1
+                    self.output_chars += len(text)
+                    write(out, {"line": n, "id": item_id, "text": text, "latency": round(latency, 4)})
+
+            await asyncio.gather(*[worker() for _ in range(self.workers)])
+            os.fsync(out.fileno())
+
+        return self.report(time.perf_counter() - start)
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        return {
+            "elapsed": round(elapsed, 3),
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "throughput": round(self.succeeded / elapsed, 3) if elapsed else None,
+            "output_chars_per_second": round(self.output_chars / elapsed, 1) if elapsed else None,
+            "latency_p50": percentile(self.latencies, 50),
+            "latency_p95": percentile(self.latencies, 95),
+            "latency_p99": percentile(self.latencies, 99),
+            "latency_max": max(self.latencies) if self.latencies else None,
+            "errors": self.errors,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="run a JSONL file of chat requests")
+    parser.add_argument("input")
+    parser.add_argument("-o", "--output", help="answers JSONL, defaults to <input>.out.jsonl")
+    parser.add_argument("-w", "--workers", type=int, default=8)
+    parser.add_argument("--query-field", default="query", help="field of an input line used as the query")
+    parser.add_argument("--timeout", type=float, default=None, help="seconds per line")
+    parser.add_argument("--report", help="also write the report to this JSON file")
+    args = parser.parse_args()
+
+    runner = JobRunner(
+        args.input,
+        args.output or f"{os.path.splitext(args.input)[0]}.out.jsonl",
+        workers=args.workers,
+        query_field=args.query_field,
+        timeout=args.timeout,
+    )
+    report = asyncio.run(runner.run())
+    print(json.dumps(report, indent=2))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,71 @@
 from fastapi import FastAPI
-from fastapi.responses import RedirectResponse
+from fastapi.responses import PlainTextResponse, RedirectResponse
 from app.db.utlis import create_tables, reset_tables
 from .db.repository.message_repository import add_message_to_db
 import pydantic
 from pydantic import BaseModel
-from typing import Any
+from typing import Any, Optional
 from .utils import get_model_worker_config
 from .schemas import BaseResponse
-from .chat import chat_stream
+from .chat import chat_stream, chat_resume, chat_batch
+from .cache import response_cache, single_flight, history_cache, semantic_cache
+from .upstream import upstream_clients, chat_scheduler, rate_limiter, model_router
+from .db.session import db_executor
+from .middleware import (
+    TrafficCaptureMiddleware,
+    TracingMiddleware,
+    RequestProfilingMiddleware,
+    traffic_capture,
+)
+from .tracing import tracer
+from .profiling import (
+    profiler,
+    loop_watchdog,
+    profile_cpu,
+    profile_memory_start,
+    profile_memory_stop,
+    profile_result,
+    profile_status,
+)
+from .metrics import metrics_registry
+from .memory.context_budget import context_budgeter
+from .memory.summarizer import conversation_summarizer
+from .memory.retrieval_index import conversation_indexes
+from .db.repository.message_write_queue import message_write_queue
+from .configs import ONLINE_LLM_MODEL, LLM_MODELS
 from .webui_pages.utils import ApiRequest
 
 app = FastAPI()
+if traffic_capture.enabled:
+    app.add_middleware(TrafficCaptureMiddleware, capture=traffic_capture)
+if tracer.enabled:
+    app.add_middleware(TracingMiddleware, tracer=tracer)
+if profiler.enabled:
+    app.add_middleware(RequestProfilingMiddleware, profiler=profiler)
 
 reset_tables()
 create_tables()
 
 
+@app.on_event("startup")
+async def warmup_upstream_clients():
+    traffic_capture.start()
+    tracer.start()
+    loop_watchdog.start()
+    backends = {b for model_name in LLM_MODELS for b in model_router.backends(model_name)}
+    await upstream_clients.warmup([ONLINE_LLM_MODEL[b] for b in backends if b in ONLINE_LLM_MODEL])
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    loop_watchdog.stop()
+    await upstream_clients.aclose()
+    await message_write_queue.close()
+    db_executor.shutdown(wait=True)
+    traffic_capture.stop()
+    tracer.stop()
+
+
 async def document():
     return RedirectResponse(url="/docs")
 
@@ -23,6 +73,128 @@ async def document():
 app.get("/", response_model=BaseResponse, summary="swagger")(document)
 
 app.post("/chat", response_model=BaseResponse, summary="chat")(chat_stream)
+app.post("/chat/batch", summary="run many chat requests, results streamed as NDJSON")(chat_batch)
+
+app.get("/chat/stream/{message_id}", summary="resume a chat stream")(chat_resume)
+
+
+@app.get("/chat/cache", response_model=BaseResponse, summary="response cache stats")
+def response_cache_stats():
+    return BaseResponse(data=response_cache.stats())
+
+
+@app.get("/chat/semantic_cache", response_model=BaseResponse, summary="semantic cache stats")
+def semantic_cache_stats():
+    return BaseResponse(data=semantic_cache.stats())
+
+
+@app.get("/chat/semantic_cache/hits", response_model=BaseResponse, summary="recent semantic cache hits")
+def semantic_cache_hits(limit: int = 50, prompt_name: Optional[str] = None):
+    return BaseResponse(data=semantic_cache.recent_hits(limit, prompt_name))
+
+
+@app.post(
+    "/chat/semantic_cache/false_hit/{id}",
+    response_model=BaseResponse,
+    summary="report a semantic cache hit (hit id or message id) as a wrong answer",
+)
+def semantic_cache_false_hit(id: str):
+    hit = semantic_cache.false_hit(id)
+    if hit is None:
+        return BaseResponse(code=404, msg=f"no semantic cache hit {id}")
+    return BaseResponse(data=hit)
+
+
+@app.get("/chat/inflight", response_model=BaseResponse, summary="single-flight stats")
+def single_flight_stats():
+    return BaseResponse(data=single_flight.stats())
+
+
+@app.get("/chat/history_cache", response_model=BaseResponse, summary="history cache stats")
+def history_cache_stats():
+    return BaseResponse(data=history_cache.stats())
+
+
+@app.get("/chat/context_budget", response_model=BaseResponse, summary="context budgeter stats")
+def context_budget_stats():
+    return BaseResponse(data=context_budgeter.stats())
+
+
+@app.get("/chat/summaries", response_model=BaseResponse, summary="background summary stats")
+def summary_stats():
+    return BaseResponse(data=conversation_summarizer.stats())
+
+
+@app.get("/chat/retrieval", response_model=BaseResponse, summary="retrieval memory index stats")
+def retrieval_index_stats():
+    return BaseResponse(data=conversation_indexes.stats())
+
+
+@app.get("/db/write_queue", response_model=BaseResponse, summary="write-behind queue stats")
+def write_queue_stats():
+    return BaseResponse(data=message_write_queue.stats())
+
+
+@app.get("/db/write_queue/dead_letters", response_model=BaseResponse, summary="message rows dropped after failed writes")
+def write_queue_dead_letters():
+    return BaseResponse(data=list(message_write_queue.dead_letters))
+
+
+@app.get("/scheduler", response_model=BaseResponse, summary="scheduler stats")
+def scheduler_stats():
+    return BaseResponse(data=chat_scheduler.stats())
+
+
+@app.get("/rate_limit", response_model=BaseResponse, summary="rate limiter stats")
+def rate_limit_stats():
+    return BaseResponse(data=rate_limiter.stats())
+
+
+@app.get("/upstream/router", response_model=BaseResponse, summary="model router stats")
+def model_router_stats():
+    return BaseResponse(data=model_router.stats())
+
+
+@app.get("/capture", response_model=BaseResponse, summary="traffic capture stats")
+def traffic_capture_stats():
+    return BaseResponse(data=traffic_capture.stats())
+
+
+@app.get("/traces", response_model=BaseResponse, summary="recently kept traces")
+def recent_traces(limit: int = 50):
+    return BaseResponse(data={"stats": tracer.stats(), "traces": tracer.recent(limit)})
+
+
+@app.get("/traces/{message_id}", response_model=BaseResponse, summary="trace waterfall of a message")
+def trace_waterfall(message_id: str):
+    trace = tracer.find(message_id)
+    if trace is None:
+        return BaseResponse(code=404, msg=f"no trace kept for {message_id}")
+    return BaseResponse(data=trace.waterfall())
+
+
+@app.get("/upstream/pool", response_model=BaseResponse, summary="upstream pool stats")
+def upstream_pool_stats():
+    return BaseResponse(data=upstream_clients.stats())
+
+
+@app.get("/metrics", response_class=PlainTextResponse, summary="Prometheus metrics")
+def metrics():
+    return PlainTextResponse(
+        metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/debug/event_loop", response_model=BaseResponse, summary="event loop lag and blocking call sites")
+def event_loop_stats():
+    return BaseResponse(data=loop_watchdog.stats())
+
+
+app.get("/debug/profile", response_model=BaseResponse, summary="profiler status")(profile_status)
+app.post("/debug/profile/cpu", summary="sampling cpu profile, collapsed stacks")(profile_cpu)
+app.post("/debug/profile/memory/start", summary="start tracing allocations")(profile_memory_start)
+app.post("/debug/profile/memory/stop", summary="top allocation diffs since start")(profile_memory_stop)
+app.get("/debug/profile/{profile_id}", summary="download a finished profile")(profile_result)
 
 
 @app.post("/message")
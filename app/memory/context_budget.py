@@ -0,0 +1,203 @@
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
+
+from ..configs import CONTEXT_BUDGET
+from ..schemas import History
+from .token_counter import count_tokens, ROLE_PREFIX_TOKENS
+
+__all__ = ["ContextBudget", "ContextBudgeter", "ContextWindowExceeded", "context_budgeter"]
+
+
+class ContextWindowExceeded(Exception):
+    status_code = 400
+
+    def __init__(self, msg: str):
+        super().__init__(msg)
+        self.msg = msg
+
+
+class ContextBudget:
+    """
+    How the context window of one call is shared between prompt, history and output
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        context_length: int,
+        prompt_tokens: int,
+        output_tokens: int,
+        history_limit: int,
+        max_tokens: Optional[int],
+        output_clamped: bool,
+    ):
+        self.model_name = model_name
+        self.context_length = context_length
+        self.prompt_tokens = prompt_tokens
+        self.output_tokens = output_tokens
+        self.history_limit = history_limit
+        self.max_tokens = max_tokens
+        self.output_clamped = output_clamped
+        self.history_tokens = 0
+        self.history_messages = 0
+        self.history_dropped = 0
+
+    def record_history(self, tokens: int, kept: int, dropped: int) -> None:
+        self.history_tokens = tokens
+        self.history_messages = kept
+        self.history_dropped = dropped
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "model_name": self.model_name,
+            "context_length": self.context_length,
+            "prompt_tokens": self.prompt_tokens,
+            "history_tokens": self.history_tokens,
+            "history_limit": self.history_limit,
+            "history_messages": self.history_messages,
+            "history_dropped": self.history_dropped,
+            "output_tokens": self.output_tokens,
+            "output_clamped": self.output_clamped,
+        }
+
+
+class ContextBudgeter:
+    """
+    Sizes a call against its model's context window before it is sent: the prompt
+    (template and query) is counted first, then room is reserved for the output
+    (max_tokens, or `default_output_tokens`), and history gets what is left. History
+    messages are dropped oldest first, system messages are kept. A requested
+    max_tokens that does not fit even without history is lowered.
+    Token counts are memoized by content hash, repeated history is counted once.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        default_context_length: int = 4096,
+        default_output_tokens: int = 512,
+        min_output_tokens: int = 16,
+        safety_margin: int = 64,
+        cache_size: int = 100000,
+    ):
+        self.enabled = enabled
+        self.default_context_length = default_context_length
+        self.default_output_tokens = default_output_tokens
+        self.min_output_tokens = min_output_tokens
+        self.safety_margin = safety_margin
+        self.cache_size = cache_size
+        self._counts: "OrderedDict[bytes, int]" = OrderedDict()
+        # counts are taken in executor threads
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.trimmed = 0
+        self.rejected = 0
+
+    def count(self, text: str) -> int:
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self._lock:
+            tokens = self._counts.get(key)
+            if tokens is not None:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return tokens
+        tokens = count_tokens(text)
+        with self._lock:
+            self.misses += 1
+            self._counts[key] = tokens
+            if len(self._counts) > self.cache_size:
+                self._counts.popitem(last=False)
+        return tokens
+
+    def context_length(self, model_name: str) -> int:
+        """
+        the smallest window of the backends serving `model_name`, any of them may get the call
+        """
+        from ..upstream import model_router
+        from ..utils import get_model_worker_config
+
+        return min(
+            get_model_worker_config(model_name, backend).get("context_length")
+            or self.default_context_length
+            for backend in model_router.backends(model_name)
+        )
+
+    def fit(
+        self,
+        model_name: str,
+        prompt: str,
+        history: List[History],
+        max_tokens: Optional[int] = None,
+        db_history_limit: Optional[int] = None,
+    ) -> Tuple[List[History], ContextBudget]:
+        """
+        The history messages that fit, and the budget. `db_history_limit` caps the
+        tokens of history loaded later from the db, budget.history_limit is what it gets.
+        """
+        context_length = self.context_length(model_name)
+        room = context_length - self.safety_margin - self.count(prompt)
+        if room < self.min_output_tokens:
+            self.rejected += 1
+            raise ContextWindowExceeded(
+                f"the prompt needs {context_length - self.safety_margin - room} tokens, "
+                f"{model_name} has a context window of {context_length}"
+            )
+        output_tokens = max_tokens or self.default_output_tokens
+        output_clamped = output_tokens > room
+        output_tokens = min(output_tokens, room)
+        history_budget = room - output_tokens
+
+        counts = [self.count(h.content) + ROLE_PREFIX_TOKENS for h in history]
+        total = sum(counts)
+        dropped = set()
+        for i, h in enumerate(history):
+            if total <= history_budget:
+                break
+            if h.role != "system":
+                dropped.add(i)
+                total -= counts[i]
+        if total > history_budget:
+            self.rejected += 1
+            raise ContextWindowExceeded(
+                f"the system messages need {total} tokens, {history_budget} are left for history"
+            )
+        if dropped:
+            self.trimmed += 1
+
+        budget = ContextBudget(
+            model_name=model_name,
+            context_length=context_length,
+            prompt_tokens=context_length - self.safety_margin - room,
+            output_tokens=output_tokens,
+            history_limit=min(history_budget, db_history_limit or history_budget),
+            max_tokens=output_tokens if max_tokens else None,
+            output_clamped=bool(max_tokens) and output_clamped,
+        )
+        if history:
+            budget.record_history(total, len(history) - len(dropped), len(dropped))
+        return [h for i, h in enumerate(history) if i not in dropped], budget
+
+    async def afit(self, *args: Any, **kwargs: Any) -> Tuple[List[History], ContextBudget]:
+        """
+        fit() in an executor thread, tokenizing blocks
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, partial(self.fit, *args, **kwargs))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "cached_counts": len(self._counts),
+            "hits": self.hits,
+            "misses": self.misses,
+            "trimmed": self.trimmed,
+            "rejected": self.rejected,
+        }
+
+
+context_budgeter = ContextBudgeter(**CONTEXT_BUDGET)
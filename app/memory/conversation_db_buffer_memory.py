@@ -1,11 +1,15 @@
+import asyncio
 import logging
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Optional
 
 from langchain.memory.chat_memory import BaseChatMemory
 from langchain.schema import get_buffer_string, BaseMessage, HumanMessage, AIMessage
 from langchain.schema.language_model import BaseLanguageModel
-from ..db.repository.message_repository import filter_message
+from ..db.repository.message_repository import filter_message, afilter_message
 from ..db.models.message_model import MessageModel
+from ..metrics import chat_stage_seconds
+from ..tracing import tracer
+from .token_counter import count_tokens, ROLE_PREFIX_TOKENS
 
 
 class ConversationBufferDBMemory(BaseChatMemory):
@@ -16,32 +20,74 @@ class ConversationBufferDBMemory(BaseChatMemory):
     memory_key: str = "history"
     max_token_limit: int = 2000
     message_limit: int = 10
+    # a ContextBudget, records the history tokens and messages that were kept
+    budget: Optional[Any] = None
 
     @property
     def buffer(self) -> List[BaseMessage]:
         """String buffer of memory."""
         # fetch limited messages desc, and return reversed
 
-        messages = filter_message(conversation_id=self.conversation_id, limit=self.message_limit)
-        
+        with chat_stage_seconds.labels("history_load").time():
+            messages = filter_message(conversation_id=self.conversation_id, limit=self.message_limit)
+            return self._to_buffer(messages)
+
+    async def abuffer(self) -> List[BaseMessage]:
+        """String buffer of memory, loaded without blocking the event loop."""
+        with chat_stage_seconds.labels("history_load").time(), tracer.span("history_load"):
+            messages = await afilter_message(
+                conversation_id=self.conversation_id, limit=self.message_limit
+            )
+            if any(m["query_tokens"] is None or m["response_tokens"] is None for m in messages):
+                # turns still in the write-behind queue, count them off the event loop
+                loop = asyncio.get_running_loop()
+                messages = await loop.run_in_executor(None, self._fill_token_counts, messages)
+            return self._to_buffer(messages)
+
+    @staticmethod
+    def _fill_token_counts(messages: List[Dict]) -> List[Dict]:
+        for m in messages:
+            if m.get("query_tokens") is None:
+                m["query_tokens"] = count_tokens(m["query"])
+            if m.get("response_tokens") is None:
+                m["response_tokens"] = count_tokens(m["response"])
+        return messages
+
+    def _to_buffer(self, messages: List[Dict], reserved_tokens: int = 0) -> List[BaseMessage]:
+        """
+        messages (newest first) as chat messages, oldest first, pruned to max_token_limit
+        of which `reserved_tokens` are taken by the caller
+        """
         messages = list(reversed(messages))
         chat_messages: List[BaseMessage] = []
+        token_counts: List[int] = []
         for message in messages:
-            chat_messages.append(HumanMessage(content=message["query"]))
-            chat_messages.append(AIMessage(content=message["response"]))
+            # memoized on the row, rows from the history cache are reused turn after turn
+            pair = message.get("_messages")
+            if pair is None:
+                pair = message["_messages"] = (
+                    HumanMessage(content=message["query"]),
+                    AIMessage(content=message["response"]),
+                )
+            chat_messages.extend(pair)
+            token_counts.append(message["query_tokens"] + ROLE_PREFIX_TOKENS)
+            token_counts.append(message["response_tokens"] + ROLE_PREFIX_TOKENS)
 
         if not chat_messages:
             return []
 
-        # prune the chat message if it exceeds the max token limit
-        curr_buffer_length = self.llm.get_num_tokens(get_buffer_string(chat_messages))
-        if curr_buffer_length > self.max_token_limit:
-            pruned_memory = []
-            while curr_buffer_length > self.max_token_limit and chat_messages:
-                pruned_memory.append(chat_messages.pop(0))
-                curr_buffer_length = self.llm.get_num_tokens(get_buffer_string(chat_messages))
+        # prune the oldest messages while the stored token counts exceed the max token limit
+        curr_buffer_length = sum(token_counts)
+        pruned = 0
+        while curr_buffer_length > self.max_token_limit - reserved_tokens and pruned < len(chat_messages):
+            curr_buffer_length -= token_counts[pruned]
+            pruned += 1
 
-        return chat_messages
+        if self.budget is not None:
+            self.budget.record_history(
+                curr_buffer_length + reserved_tokens, len(chat_messages) - pruned, pruned
+            )
+        return chat_messages[pruned:]
 
     @property
     def memory_variables(self) -> List[str]:
@@ -53,7 +99,13 @@ class ConversationBufferDBMemory(BaseChatMemory):
 
     def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
         """Return history buffer."""
-        buffer: Any = self.buffer
+        return self._to_variables(self.buffer)
+
+    async def aload_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """Return history buffer."""
+        return self._to_variables(await self.abuffer())
+
+    def _to_variables(self, buffer: Any) -> Dict[str, Any]:
         if self.return_messages:
             final_buffer: Any = buffer
         else:
@@ -0,0 +1,87 @@
+import asyncio
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langchain.schema import BaseMessage
+
+from ..db.repository.message_repository import filter_message, afilter_message
+from ..metrics import chat_stage_seconds
+from ..tracing import tracer
+from .conversation_db_buffer_memory import ConversationBufferDBMemory
+from .embeddings import embedder
+from .retrieval_index import ConversationIndex, conversation_indexes
+
+
+class ConversationRetrievalDBMemory(ConversationBufferDBMemory):
+    """
+    The past turns most similar to the query, searched in the conversation's vector index
+    (see ConversationIndexStore), followed by the last `recent_turns` turns verbatim.
+    The `message_limit` newest messages are loaded on every call, those the index has not
+    seen yet (written by another worker, or still in the write-behind queue) are added.
+    """
+
+    message_limit: int = 20
+    top_k: int = conversation_indexes.top_k
+    recent_turns: int = conversation_indexes.recent_turns
+    min_score: float = conversation_indexes.min_score
+    input_key: str = "input"
+
+    @property
+    def buffer(self) -> List[BaseMessage]:
+        """Only the recent turns, searching needs the query, see load_memory_variables."""
+        return self._load("")
+
+    def _load(self, query: str) -> List[BaseMessage]:
+        with chat_stage_seconds.labels("history_load").time():
+            messages = filter_message(conversation_id=self.conversation_id, limit=self.message_limit)
+            index = conversation_indexes.get(self.conversation_id)
+            self._catch_up(index, messages)
+            return self._select(index, messages, query)
+
+    async def abuffer(self, query: str = "") -> List[BaseMessage]:
+        """String buffer of memory, loaded without blocking the event loop."""
+        with chat_stage_seconds.labels("history_load").time(), tracer.span("history_load"):
+            messages, index = await asyncio.gather(
+                afilter_message(conversation_id=self.conversation_id, limit=self.message_limit),
+                conversation_indexes.aget(self.conversation_id),
+            )
+            loop = asyncio.get_running_loop()
+            if any(m["query_tokens"] is None or m["response_tokens"] is None for m in messages):
+                messages = await loop.run_in_executor(None, self._fill_token_counts, messages)
+            if any(m["id"] not in index for m in messages):
+                await loop.run_in_executor(None, self._catch_up, index, messages)
+            with tracer.span("retrieval_search", turns=len(index)):
+                vector = None
+                if query and self.top_k > 0:
+                    # a pluggable embedder may take milliseconds, not on the event loop
+                    vector = await loop.run_in_executor(None, embedder.embed_one, query)
+                return self._select(index, messages, query, vector)
+
+    @staticmethod
+    def _catch_up(index: ConversationIndex, messages: List[Dict]) -> None:
+        missing = [m for m in messages if m["id"] not in index]
+        if missing:
+            conversation_indexes.add_turns(index, list(reversed(missing)))
+
+    def _select(
+        self,
+        index: ConversationIndex,
+        messages: List[Dict],
+        query: str,
+        vector: Optional[np.ndarray] = None,
+    ) -> List[BaseMessage]:
+        recent = messages[: self.recent_turns]
+        retrieved = []
+        if query and self.top_k > 0:
+            hits = index.search(query, self.top_k, [m["id"] for m in recent], self.min_score, vector)
+            retrieved = [turn for turn, _ in hits]
+        # newest first, _to_buffer prunes the oldest retrieved turns first
+        return self._to_buffer(recent + list(reversed(retrieved)))
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """Return history buffer."""
+        return self._to_variables(self._load(inputs.get(self.input_key, "")))
+
+    async def aload_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """Return history buffer."""
+        return self._to_variables(await self.abuffer(inputs.get(self.input_key, "")))
@@ -0,0 +1,85 @@
+import asyncio
+from typing import Dict, List, Optional
+
+from langchain.schema import BaseMessage, SystemMessage
+
+from ..configs import SUMMARY_MEMORY
+from ..db.repository.conversation_summary_repository import get_summary, aget_summary
+from ..db.repository.message_repository import filter_message, afilter_message
+from ..metrics import chat_stage_seconds
+from ..tracing import tracer
+from .conversation_db_buffer_memory import ConversationBufferDBMemory
+from .summarizer import conversation_summarizer
+from .token_counter import ROLE_PREFIX_TOKENS
+
+
+class ConversationSummaryDBMemory(ConversationBufferDBMemory):
+    """
+    A stored running summary of the conversation plus the verbatim tail of the messages
+    not folded into it yet. Once the tail is over `tail_token_threshold` tokens, or fills
+    the `message_limit` window without reaching back to the summary, its older turns are
+    summarized in the background (see ConversationSummarizer), the request itself never
+    waits for a summary, so the prompt stays about the same size however long the
+    conversation gets.
+    """
+
+    message_limit: int = SUMMARY_MEMORY["message_limit"]
+    # model_name of the request, the summary is made by it unless SUMMARY_MEMORY sets one
+    model_name: Optional[str] = None
+    summary_prefix: str = "Summary of the earlier conversation:"
+
+    @property
+    def buffer(self) -> List[BaseMessage]:
+        """String buffer of memory, summaries are only started by abuffer."""
+        with chat_stage_seconds.labels("history_load").time():
+            summary = get_summary(conversation_id=self.conversation_id)
+            messages = filter_message(conversation_id=self.conversation_id, limit=self.message_limit)
+            return self._to_summary_buffer(summary, self._tail(summary, messages))
+
+    async def abuffer(self) -> List[BaseMessage]:
+        """String buffer of memory, loaded without blocking the event loop."""
+        with chat_stage_seconds.labels("history_load").time(), tracer.span("history_load"):
+            summary, messages = await asyncio.gather(
+                aget_summary(self.conversation_id),
+                afilter_message(conversation_id=self.conversation_id, limit=self.message_limit),
+            )
+            if any(m["query_tokens"] is None or m["response_tokens"] is None for m in messages):
+                loop = asyncio.get_running_loop()
+                messages = await loop.run_in_executor(None, self._fill_token_counts, messages)
+            tail = self._tail(summary, messages)
+            tail_tokens = sum(
+                m["query_tokens"] + m["response_tokens"] + 2 * ROLE_PREFIX_TOKENS for m in tail
+            )
+            conversation_summarizer.maybe_schedule(
+                self.conversation_id,
+                self.model_name,
+                summary,
+                list(reversed(tail)),
+                tail_tokens,
+                # messages older than the window may not be in the summary yet
+                truncated=len(tail) == len(messages) >= self.message_limit,
+            )
+            return self._to_summary_buffer(summary, tail)
+
+    @staticmethod
+    def _tail(summary: Optional[Dict], messages: List[Dict]) -> List[Dict]:
+        """
+        the messages (newest first) newer than the ones folded into the summary
+        """
+        if not summary:
+            return messages
+        tail = []
+        for m in messages:
+            if m["id"] == summary["covered_message_id"]:
+                break
+            tail.append(m)
+        return tail
+
+    def _to_summary_buffer(self, summary: Optional[Dict], tail: List[Dict]) -> List[BaseMessage]:
+        if not summary or not summary["summary"]:
+            return self._to_buffer(tail)
+        summary_tokens = summary["summary_tokens"] + ROLE_PREFIX_TOKENS
+        buffer = self._to_buffer(tail, reserved_tokens=summary_tokens)
+        if not buffer and self.budget is not None:
+            self.budget.record_history(summary_tokens, 0, 0)
+        return [SystemMessage(content=f"{self.summary_prefix}\n{summary['summary']}")] + buffer
@@ -0,0 +1,73 @@
+import importlib
+import re
+import zlib
+from typing import Any, List
+
+import numpy as np
+
+from ..configs import EMBEDDING
+
+__all__ = ["Embedder", "HashingEmbedder", "get_embedder", "embedder"]
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+class Embedder:
+    """
+    Turns texts into L2-normalized float32 vectors of `dim` dimensions, one row per text
+    """
+
+    dim: int
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+    def embed_one(self, text: str) -> np.ndarray:
+        return self.embed([text])[0]
+
+
+class HashingEmbedder(Embedder):
+    """
+    Feature hashing of lowercased words and word pairs into `dim` signed buckets, with
+    sublinear term frequencies. Needs no model and no network, texts sharing words end
+    up close, paraphrases with other words do not.
+    """
+
+    def __init__(self, dim: int = 128, bigrams: bool = True):
+        self.dim = dim
+        self.bigrams = bigrams
+
+    def _hashes(self, text: str) -> np.ndarray:
+        words = _WORD.findall(text.lower())
+        features = words
+        if self.bigrams:
+            features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        return np.fromiter(
+            (zlib.crc32(f.encode("utf-8")) for f in features), dtype=np.uint32, count=len(features)
+        )
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            hashes = self._hashes(text)
+            if not len(hashes):
+                continue
+            signs = np.where(hashes >> 31, 1.0, -1.0).astype(np.float32)
+            np.add.at(vectors[row], hashes % self.dim, signs)
+        vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+
+def get_embedder(embedder: str = "hashing", **kwargs: Any) -> Embedder:
+    """
+    "hashing", or the "package.module:Class" of an Embedder, built with `kwargs`
+    """
+    if embedder == "hashing":
+        return HashingEmbedder(**kwargs)
+    module, _, name = embedder.partition(":")
+    return getattr(importlib.import_module(module), name)(**kwargs)
+
+
+embedder = get_embedder(**EMBEDDING)
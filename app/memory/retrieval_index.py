@@ -0,0 +1,262 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from ..configs import RETRIEVAL_MEMORY
+from ..metrics import metrics_registry
+from .embeddings import embedder
+from .token_counter import count_tokens
+from .vector_index import VectorIndex
+
+__all__ = ["ConversationIndex", "ConversationIndexStore", "conversation_indexes"]
+
+SEARCH_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05)
+
+retrieval_search_seconds = metrics_registry.histogram(
+    "retrieval_search_seconds",
+    "Time to search the turns of a conversation, embedding the query unless it is given",
+    buckets=SEARCH_BUCKETS,
+)
+
+
+def turn_text(turn: Dict[str, Any]) -> str:
+    return f"{turn['query']}\n{turn['response']}"
+
+
+class ConversationIndex:
+    """
+    The embedded turns (query and response) of one conversation
+    """
+
+    def __init__(self, conversation_id: str, dim: int):
+        self.conversation_id = conversation_id
+        self.index = VectorIndex(dim)
+        # by index position
+        self.turns: List[Dict[str, Any]] = []
+        self.text_bytes = 0
+        # appended from the db threads, searched from the event loop
+        self.lock = threading.Lock()
+
+    def __contains__(self, message_id: str) -> bool:
+        return message_id in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    @property
+    def nbytes(self) -> int:
+        return self.index.nbytes + self.text_bytes
+
+    def add_turns(self, turns: List[Dict[str, Any]]) -> None:
+        """
+        embed and add turns, oldest first. A turn already indexed is replaced.
+        """
+        turns = [
+            # the write-behind queue hands over rows without token counts
+            dict(t, query_tokens=count_tokens(t["query"]), response_tokens=count_tokens(t["response"]))
+            if t.get("query_tokens") is None or t.get("response_tokens") is None
+            else t
+            for t in turns
+            if t["response"]
+        ]
+        if not turns:
+            return
+        vectors = embedder.embed([turn_text(t) for t in turns])
+        with self.lock:
+            self.index.add([t["id"] for t in turns], vectors)
+            for turn in turns:
+                position = self.index.position(turn["id"])
+                size = len(turn["query"]) + len(turn["response"])
+                if position < len(self.turns):
+                    old = self.turns[position]
+                    self.text_bytes -= len(old["query"]) + len(old["response"])
+                    self.turns[position] = turn
+                else:
+                    self.turns.append(turn)
+                self.text_bytes += size
+
+    def search(
+        self,
+        query: str,
+        k: int,
+        exclude: Iterable[str] = (),
+        min_score: float = -1.0,
+        vector: Optional[np.ndarray] = None,
+    ) -> List[Tuple[Dict[str, Any], float]]:
+        """
+        the `k` turns most similar to `query` with their scores, oldest first.
+        `vector` is the embedding of `query` if already known.
+        """
+        start = time.perf_counter()
+        if vector is None:
+            vector = embedder.embed_one(query)
+        with self.lock:
+            hits = self.index.search(vector, k, exclude, min_score)
+            result = [(self.turns[p], score) for p, score in sorted(hits)]
+        retrieval_search_seconds.observe(time.perf_counter() - start)
+        return result
+
+
+class ConversationIndexStore:
+    """
+    Indexes of recently used conversations in LRU order, bounded by `max_bytes`.
+    An index is built from the db on first use, then kept up to date incrementally:
+    responses written by this worker are added as they are written (on_write), and
+    turns written elsewhere are added when the memory sees them in the recent messages.
+    """
+
+    def __init__(
+        self,
+        top_k: int = 4,
+        recent_turns: int = 2,
+        min_score: float = 0.1,
+        max_turns: int = 10000,
+        max_bytes: int = 256 * 1024 * 1024,
+    ):
+        self.top_k = top_k
+        self.recent_turns = recent_turns
+        self.min_score = min_score
+        self.max_turns = max_turns
+        self.max_bytes = max_bytes
+        self._indexes: "OrderedDict[str, ConversationIndex]" = OrderedDict()
+        # bytes of each loaded index when it was last accounted, and their total
+        self._sizes: Dict[str, int] = {}
+        self._bytes = 0
+        self._building: Dict[str, asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self.builds = 0
+        self.evictions = 0
+        self.incremental_adds = 0
+
+    def loaded(self, conversation_id: str) -> bool:
+        return conversation_id in self._indexes
+
+    @property
+    def empty(self) -> bool:
+        return not self._indexes
+
+    def build(self, conversation_id: str) -> ConversationIndex:
+        """
+        index the newest `max_turns` turns of the conversation, blocking
+        """
+        from ..db.repository.message_repository import filter_message
+
+        turns = filter_message(conversation_id=conversation_id, limit=self.max_turns)
+        index = ConversationIndex(conversation_id, embedder.dim)
+        index.add_turns(list(reversed(turns)))
+        self._store(index)
+        return index
+
+    def get(self, conversation_id: str) -> ConversationIndex:
+        with self._lock:
+            index = self._indexes.get(conversation_id)
+            if index is not None:
+                self._indexes.move_to_end(conversation_id)
+                return index
+        return self.build(conversation_id)
+
+    async def aget(self, conversation_id: str) -> ConversationIndex:
+        """
+        the index of a conversation, built in the db thread pool (rows) and the default
+        executor (embeddings) if it is not loaded. Concurrent requests share one build.
+        """
+        with self._lock:
+            index = self._indexes.get(conversation_id)
+            if index is not None:
+                self._indexes.move_to_end(conversation_id)
+                return index
+        building = self._building.get(conversation_id)
+        if building is None:
+            building = asyncio.ensure_future(self._abuild(conversation_id))
+            self._building[conversation_id] = building
+            building.add_done_callback(lambda _: self._building.pop(conversation_id, None))
+        return await asyncio.shield(building)
+
+    async def _abuild(self, conversation_id: str) -> ConversationIndex:
+        from ..db.repository.message_repository import filter_message
+        from ..db.session import run_in_db
+
+        # not through the history cache, it would keep all of them. Turns still in the
+        # write-behind queue are added by the memory, from the recent messages
+        turns = await run_in_db(filter_message, conversation_id=conversation_id, limit=self.max_turns)
+        index = ConversationIndex(conversation_id, embedder.dim)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, index.add_turns, list(reversed(turns)))
+        self._store(index)
+        return index
+
+    def _store(self, index: ConversationIndex) -> None:
+        with self._lock:
+            self.builds += 1
+            self._indexes[index.conversation_id] = index
+            self._indexes.move_to_end(index.conversation_id)
+            self._account(index)
+            self._evict()
+
+    def _account(self, index: ConversationIndex) -> None:
+        if self._indexes.get(index.conversation_id) is not index:
+            return
+        size = index.nbytes
+        self._bytes += size - self._sizes.get(index.conversation_id, 0)
+        self._sizes[index.conversation_id] = size
+
+    def _evict(self) -> None:
+        while self._bytes > self.max_bytes and len(self._indexes) > 1:
+            conversation_id, _ = self._indexes.popitem(last=False)
+            self._bytes -= self._sizes.pop(conversation_id, 0)
+            self.evictions += 1
+
+    def add_turns(self, index: ConversationIndex, turns: List[Dict[str, Any]]) -> None:
+        """
+        embed and add turns (oldest first) to a loaded index, blocking
+        """
+        index.add_turns(turns)
+        with self._lock:
+            self._account(index)
+            self._evict()
+
+    def on_write(self, conversation_id: Optional[str], turn: Dict[str, Any]) -> None:
+        """
+        a response was written: add the turn if its conversation's index is loaded
+        """
+        index = self._indexes.get(conversation_id) if conversation_id else None
+        if index is None or not turn["response"]:
+            return
+        self.add_turns(index, [turn])
+        self.incremental_adds += 1
+
+    def invalidate(self, conversation_id: str) -> None:
+        with self._lock:
+            if self._indexes.pop(conversation_id, None) is not None:
+                self._bytes -= self._sizes.pop(conversation_id, 0)
+
+    def _usage(self) -> Iterable[Tuple[Tuple[str], float]]:
+        indexes = list(self._indexes.values())
+        yield ("conversations",), len(indexes)
+        yield ("turns",), sum(len(index) for index in indexes)
+        yield ("bytes",), self._bytes
+
+    def stats(self) -> Dict[str, Any]:
+        usage = {kind: value for (kind,), value in self._usage()}
+        return dict(
+            usage,
+            builds=self.builds,
+            evictions=self.evictions,
+            incremental_adds=self.incremental_adds,
+            embedder=type(embedder).__name__,
+            dim=embedder.dim,
+        )
+
+
+conversation_indexes = ConversationIndexStore(**RETRIEVAL_MEMORY)
+
+metrics_registry.gauge(
+    "retrieval_index_usage",
+    "Size of the loaded conversation vector indexes",
+    ["kind"],
+    collect=conversation_indexes._usage,
+)
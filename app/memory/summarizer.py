@@ -0,0 +1,154 @@
+import asyncio
+import contextvars
+import time
+from typing import Any, Dict, List, Optional
+
+from langchain.schema import AIMessage, HumanMessage, get_buffer_string
+
+from ..configs import logger, log_verbose, SUMMARY_MEMORY
+from ..db.repository.conversation_summary_repository import asave_summary
+from ..db.repository.message_repository import afilter_message_since
+from ..metrics import chat_stage_seconds, metrics_registry
+from .token_counter import count_tokens
+
+__all__ = ["ConversationSummarizer", "conversation_summarizer"]
+
+summary_runs = metrics_registry.counter(
+    "summary_memory_runs_total",
+    "Background conversation summaries by result (stored, conflict, error)",
+    ["result"],
+)
+
+
+class ConversationSummarizer:
+    """
+    Folds the older turns of a conversation's tail into its stored summary, in a background
+    task: at most one per conversation in this worker, and a summary built from an outdated
+    one (another worker was faster) is discarded.
+    The turns are read from the db after the `covered_messages` of the summary, at most
+    `message_limit` per run, so turns older than the loaded tail are folded too.
+    """
+
+    def __init__(
+        self,
+        message_limit: int = 20,
+        tail_token_threshold: int = 1000,
+        keep_turns: int = 2,
+        summary_max_tokens: int = 256,
+        summary_model: Optional[str] = None,
+    ):
+        self.message_limit = message_limit
+        self.tail_token_threshold = tail_token_threshold
+        self.keep_turns = keep_turns
+        self.summary_max_tokens = summary_max_tokens
+        self.summary_model = summary_model
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.stored = 0
+        self.conflicts = 0
+        self.errors = 0
+
+    def maybe_schedule(
+        self,
+        conversation_id: str,
+        model_name: str,
+        summary: Optional[Dict[str, Any]],
+        tail: List[Dict[str, Any]],
+        tail_tokens: int,
+        truncated: bool = False,
+    ) -> bool:
+        """
+        start summarizing if the tail (messages oldest first) is over the threshold, or
+        `truncated`: it is a full window that does not reach back to the summary
+        """
+        if (
+            not (truncated or tail_tokens > self.tail_token_threshold)
+            or len(tail) <= self.keep_turns
+            or conversation_id in self._tasks
+        ):
+            return False
+        # a fresh context: not part of the request's trace, nor of its write-behind batch
+        task = asyncio.get_running_loop().create_task(
+            self._summarize(conversation_id, model_name, summary),
+            context=contextvars.Context(),
+        )
+        self._tasks[conversation_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(conversation_id, None))
+        return True
+
+    async def _summarize(
+        self,
+        conversation_id: str,
+        model_name: str,
+        summary: Optional[Dict[str, Any]],
+    ) -> None:
+        from ..utils import get_ChatOpenAI, get_prompt_template
+
+        covered = summary["covered_messages"] if summary else 0
+        start = time.perf_counter()
+        try:
+            messages = await afilter_message_since(
+                conversation_id, covered, self.message_limit + self.keep_turns
+            )
+            # never fold the newest turns, they are sent verbatim
+            fold = messages[: min(self.message_limit, len(messages) - self.keep_turns)]
+            if not fold:
+                return
+            new_lines = []
+            for m in fold:
+                new_lines.append(HumanMessage(content=m["query"]))
+                new_lines.append(AIMessage(content=m["response"]))
+            prompt = get_prompt_template("summary", "default").format(
+                summary=summary["summary"] if summary else "",
+                new_lines=get_buffer_string(new_lines, human_prefix="Human", ai_prefix="Assistant"),
+            )
+            model = get_ChatOpenAI(
+                model_name=self.summary_model or model_name,
+                temperature=0,
+                max_tokens=self.summary_max_tokens,
+                streaming=False,
+                verbose=False,
+            )
+            text = (await model.apredict(prompt)).strip()
+            stored = await asave_summary(
+                conversation_id=conversation_id,
+                summary=text,
+                summary_tokens=count_tokens(text),
+                covered_message_id=fold[-1]["id"],
+                covered_messages=covered + len(fold),
+                expected_message_id=summary["covered_message_id"] if summary else None,
+            )
+        except Exception as e:
+            self.errors += 1
+            summary_runs.labels("error").inc()
+            msg = f"failed to summarize conversation {conversation_id}: {e}"
+            logger.error(f"{e.__class__.__name__}: {msg}", exc_info=e if log_verbose else None)
+            return
+        chat_stage_seconds.labels("summarize").observe(time.perf_counter() - start)
+        if stored:
+            self.stored += 1
+            summary_runs.labels("stored").inc()
+        else:
+            self.conflicts += 1
+            summary_runs.labels("conflict").inc()
+
+    async def wait(self, conversation_id: Optional[str] = None) -> None:
+        """
+        wait for the running summaries, of one conversation or of all
+        """
+        tasks = [self._tasks[conversation_id]] if conversation_id in self._tasks else []
+        if conversation_id is None:
+            tasks = list(self._tasks.values())
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": len(self._tasks),
+            "stored": self.stored,
+            "conflicts": self.conflicts,
+            "errors": self.errors,
+            "tail_token_threshold": self.tail_token_threshold,
+        }
+
+
+conversation_summarizer = ConversationSummarizer(**SUMMARY_MEMORY)
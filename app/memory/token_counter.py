@@ -0,0 +1,45 @@
+import threading
+from typing import Optional
+
+from ..configs import logger, log_verbose, TOKEN_ENCODING
+from ..upstream.rate_limiter import estimate_tokens
+
+__all__ = ["count_tokens", "ROLE_PREFIX_TOKENS"]
+
+# "Human: " / "AI: " and the newline get_buffer_string adds to every message
+ROLE_PREFIX_TOKENS = 3
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    import tiktoken
+
+                    _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+                except Exception as e:
+                    msg = f"failed to load tiktoken encoding {TOKEN_ENCODING}, estimating token counts: {e}"
+                    logger.warning(
+                        f"{e.__class__.__name__}: {msg}",
+                        exc_info=e if log_verbose else None,
+                    )
+                _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text: Optional[str]) -> int:
+    """
+    Tokens of a message text. Blocking (tiktoken), call it from a worker thread.
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
@@ -0,0 +1,84 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+__all__ = ["VectorIndex"]
+
+
+class VectorIndex:
+    """
+    Exact inner product search over normalized vectors kept in one contiguous float32
+    array, grown by doubling so appends are amortized O(1). Each row has an id, adding
+    an id again replaces its vector, removing one moves the last row into its place.
+    Not thread safe, callers lock.
+    """
+
+    def __init__(self, dim: int, capacity: int = 64):
+        self.dim = dim
+        self._vectors = np.empty((capacity, dim), dtype=np.float32)
+        self.ids: List[str] = []
+        self._positions: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, id: str) -> bool:
+        return id in self._positions
+
+    @property
+    def nbytes(self) -> int:
+        return self._vectors.nbytes
+
+    def position(self, id: str) -> Optional[int]:
+        return self._positions.get(id)
+
+    def add(self, ids: List[str], vectors: np.ndarray) -> None:
+        for id, vector in zip(ids, vectors):
+            position = self._positions.get(id)
+            if position is None:
+                position = len(self.ids)
+                if position == len(self._vectors):
+                    grown = np.empty((max(2 * position, 1), self.dim), dtype=np.float32)
+                    grown[:position] = self._vectors[:position]
+                    self._vectors = grown
+                self.ids.append(id)
+                self._positions[id] = position
+            self._vectors[position] = vector
+
+    def remove(self, id: str) -> Optional[int]:
+        """
+        remove a row, the last row takes its place. Return the position of the moved row,
+        None if nothing moved.
+        """
+        position = self._positions.pop(id, None)
+        if position is None:
+            return None
+        last = len(self.ids) - 1
+        last_id = self.ids.pop()
+        if position == last:
+            return None
+        self._vectors[position] = self._vectors[last]
+        self.ids[position] = last_id
+        self._positions[last_id] = position
+        return position
+
+    def search(
+        self, query: np.ndarray, k: int, exclude: Iterable[str] = (), min_score: float = -1.0
+    ) -> List[Tuple[int, float]]:
+        """
+        (position, score) of the `k` rows most similar to `query`, best first
+        """
+        size = len(self.ids)
+        if not size or k <= 0:
+            return []
+        scores = self._vectors[:size] @ query
+        for id in exclude:
+            position = self._positions.get(id)
+            if position is not None:
+                scores[position] = -np.inf
+        if k < size:
+            top = np.argpartition(-scores, k)[:k]
+            top = top[np.argsort(-scores[top])]
+        else:
+            top = np.argsort(-scores)
+        return [(int(p), float(scores[p])) for p in top if scores[p] >= min_score]
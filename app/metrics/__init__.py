@@ -0,0 +1,2 @@
+from .prometheus import *
+from .chat_metrics import *
@@ -0,0 +1,67 @@
+from typing import Iterable, Tuple
+
+from .prometheus import MetricsRegistry
+
+__all__ = [
+    "metrics_registry",
+    "chat_stage_seconds",
+    "chat_tokens",
+    "chat_inflight_streams",
+    "db_active_sessions",
+]
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+metrics_registry = MetricsRegistry()
+
+# stages: db_insert, history_load, prompt_build, upstream_ttft, generation, db_update, summarize (background)
+chat_stage_seconds = metrics_registry.histogram(
+    "chat_stage_duration_seconds",
+    "Time spent in each stage of a chat request",
+    ["stage"],
+    STAGE_BUCKETS,
+)
+chat_tokens = metrics_registry.counter(
+    "chat_tokens_total",
+    "Tokens sent to and generated by the upstream models (estimated when the upstream reports no usage)",
+    ["model", "kind"],
+)
+chat_inflight_streams = metrics_registry.gauge(
+    "chat_inflight_streams",
+    "Chat responses currently being streamed to clients",
+)
+db_active_sessions = metrics_registry.gauge(
+    "db_active_sessions",
+    "Open SQLAlchemy sessions",
+)
+
+
+def _pool_stats() -> Iterable[Tuple[Tuple[str], float]]:
+    from ..db.base import engine
+
+    pool = engine.pool
+    for stat in ("size", "checkedin", "checkedout", "overflow"):
+        method = getattr(pool, stat, None)
+        if method is not None:
+            yield (stat,), method()
+
+
+def _executor_stats() -> Iterable[Tuple[Tuple[str], float]]:
+    from ..db.session import db_executor
+
+    yield ("queued",), db_executor._work_queue.qsize()
+    yield ("threads",), len(db_executor._threads)
+
+
+metrics_registry.gauge(
+    "db_pool_connections",
+    "SQLAlchemy connection pool state",
+    ["state"],
+    collect=_pool_stats,
+)
+metrics_registry.gauge(
+    "db_executor_tasks",
+    "Work queued for and threads of the db thread pool",
+    ["state"],
+    collect=_executor_stats,
+)
@@ -0,0 +1,235 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "MetricsRegistry",
+    "DEFAULT_BUCKETS",
+]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """
+    Values are kept in one shard per thread, so recording never takes a lock:
+    a thread only writes to its own dict and a scrape sums the shards.
+    """
+
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: List[Dict] = []
+        # only taken when a thread records its first value
+        self._shards_lock = threading.Lock()
+
+    def _shard(self) -> Dict:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def labels(self, *values: str) -> "_Child":
+        """
+        the metric for one combination of label values, same as prometheus_client
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return _Child(self, tuple(str(v) for v in values))
+
+    def _merged(self) -> Dict[LabelValues, float]:
+        merged: Dict[LabelValues, float] = {}
+        for shard in list(self._shards):
+            for key, value in list(shard.items()):
+                merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, value in sorted(self._merged().items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(value)}")
+        return lines
+
+
+class _Child:
+    def __init__(self, metric: _Metric, key: LabelValues):
+        self.metric = metric
+        self.key = key
+
+    def inc(self, amount: float = 1) -> None:
+        self.metric._inc(self.key, amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self.metric._inc(self.key, -amount)
+
+    def observe(self, value: float) -> None:
+        self.metric._observe(self.key, value)
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _inc(self, key: LabelValues, amount: float) -> None:
+        shard = self._shard()
+        shard[key] = shard.get(key, 0) + amount
+
+    def inc(self, amount: float = 1) -> None:
+        self._inc((), amount)
+
+
+class Gauge(_Metric):
+    """
+    A gauge is either changed with inc/dec or read from `collect` at scrape time
+    """
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        collect: Optional[Callable[[], Iterable[Tuple[LabelValues, float]]]] = None,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def _inc(self, key: LabelValues, amount: float) -> None:
+        shard = self._shard()
+        shard[key] = shard.get(key, 0) + amount
+
+    def inc(self, amount: float = 1) -> None:
+        self._inc((), amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self._inc((), -amount)
+
+    def _merged(self) -> Dict[LabelValues, float]:
+        if self.collect is not None:
+            return {tuple(k): v for k, v in self.collect()}
+        return super()._merged()
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def _observe(self, key: LabelValues, value: float) -> None:
+        shard = self._shard()
+        counts = shard.get(key)
+        if counts is None:
+            # per bucket counts, then the sum of the observed values
+            counts = shard[key] = [0] * len(self.buckets) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def observe(self, value: float) -> None:
+        self._observe((), value)
+
+    def time(self):
+        return _Child(self, ()).time()
+
+    def _merged(self) -> Dict[LabelValues, List[float]]:
+        merged: Dict[LabelValues, List[float]] = {}
+        for shard in list(self._shards):
+            for key, counts in list(shard.items()):
+                total = merged.setdefault(key, [0] * len(counts))
+                for i, n in enumerate(list(counts)):
+                    total[i] += n
+        return merged
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, counts in sorted(self._merged().items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(counts[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (), collect=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, collect))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """
+        all metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
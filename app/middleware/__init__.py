@@ -0,0 +1,3 @@
+from .traffic_capture import *
+from .tracing import *
+from .profiling import *
@@ -0,0 +1,49 @@
+from ..profiling import ProfileBusy, ProfileForbidden, Profiler, profiler
+
+__all__ = ["RequestProfilingMiddleware"]
+
+
+class RequestProfilingMiddleware:
+    """
+    CPU profiles a request carrying the profiler's request header, for as long as
+    its response takes. The samples cover the whole process during that time.
+    The profile id is returned in the X-Profile-Id response header,
+    GET /debug/profile/{id} downloads the collapsed stacks.
+    """
+
+    def __init__(self, app, profiler: Profiler = profiler):
+        self.app = app
+        self.profiler = profiler
+        self.header = profiler.request_header.encode("latin-1")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        if self.header not in headers:
+            return await self.app(scope, receive, send)
+
+        try:
+            self.profiler.check(headers.get(b"x-admin-token", b"").decode("latin-1"))
+            sampler = self.profiler.start_sampler("request")
+        except (ProfileBusy, ProfileForbidden) as e:
+            reason = str(e).encode("latin-1")
+
+            async def unprofiled_send(message):
+                if message["type"] == "http.response.start":
+                    message["headers"] = list(message.get("headers", [])) + [(b"x-profile-error", reason)]
+                await send(message)
+
+            return await self.app(scope, receive, unprofiled_send)
+
+        async def profiled_send(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-profile-id", sampler.profile_id.encode())
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, profiled_send)
+        finally:
+            self.profiler.stop_sampler(sampler, path=scope["path"])
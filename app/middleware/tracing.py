@@ -0,0 +1,38 @@
+from ..tracing import Tracer, tracer
+
+__all__ = ["TracingMiddleware"]
+
+
+class TracingMiddleware:
+    """
+    Pure ASGI middleware starting a trace per request, finished (and tail sampled)
+    once the response, streamed or not, is fully sent
+    """
+
+    def __init__(self, app, tracer: Tracer = tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.tracer.traced_path(scope["path"]):
+            return await self.app(scope, receive, send)
+
+        trace = self.tracer.start_trace(f"{scope['method']} {scope['path']}")
+
+        async def traced_send(message):
+            if message["type"] == "http.response.start":
+                trace.root.set(status=message["status"])
+            elif message["type"] == "http.response.body" and "first_byte" not in trace.root.attributes:
+                trace.root.set(first_byte=True)
+                trace.root.event("first_byte")
+            await send(message)
+
+        error = None
+        try:
+            with self.tracer.activate(trace):
+                await self.app(scope, receive, traced_send)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.tracer.finish_trace(trace, error)
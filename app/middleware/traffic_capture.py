@@ -0,0 +1,249 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+from ..configs import TRAFFIC_CAPTURE
+
+__all__ = ["TrafficCapture", "TrafficCaptureMiddleware", "traffic_capture"]
+
+Redactor = Callable[[Dict[str, Any]], Optional[Dict[str, Any]]]
+
+
+class _CaptureFormatter(logging.Formatter):
+    """
+    Builds the JSONL line of a capture, in the listener thread
+    """
+
+    def __init__(self, capture: "TrafficCapture"):
+        super().__init__()
+        self.capture = capture
+
+    def format(self, record: logging.LogRecord) -> str:
+        # the rotating handler formats a record twice (rollover check and write)
+        if not hasattr(record, "line"):
+            record.line = self.capture.to_line(record.msg)
+        return record.line
+
+
+class _CaptureHandler(logging.handlers.QueueHandler):
+    def __init__(self, capture: "TrafficCapture", q: queue.Queue):
+        super().__init__(q)
+        self.capture = capture
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # formatting happens in the listener thread, not on the request path
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.capture.dropped += 1
+
+
+class _RotatingFileHandler(logging.handlers.RotatingFileHandler):
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            line = self.formatter.format(record)
+        except Exception:
+            # a failing redactor or an unserializable record must not stop the listener thread
+            self.formatter.capture.failed += 1
+            self.handleError(record)
+            return
+        if line:
+            super().emit(record)
+
+
+class TrafficCapture:
+    """
+    Records sampled requests (body, arrival time, status, time to first byte and
+    duration) to a rotating JSONL file, one line per request shaped like
+    requests.jsonl ({"request_id", "title", "body", ...}). Requests are only queued on
+    the request path, JSON encoding, redaction and file writes run in a background thread.
+    Redactors get the record and return it changed, or None to drop it.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        path: str = "logs/capture.jsonl",
+        paths: List[str] = ["/chat"],
+        sample_rate: float = 1.0,
+        max_bytes: int = 64 * 1024 * 1024,
+        backup_count: int = 5,
+        queue_size: int = 10000,
+        redact_fields: List[str] = [],
+        redact_headers: List[str] = ["authorization", "x-api-key", "cookie"],
+        headers: List[str] = ["user-agent", "x-request-timeout"],
+    ):
+        self.enabled = enabled
+        self.path = path
+        self.paths = set(paths)
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.queue_size = queue_size
+        self.redact_fields = set(redact_fields)
+        self.redact_headers = set(redact_headers)
+        self.headers = set(headers)
+        self.redactors: List[Redactor] = [self._redact_fields]
+        self.captured = 0
+        self.dropped = 0
+        self.redacted = 0
+        self.failed = 0
+        self._handler: Optional[_CaptureHandler] = None
+        self._listener: Optional[logging.handlers.QueueListener] = None
+
+    def add_redactor(self, redactor: Redactor) -> None:
+        """
+        redactors run in the writer thread, in the order they were added
+        """
+        self.redactors.append(redactor)
+
+    def _redact_fields(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        body = record.get("body")
+        if isinstance(body, dict):
+            for field in self.redact_fields & body.keys():
+                body[field] = "[REDACTED]"
+        return record
+
+    def sampled(self, path: str) -> bool:
+        return (
+            self._handler is not None
+            and path in self.paths
+            and (self.sample_rate >= 1 or random.random() < self.sample_rate)
+        )
+
+    def start(self) -> None:
+        if not self.enabled or self._listener is not None:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        file_handler = _RotatingFileHandler(
+            self.path,
+            maxBytes=self.max_bytes,
+            backupCount=self.backup_count,
+            encoding="utf-8",
+        )
+        file_handler.setFormatter(_CaptureFormatter(self))
+        q: queue.Queue = queue.Queue(self.queue_size)
+        self._handler = _CaptureHandler(self, q)
+        self._listener = logging.handlers.QueueListener(q, file_handler)
+        self._listener.start()
+
+    def stop(self) -> None:
+        """
+        write what is still queued and close the file
+        """
+        if self._listener is None:
+            return
+        self._handler = None
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
+        self._listener = None
+
+    def record(self, record: Dict[str, Any]) -> None:
+        handler = self._handler
+        if handler is None:
+            return
+        self.captured += 1
+        handler.handle(logging.makeLogRecord({"msg": record}))
+
+    def to_line(self, record: Dict[str, Any]) -> str:
+        """
+        the JSONL line of a raw record, "" if a redactor dropped it
+        """
+        raw = record.pop("raw_body", b"")
+        try:
+            record["body"] = json.loads(raw) if raw else None
+        except ValueError:
+            record["body"] = raw.decode("utf-8", "replace")
+        record["headers"] = {
+            k: "[REDACTED]" if k in self.redact_headers else v
+            for k, v in record["headers"].items()
+        }
+        for redactor in self.redactors:
+            record = redactor(record)
+            if record is None:
+                self.redacted += 1
+                return ""
+        return json.dumps(record, ensure_ascii=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "path": self.path,
+            "sample_rate": self.sample_rate,
+            "captured": self.captured,
+            "dropped": self.dropped,
+            "redacted": self.redacted,
+            "failed": self.failed,
+            "queued": self._handler.queue.qsize() if self._handler else 0,
+        }
+
+
+class TrafficCaptureMiddleware:
+    """
+    Pure ASGI middleware, so streamed responses pass through untouched
+    """
+
+    def __init__(self, app, capture: TrafficCapture):
+        self.app = app
+        self.capture = capture
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.capture.sampled(scope["path"]):
+            return await self.app(scope, receive, send)
+
+        arrival = time.time()
+        start = time.perf_counter()
+        chunks: List[bytes] = []
+        state = {"status": None, "ttfb": None, "bytes": 0}
+
+        async def capture_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                chunks.append(message.get("body", b""))
+            return message
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                body = message.get("body", b"")
+                if body and state["ttfb"] is None:
+                    state["ttfb"] = time.perf_counter() - start
+                state["bytes"] += len(body)
+            await send(message)
+
+        try:
+            await self.app(scope, capture_receive, capture_send)
+        finally:
+            wanted = self.capture.headers | self.capture.redact_headers
+            self.capture.record(
+                {
+                    "request_id": uuid.uuid4().hex,
+                    "title": f"{scope['method']} {scope['path']}",
+                    "raw_body": b"".join(chunks),
+                    "query_string": scope.get("query_string", b"").decode("latin-1"),
+                    "headers": {
+                        k.decode("latin-1"): v.decode("latin-1")
+                        for k, v in scope["headers"]
+                        if k.decode("latin-1") in wanted
+                    },
+                    "arrival": arrival,
+                    "status": state["status"],
+                    "ttfb": state["ttfb"],
+                    "duration": time.perf_counter() - start,
+                    "response_bytes": state["bytes"],
+                }
+            )
+
+
+traffic_capture = TrafficCapture(**TRAFFIC_CAPTURE)
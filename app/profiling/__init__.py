@@ -0,0 +1,3 @@
+from .profiler import *
+from .api import *
+from .watchdog import *
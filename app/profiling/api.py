@@ -0,0 +1,98 @@
+from typing import Literal, Optional
+
+from fastapi import Header, Query
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from ..schemas import BaseResponse
+from .profiler import ProfileBusy, ProfileForbidden, profiler
+
+__all__ = [
+    "profile_cpu",
+    "profile_memory_start",
+    "profile_memory_stop",
+    "profile_result",
+    "profile_status",
+]
+
+
+def _error(status_code: int, msg: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=status_code, content={"code": status_code, "msg": msg, "data": None}
+    )
+
+
+async def profile_cpu(
+    duration: float = Query(10, description="seconds to sample", gt=0),
+    interval: Optional[float] = Query(None, description="seconds between samples", gt=0),
+    main_thread_only: bool = Query(False, description="only sample the event loop thread"),
+    x_admin_token: Optional[str] = Header(None),
+):
+    """
+    Sample the CPU stacks of the process for `duration` seconds, returned as collapsed
+    stacks (flamegraph.pl, speedscope)
+    """
+    try:
+        profiler.check(x_admin_token)
+        result = await profiler.cpu(duration, interval, main_thread_only)
+    except ProfileForbidden as e:
+        return _error(403, str(e))
+    except ProfileBusy as e:
+        return _error(409, str(e))
+    return PlainTextResponse(result["collapsed"], headers={"X-Profile-Id": result["id"]})
+
+
+async def profile_memory_start(
+    frames: Optional[int] = Query(None, description="frames kept per allocation", ge=1),
+    x_admin_token: Optional[str] = Header(None),
+):
+    """
+    Start tracing allocations, the diff is taken by /debug/profile/memory/stop
+    """
+    try:
+        profiler.check(x_admin_token)
+        return BaseResponse(data=profiler.start_memory(frames))
+    except ProfileForbidden as e:
+        return _error(403, str(e))
+    except ProfileBusy as e:
+        return _error(409, str(e))
+
+
+async def profile_memory_stop(
+    top: int = Query(30, description="allocation sites returned", ge=1),
+    group_by: Literal["lineno", "filename", "traceback"] = Query("lineno"),
+    x_admin_token: Optional[str] = Header(None),
+):
+    """
+    The allocation sites that grew the most since /debug/profile/memory/start
+    """
+    try:
+        profiler.check(x_admin_token)
+        return BaseResponse(data=await profiler.stop_memory(top, group_by))
+    except ProfileForbidden as e:
+        return _error(403, str(e))
+    except ProfileBusy as e:
+        return _error(409, str(e))
+
+
+async def profile_status(x_admin_token: Optional[str] = Header(None)):
+    try:
+        profiler.check(x_admin_token)
+    except ProfileForbidden as e:
+        return _error(403, str(e))
+    return BaseResponse(data=profiler.stats())
+
+
+async def profile_result(profile_id: str, x_admin_token: Optional[str] = Header(None)):
+    """
+    A finished profile: collapsed stacks for cpu profiles, the top allocations for memory ones
+    """
+    try:
+        profiler.check(x_admin_token)
+    except ProfileForbidden as e:
+        return _error(403, str(e))
+    result = profiler.get(profile_id)
+    if result is None:
+        return _error(404, f"profile {profile_id} not found")
+    if result["kind"] == "cpu":
+        return PlainTextResponse(result["collapsed"], headers={"X-Profile-Id": result["id"]})
+    return BaseResponse(data=result)
@@ -0,0 +1,267 @@
+import asyncio
+import os
+import sys
+import sysconfig
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter, deque
+from typing import Any, Deque, Dict, List, Optional
+
+from ..configs import logger, PROFILING
+
+__all__ = ["ProfileBusy", "ProfileForbidden", "Profiler", "profiler"]
+
+_LIB_PATHS = sorted(
+    {p for p in (sysconfig.get_paths().get("purelib"), sysconfig.get_paths().get("stdlib")) if p},
+    key=len,
+    reverse=True,
+)
+
+
+class ProfileBusy(Exception):
+    """
+    another profile session is running
+    """
+
+
+class ProfileForbidden(Exception):
+    """
+    profiling is disabled or the admin token is wrong
+    """
+
+
+def _short_path(filename: str) -> str:
+    for prefix in _LIB_PATHS:
+        if filename.startswith(prefix):
+            return filename[len(prefix):].lstrip(os.sep)
+    cwd = os.getcwd()
+    if filename.startswith(cwd):
+        return filename[len(cwd):].lstrip(os.sep)
+    return filename
+
+
+class _Sampler(threading.Thread):
+    """
+    Statistical CPU profiler: every `interval` seconds the stacks of all threads are
+    read with sys._current_frames() and counted as collapsed stacks
+    ("thread;outer;...;inner count", the input of flamegraph.pl and speedscope).
+    """
+
+    def __init__(self, interval: float, main_thread_only: bool = False):
+        super().__init__(name="profiler", daemon=True)
+        self.profile_id = uuid.uuid4().hex
+        self.interval = interval
+        self.main_thread_only = main_thread_only
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.started = time.time()
+        self.ended: Optional[float] = None
+        self._labels: Dict[Any, str] = {}
+        self._stop_event = threading.Event()
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+            self._labels[code] = label
+        return label
+
+    def run(self) -> None:
+        me = threading.get_ident()
+        main = threading.main_thread().ident
+        while not self._stop_event.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me or (self.main_thread_only and ident != main):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+        self.ended = time.time()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+
+class Profiler:
+    """
+    One profile session at a time: a time-boxed CPU profile, a tracemalloc session
+    (allocation diff between its start and stop) or the CPU profile of one request.
+    Nothing runs, and nothing is hooked into the interpreter, outside of a session.
+    Finished profiles are kept for download, `max_results` of them.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        admin_token: str = "",
+        max_duration: float = 60,
+        interval: float = 0.01,
+        tracemalloc_frames: int = 1,
+        request_header: str = "x-debug-profile",
+        max_results: int = 20,
+    ):
+        self.enabled = enabled
+        self.admin_token = admin_token
+        self.max_duration = max_duration
+        self.interval = interval
+        self.tracemalloc_frames = tracemalloc_frames
+        self.request_header = request_header.lower()
+        self.results: Deque[Dict[str, Any]] = deque(maxlen=max_results)
+        self.session: Optional[str] = None
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._memory_started: Optional[float] = None
+        self._memory_timer: Optional[asyncio.TimerHandle] = None
+
+    def check(self, token: Optional[str]) -> None:
+        if not self.enabled:
+            raise ProfileForbidden("profiling is disabled")
+        if self.admin_token and token != self.admin_token:
+            raise ProfileForbidden("invalid admin token")
+
+    def _begin(self, kind: str) -> None:
+        # called on the event loop without awaiting in between, no lock needed
+        if self.session is not None:
+            raise ProfileBusy(f"a {self.session} profile is already running")
+        self.session = kind
+
+    def _store(self, kind: str, profile_id: Optional[str] = None, **result: Any) -> str:
+        profile_id = profile_id or uuid.uuid4().hex
+        self.results.append(dict(result, id=profile_id, kind=kind))
+        return profile_id
+
+    def get(self, profile_id: str) -> Optional[Dict[str, Any]]:
+        for result in self.results:
+            if result["id"] == profile_id:
+                return result
+        return None
+
+    def start_sampler(self, kind: str, interval: Optional[float] = None, main_thread_only: bool = False) -> _Sampler:
+        self._begin(kind)
+        sampler = _Sampler(max(interval or self.interval, 0.001), main_thread_only)
+        sampler.start()
+        return sampler
+
+    def stop_sampler(self, sampler: _Sampler, **info: Any) -> str:
+        """
+        stop a sampler, store its collapsed stacks and return their profile id
+        """
+        try:
+            sampler.stop()
+        finally:
+            self.session = None
+        return self._store(
+            "cpu",
+            sampler.profile_id,
+            started=sampler.started,
+            duration=round(sampler.ended - sampler.started, 3),
+            samples=sampler.samples,
+            interval=sampler.interval,
+            collapsed=sampler.collapsed(),
+            **info,
+        )
+
+    async def cpu(
+        self, duration: float, interval: Optional[float] = None, main_thread_only: bool = False
+    ) -> Dict[str, Any]:
+        """
+        sample the whole process for `duration` seconds
+        """
+        sampler = self.start_sampler("cpu", interval, main_thread_only)
+        try:
+            await asyncio.sleep(min(duration, self.max_duration))
+        finally:
+            # stopping joins the sampler thread, at most one interval
+            profile_id = self.stop_sampler(sampler)
+        return self.get(profile_id)
+
+    def start_memory(self, frames: Optional[int] = None) -> Dict[str, Any]:
+        self._begin("memory")
+        tracemalloc.start(max(frames or self.tracemalloc_frames, 1))
+        self._snapshot = tracemalloc.take_snapshot()
+        self._memory_started = time.time()
+        # never leave tracemalloc on, it slows every allocation down
+        self._memory_timer = asyncio.get_running_loop().call_later(self.max_duration, self._expire_memory)
+        return {"started": self._memory_started, "max_duration": self.max_duration}
+
+    def _expire_memory(self) -> None:
+        if self.session == "memory":
+            task = asyncio.ensure_future(self.stop_memory())
+            task.add_done_callback(self._memory_expired)
+
+    def _memory_expired(self, task: "asyncio.Future") -> None:
+        if not task.cancelled() and task.exception() is None:
+            profile_id = task.result()["id"]
+            logger.warning(f"memory profile stopped after {self.max_duration}s, result {profile_id}")
+
+    async def stop_memory(self, top: int = 30, group_by: str = "lineno") -> Dict[str, Any]:
+        """
+        the allocations that grew the most since start_memory. Snapshotting and diffing
+        a large heap takes seconds, it runs in an executor thread.
+        """
+        if self.session != "memory":
+            raise ProfileBusy("no memory profile is running")
+        # no other session starts and no second stop runs until the diff is stored
+        self.session = "memory_stop"
+        if self._memory_timer is not None:
+            self._memory_timer.cancel()
+            self._memory_timer = None
+        try:
+            loop = asyncio.get_running_loop()
+            profile_id = await loop.run_in_executor(None, self._stop_memory, top, group_by)
+        finally:
+            self.session = None
+        return self.get(profile_id)
+
+    def _stop_memory(self, top: int, group_by: str) -> str:
+        try:
+            snapshot = tracemalloc.take_snapshot()
+            traced, peak = tracemalloc.get_traced_memory()
+            overhead = tracemalloc.get_tracemalloc_memory()
+        finally:
+            tracemalloc.stop()
+        stats = snapshot.compare_to(self._snapshot, group_by)
+        self._snapshot = None
+        top_stats = [
+            {
+                "where": [f"{_short_path(f.filename)}:{f.lineno}" for f in stat.traceback],
+                "size_diff_kb": round(stat.size_diff / 1024, 1),
+                "size_kb": round(stat.size / 1024, 1),
+                "count_diff": stat.count_diff,
+                "count": stat.count,
+            }
+            for stat in stats[:top]
+        ]
+        profile_id = self._store(
+            "memory",
+            started=self._memory_started,
+            duration=round(time.time() - self._memory_started, 3),
+            traced_kb=round(traced / 1024, 1),
+            peak_kb=round(peak / 1024, 1),
+            tracemalloc_overhead_kb=round(overhead / 1024, 1),
+            top=top_stats,
+        )
+        return profile_id
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "session": self.session,
+            "results": [
+                {k: v for k, v in r.items() if k not in ("collapsed", "top")}
+                for r in self.results
+            ],
+        }
+
+
+profiler = Profiler(**PROFILING)
@@ -0,0 +1,218 @@
+import asyncio
+import sys
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from ..configs import logger, LOOP_WATCHDOG
+from ..metrics import metrics_registry
+from .profiler import _LIB_PATHS, _short_path
+
+__all__ = ["LoopStalled", "LoopWatchdog", "loop_watchdog"]
+
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+event_loop_lag = metrics_registry.histogram(
+    "event_loop_lag_seconds",
+    "Delay between scheduling a callback on the event loop and it running",
+    buckets=LAG_BUCKETS,
+)
+event_loop_stalls = metrics_registry.counter(
+    "event_loop_stalls_total",
+    "Event loop lags over the watchdog threshold",
+)
+
+
+class LoopStalled(AssertionError):
+    """
+    the event loop was blocked longer than allowed
+    """
+
+
+def _is_library(filename: str) -> bool:
+    return filename.startswith("<") or any(filename.startswith(p) for p in _LIB_PATHS)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{_short_path(code.co_filename)}:{frame.f_lineno} in {code.co_name}"
+
+
+class LoopWatchdog:
+    """
+    A thread posts a callback to the event loop every `interval` seconds and measures
+    how late it runs. When it is `threshold` seconds late the loop thread's stack is
+    captured, and stalls are aggregated by call site: the innermost frame of our own
+    code, and the library frame actually running (e.g. a sqlite commit).
+
+    In tests:
+
+        watchdog = LoopWatchdog(enabled=True, threshold=0.02, interval=0.005)
+        watchdog.start()
+        ... drive the hot path ...
+        watchdog.stop()
+        watchdog.check()  # raises LoopStalled listing the blocking call sites
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        interval: float = 0.05,
+        threshold: float = 0.1,
+        max_blockers: int = 100,
+        max_stack: int = 40,
+    ):
+        self.enabled = enabled
+        self.interval = interval
+        self.threshold = threshold
+        self.max_blockers = max_blockers
+        self.max_stack = max_stack
+        self.probes = 0
+        self.stalls = 0
+        self.max_lag = 0.0
+        self.lags: Deque[float] = deque(maxlen=1000)
+        self.blockers: Dict[str, Dict[str, Any]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+
+    def start(self, loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        """
+        start watching `loop`, by default the running loop (call it from the loop thread)
+        """
+        if not self.enabled or self._thread is not None:
+            return
+        self._loop = loop or asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def reset(self) -> None:
+        self.probes = 0
+        self.stalls = 0
+        self.max_lag = 0.0
+        self.lags.clear()
+        self.blockers.clear()
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            beat = threading.Event()
+            ran = []
+
+            def callback():
+                ran.append(time.perf_counter())
+                beat.set()
+
+            sent = time.perf_counter()
+            try:
+                self._loop.call_soon_threadsafe(callback)
+            except RuntimeError:
+                # the loop is closed
+                return
+            stack = None
+            if not beat.wait(self.threshold):
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is not None:
+                    stack = self._capture(frame)
+                while not beat.wait(self.interval):
+                    if self._stop_event.is_set():
+                        return
+            # when the loop ran the callback, not when this thread noticed
+            lag = ran[0] - sent
+            self._record(lag, stack)
+
+    def _capture(self, frame) -> List[Tuple[str, bool]]:
+        """
+        (label, is library code) of the frames, innermost first. Labelled right away,
+        the loop keeps running these frames.
+        """
+        frames = []
+        while frame is not None and len(frames) < self.max_stack:
+            frames.append((_frame_label(frame), _is_library(frame.f_code.co_filename)))
+            frame = frame.f_back
+        return frames
+
+    def _record(self, lag: float, frames: Optional[List[Tuple[str, bool]]]) -> None:
+        self.probes += 1
+        self.lags.append(lag)
+        self.max_lag = max(self.max_lag, lag)
+        event_loop_lag.observe(lag)
+        if lag < self.threshold or frames is None:
+            return
+        self.stalls += 1
+        event_loop_stalls.inc()
+        leaf = frames[0][0]
+        own = next((label for label, library in frames if not library), None)
+        site = f"{own} -> {leaf}" if own is not None and own != leaf else leaf
+        blocker = self.blockers.get(site)
+        if blocker is None:
+            if len(self.blockers) >= self.max_blockers:
+                site = "other"
+                blocker = self.blockers.get(site)
+            if blocker is None:
+                blocker = self.blockers[site] = {
+                    "site": site,
+                    "count": 0,
+                    "total_lag": 0.0,
+                    "max_lag": 0.0,
+                    "stack": [label for label, _ in reversed(frames)],
+                }
+        blocker["count"] += 1
+        blocker["total_lag"] += lag
+        if lag > blocker["max_lag"]:
+            blocker["max_lag"] = lag
+            blocker["stack"] = [label for label, _ in reversed(frames)]
+        logger.warning(f"event loop blocked for {lag * 1000:.0f}ms at {site}")
+
+    def top_blockers(self, limit: int = 10) -> List[Dict[str, Any]]:
+        blockers = sorted(self.blockers.values(), key=lambda b: b["total_lag"], reverse=True)
+        return [
+            dict(b, total_lag=round(b["total_lag"], 4), max_lag=round(b["max_lag"], 4))
+            for b in blockers[:limit]
+        ]
+
+    def check(self, max_lag: Optional[float] = None) -> None:
+        """
+        raise LoopStalled if the loop lagged more than `max_lag` seconds (default the threshold)
+        """
+        max_lag = self.threshold if max_lag is None else max_lag
+        if self.max_lag > max_lag:
+            sites = "\n".join(
+                f"  {b['count']}x, max {b['max_lag'] * 1000:.0f}ms: {b['site']}"
+                for b in self.top_blockers()
+            )
+            raise LoopStalled(
+                f"event loop blocked for {self.max_lag * 1000:.0f}ms (> {max_lag * 1000:.0f}ms)\n{sites}"
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        lags = sorted(self.lags)
+
+        def q(p: float) -> Optional[float]:
+            return round(lags[min(int(len(lags) * p / 100), len(lags) - 1)], 4) if lags else None
+
+        return {
+            "enabled": self.enabled,
+            "running": self._thread is not None,
+            "interval": self.interval,
+            "threshold": self.threshold,
+            "probes": self.probes,
+            "stalls": self.stalls,
+            "lag_p50": q(50),
+            "lag_p99": q(99),
+            "lag_max": round(self.max_lag, 4),
+            "top_blockers": self.top_blockers(),
+        }
+
+
+loop_watchdog = LoopWatchdog(**LOOP_WATCHDOG)
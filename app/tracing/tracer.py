@@ -0,0 +1,383 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Deque, Dict, List, Optional
+
+from ..configs import TRACING
+
+__all__ = ["Span", "Trace", "Tracer", "tracer"]
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+_current_span: ContextVar[Optional["Span"]] = ContextVar("span", default=None)
+
+
+def _span_id() -> str:
+    return f"{random.getrandbits(64):016x}"
+
+
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start", "end", "attributes", "events", "error")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.span_id = _span_id()
+        self.parent_id = parent_id
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.attributes = attributes
+        self.events: List[tuple] = []
+        self.error: Optional[str] = None
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def event(self, name: str, **attributes: Any) -> None:
+        self.events.append((name, time.perf_counter(), attributes))
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        if self.end is not None:
+            return
+        self.end = time.perf_counter()
+        if error is not None:
+            self.error = f"{error.__class__.__name__}: {error}"
+
+
+class Trace:
+    """
+    The spans of one request. Times are perf_counter values, `started` maps them to wall time.
+    """
+
+    def __init__(self, name: str, max_spans: int, attributes: Dict[str, Any]):
+        self.trace_id = uuid.uuid4().hex
+        self.started = time.time()
+        self.max_spans = max_spans
+        self.message_ids: List[str] = []
+        self.spans: List[Span] = []
+        self.dropped_spans = 0
+        self.kept_because: Optional[str] = None
+        self.root = Span(self, name, None, attributes)
+        self.spans.append(self.root)
+
+    def add(self, name: str, parent: Optional[Span], attributes: Dict[str, Any]) -> Optional[Span]:
+        if len(self.spans) >= self.max_spans:
+            self.dropped_spans += 1
+            return None
+        span = Span(self, name, (parent or self.root).span_id, attributes)
+        self.spans.append(span)
+        return span
+
+    @property
+    def duration(self) -> float:
+        return (self.root.end or time.perf_counter()) - self.root.start
+
+    def _wall(self, t: float) -> float:
+        return self.started + (t - self.root.start)
+
+    def waterfall(self) -> Dict[str, Any]:
+        """
+        the spans ordered by start, with offsets from the start of the request in ms
+        """
+        origin = self.root.start
+        depth = {}
+        spans = []
+        for span in sorted(self.spans, key=lambda s: s.start):
+            depth[span.span_id] = depth.get(span.parent_id, -1) + 1
+            end = span.end if span.end is not None else self.root.end
+            spans.append(
+                {
+                    "span_id": span.span_id,
+                    "parent_id": span.parent_id,
+                    "name": span.name,
+                    "depth": depth[span.span_id],
+                    "offset_ms": round((span.start - origin) * 1000, 3),
+                    "duration_ms": round((end - span.start) * 1000, 3) if end else None,
+                    "finished": span.end is not None,
+                    "attributes": span.attributes,
+                    "events": [
+                        dict(attrs, name=name, offset_ms=round((t - origin) * 1000, 3))
+                        for name, t, attrs in span.events
+                    ],
+                    "error": span.error,
+                }
+            )
+        return {
+            "trace_id": self.trace_id,
+            "message_ids": self.message_ids,
+            "name": self.root.name,
+            "start": self.started,
+            "duration_ms": round(self.duration * 1000, 3),
+            "kept_because": self.kept_because,
+            "dropped_spans": self.dropped_spans,
+            "spans": spans,
+        }
+
+    def to_otlp(self) -> Dict[str, Any]:
+        """
+        the trace as an OTLP/JSON ExportTraceServiceRequest
+        """
+
+        def attributes(attrs: Dict[str, Any]) -> List[Dict]:
+            result = []
+            for key, value in attrs.items():
+                if isinstance(value, bool):
+                    v = {"boolValue": value}
+                elif isinstance(value, int):
+                    v = {"intValue": str(value)}
+                elif isinstance(value, float):
+                    v = {"doubleValue": value}
+                else:
+                    v = {"stringValue": str(value)}
+                result.append({"key": key, "value": v})
+            return result
+
+        def nanos(t: float) -> str:
+            return str(int(self._wall(t) * 1e9))
+
+        spans = []
+        for span in self.spans:
+            attrs = dict(span.attributes)
+            if span is self.root and self.message_ids:
+                attrs["message_ids"] = ",".join(self.message_ids)
+            spans.append(
+                {
+                    "traceId": self.trace_id,
+                    "spanId": span.span_id,
+                    "parentSpanId": span.parent_id or "",
+                    "name": span.name,
+                    "kind": 2 if span is self.root else 1,
+                    "startTimeUnixNano": nanos(span.start),
+                    "endTimeUnixNano": nanos(span.end or self.root.end or span.start),
+                    "attributes": attributes(attrs),
+                    "events": [
+                        {"timeUnixNano": nanos(t), "name": name, "attributes": attributes(a)}
+                        for name, t, a in span.events
+                    ],
+                    "status": {"code": 2, "message": span.error} if span.error else {"code": 0},
+                }
+            )
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": attributes({"service.name": "chatApp"})},
+                    "scopeSpans": [{"scope": {"name": "app.tracing"}, "spans": spans}],
+                }
+            ]
+        }
+
+
+class _OTLPFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(record.msg, ensure_ascii=False)
+
+
+class _ExportHandler(logging.handlers.QueueHandler):
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # encoded in the listener thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class Tracer:
+    """
+    Lightweight span tracing. A trace is started per request (TracingMiddleware) and
+    propagated with contextvars, so spans opened in the request, in the tasks it
+    starts and in callbacks running in those tasks attach to it. Without a current
+    trace every call is a no-op.
+
+    Traces are tail sampled once the request is over: failed requests and those slower
+    than `slow_threshold` seconds are kept, others with probability `sample_rate`.
+    Kept traces go to a ring buffer of `max_traces` and, with `otlp_path`, to a file as
+    OTLP/JSON lines written by a background thread.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        paths: List[str] = ["/chat"],
+        slow_threshold: float = 2.0,
+        sample_rate: float = 0.01,
+        max_traces: int = 1000,
+        max_spans: int = 512,
+        otlp_path: Optional[str] = None,
+    ):
+        self.enabled = enabled
+        self.paths = set(paths)
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+        self.max_spans = max_spans
+        self.otlp_path = otlp_path
+        self.traces: Deque[Trace] = deque(maxlen=max_traces)
+        self.started = 0
+        self.kept = 0
+        self._handler: Optional[_ExportHandler] = None
+        self._listener: Optional[logging.handlers.QueueListener] = None
+
+    def start(self) -> None:
+        if not self.enabled or not self.otlp_path or self._listener is not None:
+            return
+        os.makedirs(os.path.dirname(self.otlp_path) or ".", exist_ok=True)
+        file_handler = logging.FileHandler(self.otlp_path, encoding="utf-8")
+        file_handler.setFormatter(_OTLPFormatter())
+        q: queue.Queue = queue.Queue(10000)
+        self._handler = _ExportHandler(q)
+        self._listener = logging.handlers.QueueListener(q, file_handler)
+        self._listener.start()
+
+    def stop(self) -> None:
+        if self._listener is None:
+            return
+        self._handler = None
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
+        self._listener = None
+
+    def traced_path(self, path: str) -> bool:
+        return self.enabled and path in self.paths
+
+    def start_trace(self, name: str, **attributes: Any) -> Trace:
+        self.started += 1
+        return Trace(name, self.max_spans, attributes)
+
+    @contextmanager
+    def activate(self, trace: Trace):
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            _current_trace.reset(token)
+
+    def finish_trace(self, trace: Trace, error: Optional[BaseException] = None) -> None:
+        trace.root.finish(error)
+        if trace.root.error or (trace.root.attributes.get("status") or 0) >= 500:
+            trace.kept_because = "error"
+        elif trace.duration >= self.slow_threshold:
+            trace.kept_because = "slow"
+        elif random.random() < self.sample_rate:
+            trace.kept_because = "sampled"
+        else:
+            return
+        self.kept += 1
+        self.traces.append(trace)
+        handler = self._handler
+        if handler is not None:
+            handler.handle(logging.makeLogRecord({"msg": trace.to_otlp()}))
+
+    @staticmethod
+    def current() -> Optional[Trace]:
+        return _current_trace.get()
+
+    def start_span(self, name: str, **attributes: Any) -> Optional[Span]:
+        """
+        a span to finish explicitly, under the current span. None without a current trace
+        """
+        trace = _current_trace.get()
+        if trace is None:
+            return None
+        return trace.add(name, _current_span.get(), attributes)
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any):
+        """
+        with tracer.span("name") as span: ... spans opened inside are its children.
+        `span` is None when the request is not traced.
+        """
+        span = self.start_span(name, **attributes)
+        if span is None:
+            yield None
+            return
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.finish(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.finish()
+
+    def traced(self, name: str):
+        """
+        decorator running an async function in a span
+        """
+
+        def decorator(f):
+            @wraps(f)
+            async def wrapper(*args, **kwargs):
+                if _current_trace.get() is None:
+                    return await f(*args, **kwargs)
+                with self.span(name):
+                    return await f(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def annotate(self, **attributes: Any) -> None:
+        """
+        set attributes of the current trace's root span
+        """
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.root.set(**attributes)
+
+    def add_message_id(self, message_id: str) -> None:
+        trace = _current_trace.get()
+        if trace is not None and message_id:
+            trace.message_ids.append(message_id)
+
+    def find(self, id: str) -> Optional[Trace]:
+        """
+        the most recent kept trace of a message id or trace id
+        """
+        for trace in reversed(self.traces):
+            if trace.trace_id == id or id in trace.message_ids:
+                return trace
+        return None
+
+    def recent(self, limit: int = 50) -> List[Dict[str, Any]]:
+        return [
+            {
+                "trace_id": t.trace_id,
+                "message_ids": t.message_ids,
+                "name": t.root.name,
+                "start": t.started,
+                "duration_ms": round(t.duration * 1000, 3),
+                "kept_because": t.kept_because,
+            }
+            for t in list(self.traces)[-limit:][::-1]
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "slow_threshold": self.slow_threshold,
+            "sample_rate": self.sample_rate,
+            "started": self.started,
+            "kept": self.kept,
+            "buffered": len(self.traces),
+            "otlp_path": self.otlp_path,
+            "export_dropped": self._handler.dropped if self._handler else 0,
+        }
+
+
+tracer = Tracer(**TRACING)
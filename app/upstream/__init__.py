@@ -0,0 +1,4 @@
+from .client_pool import *
+from .scheduler import *
+from .rate_limiter import *
+from .router import *
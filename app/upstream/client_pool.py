@@ -0,0 +1,248 @@
+import asyncio
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+import openai
+
+from ..configs import logger, log_verbose, UPSTREAM_POOL
+from ..tracing import Span, tracer
+
+__all__ = [
+    "PoolStats",
+    "UpstreamClient",
+    "UpstreamClientRegistry",
+    "get_upstream_client",
+    "upstream_clients",
+]
+
+
+class PoolStats:
+    """
+    Counters of one upstream connection pool
+    """
+
+    def __init__(self, pool_size: int):
+        self.pool_size = pool_size
+        self.in_use = 0
+        self.requests = 0
+        self.waits = 0
+        self.connections_opened = 0
+
+    def begin(self) -> None:
+        self.requests += 1
+        if self.in_use >= self.pool_size:
+            # every connection is busy, this request has to wait for one
+            self.waits += 1
+        self.in_use += 1
+
+    def end(self) -> None:
+        self.in_use -= 1
+
+    async def trace(self, event_name: str, info: Dict) -> None:
+        # httpcore trace extension, called for every connection level event
+        if event_name == "connection.connect_tcp.complete":
+            self.connections_opened += 1
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, stats: PoolStats, span: Optional[Span] = None):
+        self._stream = stream
+        self._stats = stats
+        self._span = span
+        self._closed = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._stats.end()
+            if self._span is not None:
+                self._span.finish()
+        await self._stream.aclose()
+
+
+class _TrackedTransport(httpx.AsyncHTTPTransport):
+    """
+    AsyncHTTPTransport that keeps PoolStats up to date.
+    A request holds its connection until the response stream is closed.
+    """
+
+    def __init__(self, stats: PoolStats, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.stats.begin()
+        request.extensions["trace"] = self.stats.trace
+        span = tracer.start_span("upstream.http", url=str(request.url))
+        try:
+            response = await super().handle_async_request(request)
+        except BaseException as e:
+            self.stats.end()
+            if span is not None:
+                span.finish(e)
+            raise
+        if span is not None:
+            span.set(status=response.status_code)
+            span.event("response_headers")
+        response.stream = _TrackedStream(response.stream, self.stats, span)
+        return response
+
+    def connections(self) -> Tuple[int, int]:
+        """
+        return (open, idle) connection counts of the underlying pool
+        """
+        pool = getattr(self, "_pool", None)
+        conns = list(getattr(pool, "connections", []))
+        return len(conns), sum(1 for c in conns if c.is_idle())
+
+
+class UpstreamClient:
+    """
+    Long-lived openai clients for one model config, sharing pooled keep-alive connections.
+    """
+
+    def __init__(
+        self,
+        config: Dict,
+        pool_size: int = 100,
+        keepalive_expiry: float = 60,
+        warmup_connections: int = 0,
+        timeout: float = 120.0,
+        connect_timeout: float = 5.0,
+    ):
+        self.base_url = config.get("api_base_url")
+        self.warmup_connections = warmup_connections
+        self.stats = PoolStats(pool_size)
+        self.connect_timeout = connect_timeout
+        timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keepalive_expiry,
+        )
+        proxy = config.get("openai_proxy") or None
+        self.transport = _TrackedTransport(self.stats, limits=limits, proxy=proxy)
+        self.http_async_client = httpx.AsyncClient(
+            transport=self.transport, timeout=timeout
+        )
+        self.http_client = httpx.Client(
+            transport=httpx.HTTPTransport(limits=limits, proxy=proxy),
+            timeout=timeout,
+        )
+        client_params = dict(
+            api_key=config.get("api_key") or "EMPTY",
+            base_url=self.base_url,
+            timeout=timeout,
+        )
+        self.async_client = openai.AsyncOpenAI(
+            http_client=self.http_async_client, **client_params
+        )
+        self.client = openai.OpenAI(http_client=self.http_client, **client_params)
+
+    def async_client_with_timeout(
+        self, timeout: Optional[float] = None, max_retries: Optional[int] = None
+    ) -> openai.AsyncOpenAI:
+        """
+        the shared async client, with a per-request timeout and retry count if given
+        """
+        options = {}
+        if timeout:
+            options["timeout"] = httpx.Timeout(timeout, connect=min(self.connect_timeout, timeout))
+        if max_retries is not None:
+            options["max_retries"] = max_retries
+        if not options:
+            return self.async_client
+        return self.async_client.with_options(**options)
+
+    async def warmup(self) -> None:
+        """
+        open `warmup_connections` keep-alive connections ahead of the first request
+        """
+        if not self.base_url or self.warmup_connections <= 0:
+            return
+
+        async def connect():
+            try:
+                r = await self.http_async_client.get(
+                    self.base_url.rstrip("/") + "/models",
+                    headers={"Authorization": f"Bearer {self.async_client.api_key}"},
+                )
+                await r.aclose()
+            except Exception as e:
+                msg = f"failed to pre-connect to {self.base_url}: {e}"
+                logger.warning(
+                    f"{e.__class__.__name__}: {msg}",
+                    exc_info=e if log_verbose else None,
+                )
+
+        await asyncio.gather(*[connect() for _ in range(self.warmup_connections)])
+
+    async def aclose(self) -> None:
+        await self.http_async_client.aclose()
+        self.http_client.close()
+
+    def pool_stats(self) -> Dict[str, Any]:
+        opened, idle = self.transport.connections()
+        return {
+            "base_url": self.base_url,
+            "pool_size": self.stats.pool_size,
+            "in_use": self.stats.in_use,
+            "idle": idle,
+            "open": opened,
+            "waits": self.stats.waits,
+            "requests": self.stats.requests,
+            "connections_opened": self.stats.connections_opened,
+        }
+
+
+class UpstreamClientRegistry:
+    """
+    One UpstreamClient per distinct model config (base url, api key, proxy).
+    """
+
+    def __init__(self, **pool_kwargs: Any):
+        self.pool_kwargs = pool_kwargs
+        self._clients: Dict[Tuple, UpstreamClient] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(config: Dict) -> Tuple:
+        return (
+            config.get("api_base_url"),
+            config.get("api_key"),
+            config.get("openai_proxy") or None,
+        )
+
+    def get(self, config: Dict) -> UpstreamClient:
+        key = self._key(config)
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = UpstreamClient(config, **self.pool_kwargs)
+                    self._clients[key] = client
+        return client
+
+    async def warmup(self, configs) -> None:
+        await asyncio.gather(*[self.get(c).warmup() for c in configs])
+
+    async def aclose(self) -> None:
+        clients = list(self._clients.values())
+        self._clients.clear()
+        await asyncio.gather(*[c.aclose() for c in clients])
+
+    def stats(self):
+        return [c.pool_stats() for c in self._clients.values()]
+
+
+upstream_clients = UpstreamClientRegistry(**UPSTREAM_POOL)
+
+
+def get_upstream_client(config: Dict) -> UpstreamClient:
+    return upstream_clients.get(config)
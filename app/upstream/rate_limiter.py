@@ -0,0 +1,339 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from ..configs import RATE_LIMIT
+from ..db.session import run_in_db
+from .scheduler import SchedulerRejected, flow_config
+
+__all__ = [
+    "RateLimitExceeded",
+    "TokenBucket",
+    "Reservation",
+    "RateLimiter",
+    "rate_limiter",
+    "estimate_tokens",
+]
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    cheap token estimate (~4 characters per token), good enough to reserve budget
+    """
+    return len(text or "") // 4 + 1
+
+
+class RateLimitExceeded(SchedulerRejected):
+    pass
+
+
+class TokenBucket:
+    """
+    A per-minute budget that refills continuously
+    """
+
+    def __init__(self, per_minute: float, tokens: Optional[float] = None, updated: Optional[float] = None):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute if tokens is None else tokens
+        self.updated = time.time() if updated is None else updated
+
+    def resize(self, per_minute: float, now: float) -> None:
+        """
+        change the budget, keeping what has been taken from the bucket so far
+        """
+        self.refill(now)
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = min(self.tokens, per_minute)
+
+    def refill(self, now: float) -> None:
+        # `now` may be a little older than a bucket created by the same call
+        elapsed = max(now - self.updated, 0.0)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = max(now, self.updated)
+
+    def wait_time(self, amount: float) -> float:
+        """
+        seconds until `amount` can be taken, 0 if it can be taken now
+        """
+        # a single charge larger than the bucket only has to wait for a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+# (bucket name, per minute budget, amount)
+Charge = Tuple[str, float, float]
+
+
+class LocalBucketStore:
+    """
+    in-process buckets. A bucket unused for `idle_ttl` seconds is dropped once it has
+    refilled, a new bucket starts full just the same.
+    """
+
+    def __init__(self, idle_ttl: float = 300):
+        self.idle_ttl = idle_ttl
+        self._buckets: Dict[str, TokenBucket] = {}
+        # bucket name -> last use, least recently used first
+        self._used: "OrderedDict[str, float]" = OrderedDict()
+        self.evicted = 0
+
+    def _bucket(self, name: str, per_minute: float, now: float) -> TokenBucket:
+        bucket = self._buckets.get(name)
+        if bucket is None:
+            bucket = self._buckets[name] = TokenBucket(per_minute)
+        elif bucket.capacity != per_minute:
+            bucket.resize(per_minute, now)
+        self._used[name] = now
+        self._used.move_to_end(name)
+        return bucket
+
+    def _evict(self, now: float) -> None:
+        while self._used:
+            name, used = next(iter(self._used.items()))
+            if now - used <= self.idle_ttl:
+                return
+            bucket = self._buckets[name]
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._used[name], self._buckets[name]
+                self.evicted += 1
+            else:
+                # still paying back a settled overrun, look again later
+                self._used[name] = now
+                self._used.move_to_end(name)
+
+    async def take(self, charges: List[Charge]) -> Tuple[Optional[str], float]:
+        """
+        take every charge or none of them, return (name of the limiting bucket, wait seconds)
+        """
+        now = time.time()
+        self._evict(now)
+        buckets = []
+        for name, per_minute, amount in charges:
+            bucket = self._bucket(name, per_minute, now)
+            bucket.refill(now)
+            wait = bucket.wait_time(amount)
+            if wait > 0:
+                return name, wait
+            buckets.append((bucket, amount))
+        for bucket, amount in buckets:
+            bucket.tokens -= amount
+        return None, 0.0
+
+    async def adjust(self, name: str, per_minute: float, delta: float) -> None:
+        now = time.time()
+        bucket = self._bucket(name, per_minute, now)
+        bucket.refill(now)
+        bucket.tokens -= delta
+
+
+class SQLiteBucketStore:
+    """
+    buckets in a sqlite file shared by every worker process on the host
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limit_bucket "
+                "(name TEXT PRIMARY KEY, tokens REAL, updated REAL)"
+            )
+            self._local.conn = conn
+        return conn
+
+    def _load(self, conn, name: str, per_minute: float) -> TokenBucket:
+        row = conn.execute(
+            "SELECT tokens, updated FROM rate_limit_bucket WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            return TokenBucket(per_minute)
+        return TokenBucket(per_minute, tokens=min(row[0], per_minute), updated=row[1])
+
+    def _save(self, conn, name: str, bucket: TokenBucket) -> None:
+        conn.execute(
+            "INSERT OR REPLACE INTO rate_limit_bucket (name, tokens, updated) VALUES (?, ?, ?)",
+            (name, bucket.tokens, bucket.updated),
+        )
+
+    def _take(self, charges: List[Charge]) -> Tuple[Optional[str], float]:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            buckets = []
+            for name, per_minute, amount in charges:
+                bucket = self._load(conn, name, per_minute)
+                bucket.refill(now)
+                wait = bucket.wait_time(amount)
+                if wait > 0:
+                    conn.execute("ROLLBACK")
+                    return name, wait
+                buckets.append((name, bucket, amount))
+            for name, bucket, amount in buckets:
+                bucket.tokens -= amount
+                self._save(conn, name, bucket)
+            conn.execute("COMMIT")
+            return None, 0.0
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _adjust(self, name: str, per_minute: float, delta: float) -> None:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            bucket = self._load(conn, name, per_minute)
+            bucket.refill(time.time())
+            bucket.tokens -= delta
+            self._save(conn, name, bucket)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    async def take(self, charges: List[Charge]) -> Tuple[Optional[str], float]:
+        return await run_in_db(self._take, charges)
+
+    async def adjust(self, name: str, per_minute: float, delta: float) -> None:
+        await run_in_db(self._adjust, name, per_minute, delta)
+
+
+class Reservation:
+    """
+    Tokens charged for one upstream call, settled against the real usage when it ends
+    """
+
+    def __init__(self, limiter: Optional["RateLimiter"], tpm_buckets: List[Tuple[str, float]], prompt_tokens: int, estimated_tokens: int):
+        self.limiter = limiter
+        self.tpm_buckets = tpm_buckets
+        self.prompt_tokens = prompt_tokens
+        self.estimated_tokens = estimated_tokens
+        self.settled = False
+
+    async def settle(self, total_tokens: int) -> None:
+        """
+        charge the difference between the real and the estimated usage (a refund if negative)
+        """
+        if self.settled:
+            return
+        self.settled = True
+        delta = total_tokens - self.estimated_tokens
+        if self.limiter is None or not delta:
+            return
+        for name, per_minute in self.tpm_buckets:
+            await self.limiter.store.adjust(name, per_minute, delta)
+
+    async def settle_text(self, completion: str) -> None:
+        """
+        settle with an estimate of the completion when the provider reported no usage
+        """
+        await self.settle(self.prompt_tokens + estimate_tokens(completion))
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budgets per model and per client key.
+    A model's budget is its `models` entry, else the sum of the `rpm` / `tpm` of the
+    ONLINE_LLM_MODEL entries serving it (see model_limits), so it does not depend on
+    the backend a call ends up on. Tokens are reserved from an estimate of
+    prompt + max_tokens before the call and corrected afterwards.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        models: Dict[str, Dict[str, float]] = {},
+        keys: Dict[str, Dict[str, float]] = {},
+        default_key_limits: Dict[str, float] = {},
+        default_max_tokens: int = 512,
+        shared_db: Optional[str] = None,
+        bucket_idle_ttl: float = 300,
+    ):
+        self.enabled = enabled
+        self.models = models
+        self.keys = flow_config(keys)
+        self.default_key_limits = default_key_limits
+        self.default_max_tokens = default_max_tokens
+        self.store = (
+            SQLiteBucketStore(shared_db) if shared_db else LocalBucketStore(bucket_idle_ttl)
+        )
+        self.rejected = 0
+
+    def model_limits(self, model_name: str, backend_configs: List[Dict[str, Any]]) -> Dict[str, float]:
+        """
+        rpm / tpm budget of `model_name`: its `models` entry, else the sum over the configs
+        of its backends. A limit is left out (unlimited) if any backend does not set it.
+        """
+        if model_name in self.models:
+            return self.models[model_name]
+        limits = {}
+        for limit in ("rpm", "tpm"):
+            values = [config.get(limit) for config in backend_configs]
+            if values and all(values):
+                limits[limit] = sum(values)
+        return limits
+
+    async def reserve(
+        self,
+        model_name: str,
+        model_limits: Dict[str, float],
+        flow: str,
+        prompt_tokens: int,
+        max_tokens: Optional[int] = None,
+    ) -> Reservation:
+        """
+        Reserve budget for one call or raise RateLimitExceeded: 429 when the client key
+        is over budget, 503 when the model is.
+        """
+        estimated = prompt_tokens + (max_tokens or self.default_max_tokens)
+        if not self.enabled:
+            return Reservation(None, [], prompt_tokens, estimated)
+
+        key_limits = self.keys.get(flow, self.default_key_limits)
+        charges: List[Charge] = []
+        tpm_buckets = []
+        for scope, limits in [(f"model:{model_name}", model_limits), (flow, key_limits)]:
+            if limits.get("rpm"):
+                charges.append((f"{scope}:rpm", limits["rpm"], 1))
+            if limits.get("tpm"):
+                charges.append((f"{scope}:tpm", limits["tpm"], estimated))
+                tpm_buckets.append((f"{scope}:tpm", limits["tpm"]))
+
+        if charges:
+            name, wait = await self.store.take(charges)
+            if name is not None:
+                self.rejected += 1
+                retry_after = max(int(wait + 0.999), 1)
+                if name.startswith("model:"):
+                    raise RateLimitExceeded(
+                        503, f"model {model_name} is over its rate limit", retry_after
+                    )
+                raise RateLimitExceeded(429, "rate limit exceeded for this client", retry_after)
+        return Reservation(self, tpm_buckets, prompt_tokens, estimated)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {"enabled": self.enabled, "rejected": self.rejected}
+        if isinstance(self.store, LocalBucketStore):
+            now = time.time()
+            buckets = {}
+            for name, bucket in self.store._buckets.items():
+                bucket.refill(now)
+                buckets[name] = {"available": round(bucket.tokens, 1), "per_minute": bucket.capacity}
+            stats["buckets"] = buckets
+            stats["evicted"] = self.store.evicted
+        return stats
+
+
+rate_limiter = RateLimiter(**RATE_LIMIT)
@@ -0,0 +1,386 @@
+import asyncio
+import bisect
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+from langchain.callbacks import AsyncIteratorCallbackHandler
+from langchain.callbacks.base import AsyncCallbackHandler, BaseCallbackHandler
+from langchain.schema import LLMResult
+
+from ..configs import logger, MODEL_PRIVIDER, ONLINE_LLM_MODEL, MODEL_ROUTER
+from ..metrics import chat_stage_seconds, chat_tokens
+from ..tracing import tracer
+from .rate_limiter import estimate_tokens
+
+__all__ = [
+    "NoBackendAvailable",
+    "BackendStats",
+    "ModelRouter",
+    "model_router",
+]
+
+# upper bounds (seconds) of the time-to-first-token histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, float("inf")]
+
+
+class NoBackendAvailable(Exception):
+    pass
+
+
+class BackendStats:
+    """
+    Latency, error rate and circuit breaker of one ONLINE_LLM_MODEL entry
+    """
+
+    def __init__(self, name: str, alpha: float, failure_threshold: int, cooldown: float, window: int = 200):
+        self.name = name
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.ewma_ttft: Optional[float] = None
+        self.ewma_error = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        # "closed" (healthy), "open" (ejected) or "half_open" (one probe allowed)
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+        self._recent: Deque[float] = deque(maxlen=window)
+
+    def available(self, now: float) -> bool:
+        if self.state == "open" and now - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+        if self.state == "half_open":
+            # a single probe at a time decides whether to close the breaker again
+            return self.in_flight == 0
+        return self.state == "closed"
+
+    def score(self, error_penalty: float) -> float:
+        # backends without samples score 0 so they get tried
+        return (self.ewma_ttft or 0.0) * (1 + self.in_flight) * (1 + error_penalty * self.ewma_error)
+
+    def record_ttft(self, ttft: float) -> None:
+        self.ewma_ttft = ttft if self.ewma_ttft is None else self.alpha * ttft + (1 - self.alpha) * self.ewma_ttft
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, ttft)] += 1
+        self._recent.append(ttft)
+
+    def record_success(self) -> Optional[str]:
+        self.ewma_error = (1 - self.alpha) * self.ewma_error
+        self.consecutive_failures = 0
+        if self.state != "closed":
+            self.state = "closed"
+            return "closed"
+        return None
+
+    def record_failure(self) -> Optional[str]:
+        self.failures += 1
+        self.ewma_error = self.alpha + (1 - self.alpha) * self.ewma_error
+        self.consecutive_failures += 1
+        if self.state == "half_open" or (
+            self.state == "closed" and self.consecutive_failures >= self.failure_threshold
+        ):
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            return "open"
+        return None
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._recent:
+            return None
+        samples = sorted(self._recent)
+        return samples[min(int(len(samples) * q / 100), len(samples) - 1)]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "requests": self.requests,
+            "failures": self.failures,
+            "in_flight": self.in_flight,
+            "ewma_ttft": round(self.ewma_ttft, 4) if self.ewma_ttft is not None else None,
+            "ewma_error_rate": round(self.ewma_error, 4),
+            "ttft_p50": self.percentile(50),
+            "ttft_p95": self.percentile(95),
+            "ttft_histogram": {
+                ("+Inf" if b == float("inf") else str(b)): n
+                for b, n in zip(LATENCY_BUCKETS, self.histogram)
+            },
+        }
+
+
+class _Attempt(AsyncCallbackHandler):
+    """
+    One upstream call of a routed request. Its tokens reach the request's
+    callback only if it is the first attempt to produce a token.
+    """
+
+    def __init__(self, race: "_Race", backend: str, hedge: bool):
+        self.race = race
+        self.backend = backend
+        self.hedge = hedge
+        self.started = time.monotonic()
+        self.first_token = False
+        self.prompts: List[str] = []
+        self.task: Optional[asyncio.Task] = None
+
+    async def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> None:
+        self.prompts = prompts
+
+    async def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        if self.race.winner not in (None, self):
+            return
+        model_name = self.race.model_name
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if usage.get("completion_tokens"):
+            prompt_tokens = usage.get("prompt_tokens", 0)
+            completion_tokens = usage["completion_tokens"]
+        else:
+            # streamed responses carry no usage
+            prompt_tokens = sum(estimate_tokens(p) for p in self.prompts)
+            completion_tokens = sum(estimate_tokens(g.text) for g in response.generations[0])
+        chat_tokens.labels(model_name, "prompt").inc(prompt_tokens)
+        chat_tokens.labels(model_name, "completion").inc(completion_tokens)
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if not self.first_token:
+            self.first_token = True
+            self.race.router.backend_stats(self.backend).record_ttft(time.monotonic() - self.started)
+            if self.race.winner is None:
+                self.race.win(self)
+        if self.race.winner is self:
+            await self.race.callback.on_llm_new_token(token, **kwargs)
+
+
+class _Race:
+    def __init__(self, router: "ModelRouter", model_name: str, callback: AsyncIteratorCallbackHandler):
+        self.router = router
+        self.model_name = model_name
+        self.callback = callback
+        self.attempts: List[_Attempt] = []
+        self.winner: Optional[_Attempt] = None
+        self.decided = asyncio.Event()
+        self.last_error: Optional[BaseException] = None
+        self.hedged = False
+        self.started = time.monotonic()
+
+    def win(self, attempt: _Attempt) -> None:
+        self.winner = attempt
+        self.decided.set()
+        now = time.monotonic()
+        chat_stage_seconds.labels("upstream_ttft").observe(now - self.started)
+        for other in self.attempts:
+            if other is not attempt and other.task is not None:
+                if not other.first_token and not other.task.done():
+                    # lost the race, its first token would have come later than this
+                    self.router.backend_stats(other.backend).record_ttft(now - other.started)
+                other.task.cancel()
+        if attempt.hedge:
+            self.router.hedges_won += 1
+
+
+class ModelRouter:
+    """
+    Resolves a model name to the ONLINE_LLM_MODEL entries (backends) serving it and
+    sends each call to the backend with the best EWMA time-to-first-token and error
+    rate. Backends failing `failure_threshold` times in a row are ejected for
+    `cooldown` seconds. A call failing before its first token fails over to the
+    next backend, and with `hedge` enabled a slow first token starts a second call
+    on another backend, whichever answers first is kept.
+    """
+
+    def __init__(
+        self,
+        routes: Dict[str, List[str]] = {},
+        ewma_alpha: float = 0.3,
+        error_penalty: float = 4.0,
+        failure_threshold: int = 3,
+        cooldown: float = 30.0,
+        max_attempts: int = 2,
+        hedge: bool = False,
+        hedge_percentile: float = 95,
+        hedge_min_delay: float = 0.5,
+        max_events: int = 100,
+    ):
+        self.routes = routes
+        self.ewma_alpha = ewma_alpha
+        self.error_penalty = error_penalty
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_attempts = max_attempts
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.events: Deque[Dict[str, Any]] = deque(maxlen=max_events)
+        self.hedges = 0
+        self.hedges_won = 0
+        self.failovers = 0
+        self._stats: Dict[str, BackendStats] = {}
+
+    def backends(self, model_name: Optional[str]) -> List[str]:
+        """
+        ONLINE_LLM_MODEL entries serving `model_name`, in configured order
+        """
+        if model_name in self.routes:
+            return list(self.routes[model_name])
+        if model_name in ONLINE_LLM_MODEL:
+            return [model_name]
+        backends = [
+            name
+            for name, config in ONLINE_LLM_MODEL.items()
+            if config.get("model_name") == model_name and config.get("api_base_url")
+        ]
+        return backends or [MODEL_PRIVIDER]
+
+    def backend_stats(self, backend: str) -> BackendStats:
+        stats = self._stats.get(backend)
+        if stats is None:
+            stats = BackendStats(backend, self.ewma_alpha, self.failure_threshold, self.cooldown)
+            self._stats[backend] = stats
+        return stats
+
+    def pick(self, model_name: str, exclude: List[str] = ()) -> Optional[str]:
+        """
+        the available backend with the lowest score, None if all are ejected or excluded
+        """
+        now = time.monotonic()
+        candidates = [
+            (self.backend_stats(b).score(self.error_penalty), i, b)
+            for i, b in enumerate(self.backends(model_name))
+            if b not in exclude and self.backend_stats(b).available(now)
+        ]
+        return min(candidates)[2] if candidates else None
+
+    def preferred(self, model_name: Optional[str]) -> str:
+        """
+        the healthy backend with the lowest score, else the first one, for callers that
+        only need its config: unlike pick, an ejected backend is not moved to half_open
+        (which would take its single probe)
+        """
+        backends = self.backends(model_name)
+        candidates = [
+            (stats.score(self.error_penalty) if stats else 0.0, i, b)
+            for i, b in enumerate(backends)
+            for stats in [self._stats.get(b)]
+            if stats is None or stats.state == "closed"
+        ]
+        return min(candidates)[2] if candidates else backends[0]
+
+    def _event(self, backend: str, state: str, error: Optional[BaseException] = None) -> None:
+        event = {"time": time.time(), "backend": backend, "state": state}
+        if error is not None:
+            event["error"] = f"{error.__class__.__name__}: {error}"
+        self.events.append(event)
+        if state == "open":
+            logger.warning(f"upstream backend {backend} ejected after {event.get('error')}")
+        else:
+            logger.info(f"upstream backend {backend} is back")
+
+    def _hedge_delay(self, backend: str) -> float:
+        percentile = self.backend_stats(backend).percentile(self.hedge_percentile)
+        return max(self.hedge_min_delay, percentile or 0.0)
+
+    def _launch(self, race: _Race, call: Callable, hedge: bool = False) -> bool:
+        tried = [a.backend for a in race.attempts]
+        if len(tried) >= self.max_attempts:
+            return False
+        backend = self.pick(race.model_name, tried)
+        if backend is None:
+            return False
+        attempt = _Attempt(race, backend, hedge)
+        attempt.task = asyncio.create_task(self._run_attempt(attempt, call))
+        race.attempts.append(attempt)
+        return True
+
+    async def _run_attempt(self, attempt: _Attempt, call: Callable) -> Any:
+        stats = self.backend_stats(attempt.backend)
+        stats.requests += 1
+        stats.in_flight += 1
+        try:
+            with tracer.span("upstream.attempt", backend=attempt.backend, hedge=attempt.hedge):
+                result = await call(attempt.backend, [attempt])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            attempt.race.last_error = e
+            if stats.record_failure() == "open":
+                self._event(attempt.backend, "open", e)
+            raise
+        finally:
+            stats.in_flight -= 1
+        if stats.record_success() == "closed":
+            self._event(attempt.backend, "closed")
+        return result
+
+    async def acall(
+        self,
+        model_name: str,
+        call: Callable[[str, List[BaseCallbackHandler]], Awaitable],
+        callback: AsyncIteratorCallbackHandler,
+    ) -> Any:
+        """
+        Run `call(backend, callbacks)` on the best backend of `model_name`, streaming
+        the tokens of the winning attempt to `callback`.
+        """
+        race = _Race(self, model_name, callback)
+        if not self._launch(race, call):
+            raise NoBackendAvailable(f"no available backend for model {model_name}")
+        decided = asyncio.create_task(race.decided.wait())
+        try:
+            while race.winner is None:
+                pending = {a.task for a in race.attempts if not a.task.done()}
+                if not pending:
+                    # every attempt failed before its first token
+                    if not self._launch(race, call):
+                        raise race.last_error or NoBackendAvailable(
+                            f"no available backend for model {model_name}"
+                        )
+                    self.failovers += 1
+                    continue
+                timeout = None
+                if self.hedge and not race.hedged:
+                    first = race.attempts[-1]
+                    timeout = max(first.started + self._hedge_delay(first.backend) - time.monotonic(), 0)
+                done, _ = await asyncio.wait(
+                    pending | {decided}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    # the first token is late, race a second backend (only once)
+                    race.hedged = True
+                    if self._launch(race, call, hedge=True):
+                        self.hedges += 1
+                for attempt in race.attempts:
+                    if (
+                        race.winner is None
+                        and attempt.task.done()
+                        and not attempt.task.cancelled()
+                        and attempt.task.exception() is None
+                    ):
+                        # finished without streaming a token (e.g. an empty answer)
+                        race.win(attempt)
+            result = await race.winner.task
+            chat_stage_seconds.labels("generation").observe(time.monotonic() - race.started)
+            return result
+        finally:
+            decided.cancel()
+            for attempt in race.attempts:
+                if not attempt.task.done():
+                    attempt.task.cancel()
+            for attempt in race.attempts:
+                if attempt is not race.winner and attempt.task.done() and not attempt.task.cancelled():
+                    # retrieve the exceptions of failed attempts
+                    attempt.task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hedge": self.hedge,
+            "hedges": self.hedges,
+            "hedges_won": self.hedges_won,
+            "failovers": self.failovers,
+            "backends": {name: stats.stats() for name, stats in self._stats.items()},
+            "events": list(self.events),
+        }
+
+
+model_router = ModelRouter(**MODEL_ROUTER)
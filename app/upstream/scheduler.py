@@ -0,0 +1,324 @@
+import asyncio
+import hashlib
+import heapq
+import itertools
+import math
+import time
+from collections import defaultdict, deque
+from typing import Any, Dict, List, Optional
+
+from ..configs import SCHEDULER
+
+__all__ = [
+    "SchedulerRejected",
+    "Ticket",
+    "ChatScheduler",
+    "chat_scheduler",
+    "get_flow_id",
+    "flow_config",
+]
+
+
+class SchedulerRejected(Exception):
+    """
+    raised when a request is not admitted, carries the http status to answer with
+    """
+
+    def __init__(self, status_code: int, msg: str, retry_after: int):
+        super().__init__(msg)
+        self.status_code = status_code
+        self.msg = msg
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """
+    A request's place in a model queue, and once granted, its concurrency slot
+    """
+
+    def __init__(
+        self,
+        scheduler: Optional["ChatScheduler"],
+        model_name: str,
+        flow: str,
+        lane: str,
+        deadline: Optional[float],
+    ):
+        self.scheduler = scheduler
+        self.model_name = model_name
+        self.flow = flow
+        self.lane = lane
+        self.deadline = deadline
+        self.start_tag = 0.0
+        self.queued = False
+        self.granted = False
+        self.released = False
+        self.future: Optional[asyncio.Future] = None
+        self.enqueued_at = time.monotonic()
+
+    def release(self) -> None:
+        if self.granted and not self.released:
+            self.released = True
+            if self.scheduler is not None:
+                self.scheduler._release(self)
+
+
+class _Lane:
+    """
+    start-time fair queue of one traffic lane
+    """
+
+    def __init__(self, weight: float):
+        self.weight = weight
+        self.pass_ = 0.0
+        self.vtime = 0.0
+        self.flow_finish: Dict[str, float] = {}
+        self.heap: List = []
+
+    def push(self, ticket: Ticket, weight: float, seq: int) -> None:
+        start = max(self.vtime, self.flow_finish.get(ticket.flow, 0.0))
+        finish = start + 1.0 / weight
+        self.flow_finish[ticket.flow] = finish
+        ticket.start_tag = start
+        heapq.heappush(self.heap, (finish, seq, ticket))
+
+    def pop(self) -> Ticket:
+        _, _, ticket = heapq.heappop(self.heap)
+        self.vtime = ticket.start_tag
+        if not self.heap:
+            # idle lane, forget the flow history
+            self.flow_finish.clear()
+            self.vtime = 0.0
+        return ticket
+
+
+class _ModelQueue:
+    def __init__(self, max_concurrency: int, lanes: Dict[str, float]):
+        self.max_concurrency = max_concurrency
+        self.in_use = 0
+        self.queued = 0
+        self.flow_queued: Dict[str, int] = defaultdict(int)
+        self.lanes = {name: _Lane(weight) for name, weight in lanes.items()}
+
+
+class ChatScheduler:
+    """
+    Admission control for upstream generations.
+    Every model_name has a concurrency cap and a bounded queue. Queued requests are
+    ordered by weighted fair queuing across flows (api keys / conversations) inside
+    each lane, and lanes (interactive, batch) share the model by their weights.
+    Requests whose deadline passes while queued are dropped.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        max_concurrency: Dict[str, int] = {"default": 16},
+        max_queue: int = 256,
+        max_queue_per_flow: int = 32,
+        lanes: Dict[str, float] = {"interactive": 4, "batch": 1},
+        flow_weights: Dict[str, float] = {},
+        retry_after: int = 1,
+    ):
+        self.enabled = enabled
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_flow = max_queue_per_flow
+        self.lane_weights = lanes
+        self.flow_weights = flow_config(flow_weights)
+        self.retry_after = retry_after
+        self._models: Dict[str, _ModelQueue] = {}
+        self._seq = itertools.count()
+        self.admitted = 0
+        self.rejected = defaultdict(int)
+        self.expired = 0
+        self.wait_times: deque = deque(maxlen=2048)
+
+    def _model(self, model_name: str) -> _ModelQueue:
+        mq = self._models.get(model_name)
+        if mq is None:
+            cap = self.max_concurrency.get(
+                model_name, self.max_concurrency.get("default", 16)
+            )
+            mq = _ModelQueue(cap, self.lane_weights)
+            self._models[model_name] = mq
+        return mq
+
+    def _retry_after(self, mq: _ModelQueue) -> int:
+        # roughly how many "rounds" of the model's slots are queued ahead
+        return max(
+            self.retry_after,
+            math.ceil(self.retry_after * mq.queued / max(mq.max_concurrency, 1)),
+        )
+
+    def _reject(self, status_code: int, msg: str, mq: _ModelQueue) -> SchedulerRejected:
+        self.rejected[status_code] += 1
+        return SchedulerRejected(status_code, msg, self._retry_after(mq))
+
+    async def acquire(
+        self,
+        model_name: str,
+        flow: str,
+        lane: str = "interactive",
+        deadline: Optional[float] = None,
+    ) -> Ticket:
+        """
+        Wait for a concurrency slot of model_name. `deadline` is in event loop time.
+        Raise SchedulerRejected when the request can not be admitted.
+        """
+        if not self.enabled:
+            return Ticket(None, model_name, flow, lane, deadline)
+
+        loop = asyncio.get_running_loop()
+        mq = self._model(model_name)
+        if lane not in mq.lanes:
+            lane = next(iter(mq.lanes))
+        ticket = Ticket(self, model_name, flow, lane, deadline)
+
+        if mq.in_use < mq.max_concurrency and mq.queued == 0:
+            self._grant(mq, ticket)
+            self._record_wait(ticket)
+            return ticket
+
+        if mq.queued >= self.max_queue:
+            raise self._reject(503, f"model {model_name} is saturated", mq)
+        if mq.flow_queued[flow] >= self.max_queue_per_flow:
+            raise self._reject(429, "too many queued requests for this client", mq)
+
+        ticket.future = loop.create_future()
+        self._enqueue(mq, ticket)
+        timeout = None if deadline is None else max(deadline - loop.time(), 0)
+        try:
+            await asyncio.wait_for(ticket.future, timeout)
+        except asyncio.TimeoutError:
+            self._dequeued(mq, ticket)
+            self.expired += 1
+            raise self._reject(503, "deadline passed while queued", mq)
+        except asyncio.CancelledError:
+            if ticket.granted:
+                ticket.release()
+            else:
+                self._dequeued(mq, ticket)
+            raise
+        self._record_wait(ticket)
+        return ticket
+
+    def _enqueue(self, mq: _ModelQueue, ticket: Ticket) -> None:
+        lane = mq.lanes[ticket.lane]
+        if not lane.heap:
+            # a lane that becomes busy starts level with the busiest lane
+            active = [l.pass_ for l in mq.lanes.values() if l.heap]
+            lane.pass_ = max(lane.pass_, min(active)) if active else 0.0
+        weight = self.flow_weights.get(ticket.flow, 1.0)
+        lane.push(ticket, weight, next(self._seq))
+        ticket.queued = True
+        mq.queued += 1
+        mq.flow_queued[ticket.flow] += 1
+
+    def _dequeued(self, mq: _ModelQueue, ticket: Ticket) -> None:
+        # a ticket given up by its request stays in the heap and is skipped when popped
+        if ticket.queued:
+            ticket.queued = False
+            mq.queued -= 1
+            mq.flow_queued[ticket.flow] -= 1
+            if not mq.flow_queued[ticket.flow]:
+                del mq.flow_queued[ticket.flow]
+
+    def _grant(self, mq: _ModelQueue, ticket: Ticket) -> None:
+        mq.in_use += 1
+        ticket.granted = True
+        self.admitted += 1
+
+    def _record_wait(self, ticket: Ticket) -> None:
+        self.wait_times.append(time.monotonic() - ticket.enqueued_at)
+
+    def _release(self, ticket: Ticket) -> None:
+        mq = self._model(ticket.model_name)
+        mq.in_use -= 1
+        self._dispatch(mq)
+
+    def _dispatch(self, mq: _ModelQueue) -> None:
+        loop = asyncio.get_event_loop()
+        while mq.in_use < mq.max_concurrency:
+            lanes = [l for l in mq.lanes.values() if l.heap]
+            if not lanes:
+                return
+            lane = min(lanes, key=lambda l: l.pass_)
+            ticket = lane.pop()
+            if ticket.future.done():
+                # cancelled or timed out while queued
+                continue
+            lane.pass_ += 1.0 / lane.weight
+            self._dequeued(mq, ticket)
+            if ticket.deadline is not None and ticket.deadline <= loop.time():
+                self.expired += 1
+                ticket.future.set_exception(
+                    self._reject(503, "deadline passed while queued", mq)
+                )
+                continue
+            self._grant(mq, ticket)
+            ticket.future.set_result(ticket)
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self.wait_times)
+
+        def percentile(p):
+            return round(waits[min(int(len(waits) * p), len(waits) - 1)], 6) if waits else 0.0
+
+        return {
+            "enabled": self.enabled,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "expired": self.expired,
+            "queue_wait": {
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "p99": percentile(0.99),
+                "max": round(waits[-1], 6) if waits else 0.0,
+            },
+            "models": {
+                name: {
+                    "max_concurrency": mq.max_concurrency,
+                    "in_use": mq.in_use,
+                    "queued": mq.queued,
+                    "lanes": {n: len(l.heap) for n, l in mq.lanes.items()},
+                }
+                for name, mq in self._models.items()
+            },
+        }
+
+
+def _key_flow(api_key: str) -> str:
+    # flows show up in stats, never name them by the credential itself
+    return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+
+def get_flow_id(headers, conversation_id: str = "", client_host: str = "") -> str:
+    """
+    fairness key of a request: a digest of its api key, else its conversation, else the
+    client address
+    """
+    api_key = headers.get("x-api-key")
+    if not api_key:
+        auth = headers.get("authorization") or ""
+        if auth.lower().startswith("bearer "):
+            api_key = auth[7:].strip()
+    if api_key:
+        return _key_flow(api_key)
+    if conversation_id:
+        return f"conversation:{conversation_id}"
+    return f"client:{client_host}"
+
+
+def flow_config(config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    a per flow setting keyed by get_flow_id: "key:<api key>" entries are configured
+    with the key itself
+    """
+    return {
+        _key_flow(name[4:]) if name.startswith("key:") else name: value
+        for name, value in config.items()
+    }
+
+
+chat_scheduler = ChatScheduler(**SCHEDULER)
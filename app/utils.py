@@ -1,6 +1,7 @@
 from .configs import logger, log_verbose
 from .configs import MODEL_PRIVIDER, ONLINE_LLM_MODEL
 from .configs.server_config import HTTPX_DEFAULT_TIMEOUT,API_SERVER
+from .upstream import get_upstream_client, model_router
 import asyncio
 from typing import (
     Literal,
@@ -31,10 +32,12 @@ def get_prompt_template(type: str = "llm_chat", name: str = "default") -> Option
     return PROMPT_TEMPLATES[type].get(name)
 
 
-async def wrap_done(fn: Awaitable, event: asyncio.Event):
-    """Wrap an awaitable with a event to signal when it's done or an exception is raised."""
+async def wrap_done(fn: Awaitable, event: asyncio.Event) -> bool:
+    """Wrap an awaitable with a event to signal when it's done or an exception is raised.
+    Return True if the awaitable finished without error."""
     try:
         await fn
+        return True
     except Exception as e:
         logging.exception(e)
         # TODO: handle exception
@@ -42,6 +45,7 @@ async def wrap_done(fn: Awaitable, event: asyncio.Event):
         logger.error(
             f"{e.__class__.__name__}: {msg}", exc_info=e if log_verbose else None
         )
+        return False
     finally:
         # Signal the aiter to stop.
         event.set()
@@ -54,14 +58,21 @@ def get_ChatOpenAI(
     streaming: bool = True,
     callbacks: List[Callable] = [],
     verbose: bool = True,
+    timeout: Optional[float] = None,
+    backend: Optional[str] = None,
+    max_retries: Optional[int] = None,
     **kwargs: Any,
 ) -> ChatOpenAI:
-    config = get_model_worker_config(model_name)
+    config = get_model_worker_config(model_name, backend)
+    # reuse the pooled clients of this model config, only callbacks are per request
+    upstream = get_upstream_client(config)
 
     model = ChatOpenAI(
         streaming=streaming,
         verbose=verbose,
         callbacks=callbacks,
+        client=upstream.client.chat.completions,
+        async_client=upstream.async_client_with_timeout(timeout, max_retries).chat.completions,
         openai_api_key=config.get("api_key"),
         openai_api_base=config.get("api_base_url"),
         model_name=config.get("model_name"),
@@ -73,42 +84,14 @@ def get_ChatOpenAI(
     return model
 
 
-def get_model_worker_config(model_name: str = None) -> dict:
+def get_model_worker_config(model_name: str = None, backend: Optional[str] = None) -> dict:
     """
     Load the configuration items of the model worker.
-    Priority: FSCHAT_MODEL_WORKERS[model_name] > ONLINE_LLM_MODEL[model_name] > FSCHAT_MODEL_WORKERS["default"]
+    `backend` is the ONLINE_LLM_MODEL entry to use, by default the one the router prefers for `model_name`.
     """
-
-    # from server import model_workers
-
-    config = ONLINE_LLM_MODEL.get(MODEL_PRIVIDER)
-
-    """
-    config = FSCHAT_MODEL_WORKERS.get("default", {}).copy()
-    config.update(ONLINE_LLM_MODEL.get(model_name, {}).copy())
-    config.update(FSCHAT_MODEL_WORKERS.get(model_name, {}).copy())
-
-    if model_name in ONLINE_LLM_MODEL:
-        config["online_api"] = True
-        if provider := config.get("provider"):
-            try:
-                config["worker_class"] = getattr(model_workers, provider)
-            except Exception as e:
-                msg = f"在线模型 ‘{model_name}’ 的provider没有正确配置"
-                logger.error(
-                    f"{e.__class__.__name__}: {msg}",
-                    exc_info=e if log_verbose else None,
-                )
-
-    # local model
-    if model_name in MODEL_PATH["llm_model"]:
-        path = get_model_path(model_name)
-        config["model_path"] = path
-        if path and os.path.isdir(path):
-            config["model_path_exists"] = True
-        config["device"] = llm_device(config.get("device"))
-    """
-    return config
+    if backend is None:
+        backend = model_router.preferred(model_name)
+    return ONLINE_LLM_MODEL.get(backend) or ONLINE_LLM_MODEL.get(MODEL_PRIVIDER)
 
 
 def api_address() -> str:
@@ -232,13 +232,19 @@ def dialogue_page(api: ApiRequest, is_lite: bool = False):
                     temperature=0,
                 )
 
+                # Clicking reruns the page, which closes the stream;
+                # the server then cancels the generation and keeps the partial answer
+                stop_btn = st.empty()
+                stop_btn.button("Stop generating", key="stop_generating")
+
                 for t in r:
                     if error_msg := check_error_msg(t):  # check whether error occured
                         st.error(error_msg)
                         break
                     text += t.get("text", "")
                     chat_box.update_msg(text)
-                    message_id = t.get("message_id", "")
+                    message_id = t.get("message_id", message_id)
+                stop_btn.empty()
 
                 metadata = {
                     "message_id": message_id,
@@ -17,6 +17,25 @@ from app.utils import api_address, get_httpx_client
 from pprint import pprint
 
 
+def parse_stream_line(line: str, data_lines: List[str]) -> Optional[str]:
+    """
+    Feed one line of a server-sent-events stream, collecting `data:` lines in data_lines.
+    Return the payload once a frame is complete. Lines that are not SSE fields
+    (e.g. a non-streaming json response) are returned as they are.
+    """
+    if line.startswith("data:"):
+        data = line[5:]
+        data_lines.append(data[1:] if data.startswith(" ") else data)
+        return None
+    if not line:
+        payload = "\n".join(data_lines)
+        data_lines.clear()
+        return payload or None
+    if line.startswith(("event:", "id:", "retry:", ":")):
+        return None
+    return line
+
+
 class ApiRequest:
     def __init__(
         self,
@@ -121,7 +140,11 @@ class ApiRequest:
         async def ret_async(response, as_json):
             try:
                 async with response as r:
-                    async for chunk in r.aiter_text(None):
+                    chunks = r.aiter_lines() if as_json else r.aiter_text(None)
+                    data_lines = []
+                    async for chunk in chunks:
+                        if as_json:
+                            chunk = parse_stream_line(chunk, data_lines)
                         if not chunk:  # fastchat api yield empty bytes on start and end
                             continue
                         if as_json:
@@ -157,7 +180,11 @@ class ApiRequest:
         def ret_sync(response, as_json):
             try:
                 with response as r:
-                    for chunk in r.iter_text(None):
+                    chunks = r.iter_lines() if as_json else r.iter_text(None)
+                    data_lines = []
+                    for chunk in chunks:
+                        if as_json:
+                            chunk = parse_stream_line(chunk, data_lines)
                         if not chunk:  # fastchat api yield empty bytes on start and end
                             continue
                         if as_json:
@@ -0,0 +1,87 @@
+"""
+Compare a fresh upstream client per request (the old get_ChatOpenAI behaviour)
+with the shared pooled client, against a running stub server:
+
+    python -m benchmarks.stub_openai --port 9000 &
+    python -m benchmarks.client_pool --base-url http://127.0.0.1:9000/v1 -n 200 -c 20
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+import openai
+
+from app.upstream import UpstreamClient
+
+
+async def run(make_client, n: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            client, close = make_client()
+            start = time.perf_counter()
+            stream = await client.chat.completions.create(
+                model="stub",
+                messages=[{"role": "user", "content": "hello"}],
+                stream=True,
+            )
+            async for _ in stream:
+                pass
+            latencies.append(time.perf_counter() - start)
+            if close:
+                await close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(n)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "elapsed": round(elapsed, 3),
+        "p50": round(latencies[len(latencies) // 2], 4),
+        "p99": round(latencies[int(len(latencies) * 0.99) - 1], 4),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default="http://127.0.0.1:9000/v1")
+    parser.add_argument("-n", type=int, default=200)
+    parser.add_argument("-c", type=int, default=20)
+    args = parser.parse_args()
+
+    connects = {"fresh": 0}
+
+    async def trace(event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            connects["fresh"] += 1
+
+    async def add_trace(request):
+        request.extensions["trace"] = trace
+
+    def fresh_client():
+        http_client = httpx.AsyncClient(event_hooks={"request": [add_trace]})
+        client = openai.AsyncOpenAI(
+            api_key="EMPTY", base_url=args.base_url, http_client=http_client
+        )
+        return client, http_client.aclose
+
+    fresh = await run(fresh_client, args.n, args.c)
+    fresh["connections_opened"] = connects["fresh"]
+
+    upstream = UpstreamClient(
+        {"api_base_url": args.base_url}, pool_size=args.c, warmup_connections=args.c
+    )
+    await upstream.warmup()
+    pooled = await run(lambda: (upstream.async_client, None), args.n, args.c)
+    pooled.update(upstream.pool_stats())
+    await upstream.aclose()
+
+    print("fresh client per request:", fresh)
+    print("shared pooled client:   ", pooled)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
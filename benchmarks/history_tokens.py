@@ -0,0 +1,120 @@
+"""
+Time ConversationBufferDBMemory history loads as conversations grow, with the stored
+per-message token counts against the previous pruning (re-tokenizing the remaining
+buffer after every popped message):
+
+    python -m benchmarks.history_tokens --turns 10 100 1000 5000 --history-len 50
+    python -m benchmarks.history_tokens --history-len 0   # the whole conversation
+
+Writes to the configured database (SQLALCHEMY_DATABASE_URL), run it from a scratch
+directory with the default sqlite url. The conversations it creates are deleted.
+"""
+import argparse
+import statistics
+import time
+import uuid
+from typing import List
+
+from langchain.schema import AIMessage, HumanMessage, get_buffer_string
+from langchain_community.chat_models import ChatOpenAI
+
+from app.db.models.message_model import MessageModel
+from app.db.repository.message_repository import filter_message
+from app.db.session import session_scope
+from app.db.utlis import create_tables
+from app.memory.conversation_db_buffer_memory import ConversationBufferDBMemory
+from app.memory.token_counter import count_tokens
+
+
+def create_conversation(turns: int, words: int) -> str:
+    conversation_id = uuid.uuid4().hex
+    rows = []
+    for i in range(turns):
+        query = f"question {i} " + "lorem ipsum " * (words // 2)
+        response = f"answer {i} " + "dolor sit amet " * (words // 3)
+        rows.append(
+            {
+                "id": uuid.uuid4().hex,
+                "conversation_id": conversation_id,
+                "chat_type": "llm_chat",
+                "query": query,
+                "response": response,
+                "query_tokens": count_tokens(query),
+                "response_tokens": count_tokens(response),
+                "meta_data": {},
+            }
+        )
+    with session_scope() as session:
+        session.bulk_insert_mappings(MessageModel, rows)
+    return conversation_id
+
+
+def delete_conversation(conversation_id: str) -> None:
+    with session_scope() as session:
+        session.query(MessageModel).filter_by(conversation_id=conversation_id).delete()
+
+
+def legacy_buffer(memory: ConversationBufferDBMemory) -> List:
+    """
+    the pruning ConversationBufferDBMemory did before token counts were stored
+    """
+    messages = filter_message(conversation_id=memory.conversation_id, limit=memory.message_limit)
+    chat_messages = []
+    for message in reversed(messages):
+        chat_messages.append(HumanMessage(content=message["query"]))
+        chat_messages.append(AIMessage(content=message["response"]))
+    curr_buffer_length = memory.llm.get_num_tokens(get_buffer_string(chat_messages))
+    while curr_buffer_length > memory.max_token_limit and chat_messages:
+        chat_messages.pop(0)
+        curr_buffer_length = memory.llm.get_num_tokens(get_buffer_string(chat_messages))
+    return chat_messages
+
+
+def timed(fn, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="history load time against conversation length")
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    parser.add_argument("--history-len", type=int, default=50, help="0 loads the whole conversation")
+    parser.add_argument("--max-token-limit", type=int, default=2000)
+    parser.add_argument("--words", type=int, default=40, help="words per message")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--legacy-max-turns", type=int, default=1000, help="skip the legacy pruning above this")
+    args = parser.parse_args()
+
+    # the legacy path tokenizes with the model, use the same counter as the stored counts
+    ChatOpenAI.get_num_tokens = lambda self, text: count_tokens(text)
+    llm = ChatOpenAI(openai_api_key="EMPTY")
+    create_tables()
+
+    # kept: messages left after pruning, both ways count within a few tokens of each other
+    print(f"{'turns':>8}{'loaded':>8}{'kept':>6}{'stored (ms)':>14}{'kept':>6}{'legacy (ms)':>14}")
+    for turns in args.turns:
+        conversation_id = create_conversation(turns, args.words)
+        try:
+            memory = ConversationBufferDBMemory(
+                conversation_id=conversation_id,
+                llm=llm,
+                message_limit=args.history_len or turns,
+                max_token_limit=args.max_token_limit,
+            )
+            kept = len(memory.buffer)
+            stored = timed(lambda: memory.buffer, args.repeat)
+            legacy, legacy_kept = "skipped", ""
+            if memory.message_limit <= args.legacy_max_turns:
+                legacy_kept = len(legacy_buffer(memory))
+                legacy = f"{timed(lambda: legacy_buffer(memory), args.repeat):.2f}"
+            print(f"{turns:>8}{memory.message_limit:>8}{kept:>6}{stored:>14.2f}{legacy_kept:>6}{legacy:>14}")
+        finally:
+            delete_conversation(conversation_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+Load generator for /chat:
+
+    python -m benchmarks.load --url http://127.0.0.1:7861 --stream --concurrency 32 --duration 30
+    python -m benchmarks.load --rate 50 --history db --server-pid $(cat /tmp/chat.pid) -o results.json
+    python -m benchmarks.load ... --compare results.json
+
+--concurrency runs a closed loop (each worker sends its next request when the last one is
+done), --rate an open loop (Poisson arrivals, whatever the response times). Results are
+written as JSON, labelled with the current commit, and --compare prints the change of the
+main metrics against a previous result file.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+# metrics compared by --compare, and whether lower is better
+COMPARED = {
+    "ttft_p50": True,
+    "ttft_p95": True,
+    "latency_p50": True,
+    "latency_p95": True,
+    "latency_p99": True,
+    "tokens_per_second": False,
+    "requests_per_second": False,
+    "error_rate": True,
+    "rss_max_mb": True,
+}
+
+
+def percentile(samples: List[float], q: float) -> Optional[float]:
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return round(samples[min(int(len(samples) * q / 100), len(samples) - 1)], 4)
+
+
+def read_rss_mb(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def git_label() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return ""
+
+
+class LoadGenerator:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.samples: List[Dict[str, Any]] = []
+        self.rss: List[float] = []
+        self.sent = 0
+
+    def body(self, user: int) -> Dict[str, Any]:
+        args = self.args
+        self.sent += 1
+        body = {
+            "query": f"request {self.sent} from user {user}",
+            "stream": args.stream,
+            "max_tokens": args.max_tokens,
+        }
+        if args.history == "db":
+            # every virtual user keeps one conversation, its history grows with the run
+            body["conversation_id"] = f"load-{args.seed}-{user}"
+            body["history_len"] = args.history_turns
+        elif args.history == "inline":
+            body["history"] = [
+                {"role": role, "content": f"earlier message {i}"}
+                for i in range(args.history_turns)
+                for role in ("user", "assistant")
+            ]
+        return body
+
+    async def one(self, client: httpx.AsyncClient, user: int) -> None:
+        sample = {"ok": False, "ttft": None, "latency": None, "tokens": 0, "status": None}
+        start = time.perf_counter()
+        try:
+            async with client.stream("POST", "/chat", json=self.body(user)) as response:
+                sample["status"] = response.status_code
+                if response.status_code != 200:
+                    await response.aread()
+                elif self.args.stream:
+                    event = None
+                    async for line in response.aiter_lines():
+                        if line.startswith("event:"):
+                            event = line[6:].strip()
+                        elif line.startswith("data:"):
+                            data = json.loads(line[5:])
+                            if event == "done":
+                                sample["ok"] = data.get("finish_reason") in (None, "stop")
+                            elif event is None and "text" in data:
+                                if sample["ttft"] is None:
+                                    sample["ttft"] = time.perf_counter() - start
+                                sample["tokens"] += len(data["text"].split())
+                        elif not line:
+                            event = None
+                else:
+                    data = json.loads(await response.aread())
+                    sample["ttft"] = time.perf_counter() - start
+                    sample["tokens"] = len(data.get("text", "").split())
+                    sample["ok"] = data.get("finish_reason") in (None, "stop")
+        except Exception as e:
+            sample["error"] = f"{e.__class__.__name__}: {e}"
+        sample["latency"] = time.perf_counter() - start
+        self.samples.append(sample)
+
+    async def closed_loop(self, client: httpx.AsyncClient, deadline: float) -> None:
+        async def worker(user: int) -> None:
+            while time.perf_counter() < deadline and self.budget_left():
+                await self.one(client, user)
+
+        await asyncio.gather(*[worker(u) for u in range(self.args.concurrency)])
+
+    async def open_loop(self, client: httpx.AsyncClient, deadline: float) -> None:
+        tasks = []
+        users = max(self.args.concurrency, 1)
+        while time.perf_counter() < deadline and self.budget_left():
+            tasks.append(asyncio.create_task(self.one(client, self.sent % users)))
+            await asyncio.sleep(self.rng.expovariate(self.args.rate))
+        await asyncio.gather(*tasks)
+
+    def budget_left(self) -> bool:
+        return not self.args.requests or self.sent < self.args.requests
+
+    async def sample_rss(self) -> None:
+        while True:
+            rss = read_rss_mb(self.args.server_pid)
+            if rss is not None:
+                self.rss.append(rss)
+            await asyncio.sleep(0.5)
+
+    async def run(self) -> Dict[str, Any]:
+        args = self.args
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        async with httpx.AsyncClient(
+            base_url=args.url, timeout=args.timeout, limits=limits
+        ) as client:
+            rss_task = asyncio.create_task(self.sample_rss()) if args.server_pid else None
+            start = time.perf_counter()
+            deadline = start + args.duration
+            if args.rate:
+                await self.open_loop(client, deadline)
+            else:
+                await self.closed_loop(client, deadline)
+            elapsed = time.perf_counter() - start
+            if rss_task:
+                rss_task.cancel()
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        ok = [s for s in self.samples if s["ok"]]
+        ttft = [s["ttft"] for s in ok if s["ttft"] is not None]
+        latency = [s["latency"] for s in ok]
+        tokens = sum(s["tokens"] for s in ok)
+        errors: Dict[str, int] = {}
+        for s in self.samples:
+            if not s["ok"]:
+                key = s.get("error", "").split(":")[0] or f"status {s['status']}"
+                errors[key] = errors.get(key, 0) + 1
+        config = {k: v for k, v in vars(self.args).items() if k not in ("output", "compare")}
+        return {
+            "label": self.args.label or git_label(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": config,
+            "results": {
+                "requests": len(self.samples),
+                "elapsed": round(elapsed, 3),
+                "requests_per_second": round(len(ok) / elapsed, 3),
+                "tokens_per_second": round(tokens / elapsed, 1),
+                "ttft_p50": percentile(ttft, 50),
+                "ttft_p95": percentile(ttft, 95),
+                "ttft_p99": percentile(ttft, 99),
+                "latency_p50": percentile(latency, 50),
+                "latency_p95": percentile(latency, 95),
+                "latency_p99": percentile(latency, 99),
+                "error_rate": round(1 - len(ok) / len(self.samples), 4) if self.samples else None,
+                "errors": errors,
+                "rss_start_mb": round(self.rss[0], 1) if self.rss else None,
+                "rss_max_mb": round(max(self.rss), 1) if self.rss else None,
+                "rss_end_mb": round(self.rss[-1], 1) if self.rss else None,
+            },
+        }
+
+
+def compare(previous: Dict[str, Any], current: Dict[str, Any]) -> None:
+    print(f"{'metric':<22}{previous.get('label') or 'previous':>12}{current.get('label') or 'current':>12}{'change':>12}")
+    for metric, lower_is_better in COMPARED.items():
+        a = previous["results"].get(metric)
+        b = current["results"].get(metric)
+        change = ""
+        if a and b is not None:
+            pct = (b - a) / a * 100
+            better = pct < 0 if lower_is_better else pct > 0
+            change = f"{pct:+.1f}%{'' if abs(pct) < 1 else (' +' if better else ' -')}"
+        print(f"{metric:<22}{str(a):>12}{str(b):>12}{change:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="load generator for /chat")
+    parser.add_argument("--url", default="http://127.0.0.1:7861")
+    parser.add_argument("--stream", action="store_true", help="request server-sent events")
+    parser.add_argument("--history", choices=["none", "db", "inline"], default="none")
+    parser.add_argument("--history-turns", type=int, default=4)
+    parser.add_argument("--max-tokens", type=int, default=None)
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="closed loop workers")
+    parser.add_argument("--rate", type=float, default=0.0, help="open loop arrivals per second")
+    parser.add_argument("-d", "--duration", type=float, default=30.0, help="seconds")
+    parser.add_argument("-n", "--requests", type=int, default=0, help="stop after N requests")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--server-pid", type=int, help="sample the RSS of this process")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--label", default="", help="defaults to the current commit")
+    parser.add_argument("-o", "--output", help="write the results JSON here")
+    parser.add_argument("--compare", help="a previous results JSON to compare with")
+    args = parser.parse_args()
+
+    report = asyncio.run(LoadGenerator(args).run())
+    print(json.dumps(report["results"], indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare and os.path.exists(args.compare):
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Replay captured traffic (TRAFFIC_CAPTURE) against a server and compare runs:
+
+    python -m benchmarks.replay run logs/capture.jsonl.1 logs/capture.jsonl --url http://127.0.0.1:7861 -o a.json
+    python -m benchmarks.replay run logs/capture.jsonl --speed 4 -o b.json     # 4x faster
+    python -m benchmarks.replay run logs/capture.jsonl --speed 0 -c 64 -o c.json  # as fast as possible
+    python -m benchmarks.replay compare a.json b.json
+
+--speed 1 keeps the original inter-arrival times. compare accepts result files and
+capture files (their recorded timings) and prints the latency and time to first byte
+distributions of both runs with the Kolmogorov-Smirnov distance between them.
+"""
+import argparse
+import asyncio
+import bisect
+import json
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+import httpx
+
+from benchmarks.load import git_label, percentile
+
+QUANTILES = [50, 90, 95, 99]
+
+
+def read_capture(paths: List[str]) -> List[Dict[str, Any]]:
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+    records.sort(key=lambda r: r["arrival"])
+    return records
+
+
+class Replayer:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.samples: List[Dict[str, Any]] = []
+
+    async def one(self, client: httpx.AsyncClient, record: Dict[str, Any], lag: float) -> None:
+        method, path = record["title"].split(" ", 1)
+        if record.get("query_string"):
+            path = f"{path}?{record['query_string']}"
+        headers = {k: v for k, v in record.get("headers", {}).items() if v != "[REDACTED]"}
+        sample = {"request_id": record["request_id"], "lag": round(lag, 4), "status": None, "ttfb": None}
+        start = time.perf_counter()
+        try:
+            async with client.stream(method, path, json=record["body"], headers=headers) as response:
+                sample["status"] = response.status_code
+                async for chunk in response.aiter_raw():
+                    if chunk and sample["ttfb"] is None:
+                        sample["ttfb"] = time.perf_counter() - start
+        except Exception as e:
+            sample["error"] = f"{e.__class__.__name__}: {e}"
+        sample["latency"] = time.perf_counter() - start
+        self.samples.append(sample)
+
+    async def run(self, records: List[Dict[str, Any]]) -> Dict[str, Any]:
+        args = self.args
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+            start = time.perf_counter()
+            if args.speed > 0:
+                # open loop, keep the captured arrival pattern (scaled)
+                tasks = []
+                first = records[0]["arrival"] if records else 0
+                for record in records:
+                    due = start + (record["arrival"] - first) / args.speed
+                    delay = due - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    lag = max(time.perf_counter() - due, 0)
+                    tasks.append(asyncio.create_task(self.one(client, record, lag)))
+                await asyncio.gather(*tasks)
+            else:
+                it: Iterator[Dict[str, Any]] = iter(records)
+
+                async def worker() -> None:
+                    for record in it:
+                        await self.one(client, record, 0.0)
+
+                await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+            elapsed = time.perf_counter() - start
+        return {
+            "label": args.label or git_label(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "func")},
+            "elapsed": round(elapsed, 3),
+            "summary": summarize(self.samples),
+            "samples": self.samples,
+        }
+
+
+def load_timings(path: str) -> Dict[str, Any]:
+    """
+    latencies and ttfb of a replay result file, or of the requests of a capture file
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except ValueError:
+        # several JSON lines, a capture
+        data = None
+    if isinstance(data, dict) and "samples" in data:
+        samples = data["samples"]
+        label = data.get("label") or path
+    else:
+        samples = [
+            {"status": r["status"], "ttfb": r["ttfb"], "latency": r["duration"]}
+            for r in read_capture([path])
+        ]
+        label = f"{path} (captured)"
+    return {"label": label, "samples": samples}
+
+
+def summarize(samples: List[Dict[str, Any]]) -> Dict[str, Any]:
+    ok = [s for s in samples if s.get("status") == 200]
+    summary = {"requests": len(samples), "error_rate": round(1 - len(ok) / len(samples), 4) if samples else None}
+    for metric in ("latency", "ttfb"):
+        values = [s[metric] for s in ok if s.get(metric) is not None]
+        for q in QUANTILES:
+            summary[f"{metric}_p{q}"] = percentile(values, q)
+        summary[f"{metric}_max"] = round(max(values), 4) if values else None
+    return summary
+
+
+def ks_distance(a: List[float], b: List[float]) -> Optional[float]:
+    """
+    largest gap between the two empirical distribution functions
+    """
+    if not a or not b:
+        return None
+    a, b = sorted(a), sorted(b)
+    return round(
+        max(
+            abs(bisect.bisect_right(a, x) / len(a) - bisect.bisect_right(b, x) / len(b))
+            for x in a + b
+        ),
+        4,
+    )
+
+
+def compare(path_a: str, path_b: str) -> None:
+    a, b = load_timings(path_a), load_timings(path_b)
+    summary_a, summary_b = summarize(a["samples"]), summarize(b["samples"])
+    print(f"A: {a['label']}\nB: {b['label']}")
+    print(f"{'metric':<16}{'A':>10}{'B':>10}{'change':>10}")
+    for key in summary_a:
+        x, y = summary_a[key], summary_b[key]
+        change = f"{(y - x) / x * 100:+.1f}%" if x and y is not None else ""
+        print(f"{key:<16}{str(x):>10}{str(y):>10}{change:>10}")
+    for metric in ("latency", "ttfb"):
+        values = [
+            [s[metric] for s in run["samples"] if s.get("status") == 200 and s.get(metric) is not None]
+            for run in (a, b)
+        ]
+        print(f"ks_distance({metric}) = {ks_distance(*values)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay captured traffic")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="replay capture files against a server")
+    run.add_argument("capture", nargs="+", help="capture files, rotated ones included")
+    run.add_argument("--url", default="http://127.0.0.1:7861")
+    run.add_argument("--speed", type=float, default=1.0, help="time scale, 0 replays as fast as possible")
+    run.add_argument("-c", "--concurrency", type=int, default=32, help="workers when --speed 0")
+    run.add_argument("--timeout", type=float, default=120.0)
+    run.add_argument("--label", default="", help="defaults to the current commit")
+    run.add_argument("-o", "--output", help="write the results JSON here")
+    cmp = commands.add_parser("compare", help="compare the latency distributions of two runs")
+    cmp.add_argument("a")
+    cmp.add_argument("b")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        compare(args.a, args.b)
+        return
+    records = read_capture(args.capture)
+    report = asyncio.run(Replayer(args).run(records))
+    print(json.dumps(report["summary"], indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
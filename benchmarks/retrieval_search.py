@@ -0,0 +1,84 @@
+"""
+Time the retrieval memory's vector index: building the index of a conversation, adding
+one turn, and embedding a query plus searching, as conversations grow:
+
+    python -m benchmarks.retrieval_search --turns 100 1000 5000 10000
+
+Runs in memory, no database or model needed. Each search checks that the turn the query
+was taken from comes back first.
+"""
+import argparse
+import random
+import statistics
+import time
+import uuid
+
+from app.memory.embeddings import embedder
+from app.memory.retrieval_index import ConversationIndex
+
+TOPICS = [
+    "password reset email link expired",
+    "invoice billing address change",
+    "two factor authentication phone lost",
+    "export data csv download",
+    "delete account permanently",
+    "api rate limit exceeded error",
+    "refund for duplicate charge",
+    "slow dashboard loading times",
+]
+FILLER = "please could you help me with this thanks again for the quick answer".split()
+
+
+def make_turn(i: int, rng: random.Random) -> dict:
+    topic = rng.choice(TOPICS)
+    words = rng.sample(FILLER, 6)
+    return {
+        "id": uuid.uuid4().hex,
+        "query": f"question {i} about {topic} {' '.join(words)}",
+        "response": f"answer {i}: for {topic} go to settings and follow the steps {' '.join(words)}",
+        "query_tokens": 20,
+        "response_tokens": 25,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="retrieval index build and search times")
+    parser.add_argument("--turns", type=int, nargs="+", default=[100, 1000, 5000, 10000])
+    parser.add_argument("--top-k", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    rng = random.Random(0)
+
+    print(f"embedder {type(embedder).__name__}, dim {embedder.dim}")
+    print(f"{'turns':>8}{'build (ms)':>12}{'add (us)':>10}{'search p50 (us)':>17}{'p99 (us)':>10}{'self hit':>10}")
+    for turns in args.turns:
+        rows = [make_turn(i, rng) for i in range(turns)]
+        index = ConversationIndex("bench", embedder.dim)
+        start = time.perf_counter()
+        index.add_turns(rows)
+        build = (time.perf_counter() - start) * 1000
+
+        extra = [make_turn(turns + i, rng) for i in range(100)]
+        start = time.perf_counter()
+        for turn in extra:
+            index.add_turns([turn])
+        add = (time.perf_counter() - start) / len(extra) * 1e6
+
+        samples, self_hits = [], 0
+        for _ in range(args.queries):
+            turn = rng.choice(rows)
+            start = time.perf_counter()
+            hits = index.search(turn["query"], args.top_k)
+            samples.append((time.perf_counter() - start) * 1e6)
+            best = max(hits, key=lambda hit: hit[1])[0]
+            self_hits += best["id"] == turn["id"]
+        samples.sort()
+        p99 = samples[min(int(len(samples) * 0.99), len(samples) - 1)]
+        print(
+            f"{turns:>8}{build:>12.1f}{add:>10.1f}{statistics.median(samples):>17.1f}{p99:>10.1f}"
+            f"{self_hits / args.queries:>10.0%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Route requests between two stub servers with different delays and print the
+router's view of them (latency, ejections, hedges):
+
+    python -m benchmarks.stub_openai --port 9000 &
+    python -m benchmarks.stub_openai --port 9001 --ttft 1.0 &
+    python -m benchmarks.router --backend http://127.0.0.1:9000/v1 --backend http://127.0.0.1:9001/v1 --hedge
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from langchain.callbacks import AsyncIteratorCallbackHandler
+from langchain.schema import HumanMessage
+
+from app.configs import ONLINE_LLM_MODEL
+from app.upstream import model_router
+from app.utils import get_ChatOpenAI, wrap_done
+
+
+async def one(model_name: str, latencies: list, errors: list):
+    callback = AsyncIteratorCallbackHandler()
+
+    def call(backend, callbacks):
+        model = get_ChatOpenAI(
+            model_name=model_name,
+            temperature=0,
+            callbacks=callbacks,
+            backend=backend,
+            max_retries=0,
+        )
+        return model.agenerate([[HumanMessage(content="hello")]])
+
+    start = time.perf_counter()
+    ttft = None
+    task = asyncio.create_task(
+        wrap_done(model_router.acall(model_name, call, callback), callback.done)
+    )
+    async for _ in callback.aiter():
+        if ttft is None:
+            ttft = time.perf_counter() - start
+    if await task:
+        latencies.append(ttft or time.perf_counter() - start)
+    else:
+        errors.append(1)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", action="append", required=True, help="api base url")
+    parser.add_argument("-n", type=int, default=100)
+    parser.add_argument("-c", type=int, default=10)
+    parser.add_argument("--hedge", action="store_true")
+    args = parser.parse_args()
+
+    model_name = "bench"
+    names = []
+    for i, url in enumerate(args.backend):
+        name = f"bench-{i}"
+        ONLINE_LLM_MODEL[name] = {"model_name": "stub", "api_base_url": url, "api_key": "EMPTY"}
+        names.append(name)
+    model_router.routes[model_name] = names
+    model_router.hedge = args.hedge
+
+    semaphore = asyncio.Semaphore(args.c)
+    latencies, errors = [], []
+
+    async def limited():
+        async with semaphore:
+            await one(model_name, latencies, errors)
+
+    await asyncio.gather(*[limited() for _ in range(args.n)])
+    latencies.sort()
+    print(
+        "ttft p50/p99:",
+        round(latencies[len(latencies) // 2], 4) if latencies else None,
+        round(latencies[int(len(latencies) * 0.99) - 1], 4) if latencies else None,
+        "errors:",
+        len(errors),
+    )
+    stats = model_router.stats()
+    for name, backend in stats.pop("backends").items():
+        backend.pop("ttft_histogram")
+        print(name, json.dumps(backend))
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
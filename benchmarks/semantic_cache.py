@@ -0,0 +1,84 @@
+"""
+Pick a semantic cache threshold: for a set of paraphrase pairs (same answer) and
+unrelated pairs (different answers), the share of each that would hit at each threshold,
+plus the lookup time as the cache grows:
+
+    python -m benchmarks.semantic_cache --thresholds 0.5 0.6 0.7 0.8 0.9 --entries 1000 10000
+
+Hits on paraphrases are wanted, hits on unrelated prompts and on near misses (the same
+question about another entity or operand) are false hits. Runs in memory with the
+configured embedder, no database or model needed.
+"""
+import argparse
+import statistics
+import time
+
+from app.cache.semantic_cache import SemanticCache
+from app.memory.embeddings import embedder
+
+PARAPHRASES = [
+    ("how do I reset my password", "how can I reset my password"),
+    ("how do I reset my password", "password reset steps"),
+    ("change the billing address on my invoice", "how to change my invoice billing address"),
+    ("I lost the phone I use for two factor authentication", "lost my two factor authentication phone"),
+    ("export my data as csv", "how do I export data to a csv file"),
+    ("delete my account permanently", "how can I permanently delete my account"),
+    ("why do I get api rate limit exceeded", "api rate limit exceeded error"),
+    ("refund for a duplicate charge", "I was charged twice, can I get a refund"),
+]
+UNRELATED = [
+    ("how do I reset my password", "how do I delete my account"),
+    ("export my data as csv", "import my data from a csv file"),
+    ("refund for a duplicate charge", "change the billing address on my invoice"),
+    ("why is the dashboard slow", "why do I get api rate limit exceeded"),
+    ("how do I reset my password", "how do I reset my username"),
+    ("delete my account permanently", "delete my last message"),
+]
+NEAR_MISSES = [
+    ("write a function to add two numbers", "write a function to multiply two numbers"),
+    ("what is the capital of france", "what is the capital of spain"),
+    ("convert 10 miles to kilometers", "convert 10 kilometers to miles"),
+    ("sort a list in python", "sort a list in javascript"),
+]
+
+
+def hit_rate(pairs, threshold: float) -> float:
+    hits = 0
+    for cached, query in pairs:
+        # get / set work on a disabled cache too
+        cache = SemanticCache(threshold=threshold)
+        cache.set("m", "default", None, cache.query_text(cached), ["answer"])
+        hits += cache.get("m", "default", None, cache.query_text(query)) is not None
+    return hits / len(pairs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="semantic cache hit rates and lookup times")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.5, 0.6, 0.7, 0.8, 0.9])
+    parser.add_argument("--entries", type=int, nargs="+", default=[1000, 10000])
+    args = parser.parse_args()
+
+    print(f"embedder {type(embedder).__name__}, dim {embedder.dim}")
+    print(f"{'threshold':>10}{'paraphrase hits':>17}{'false hits':>12}{'near miss hits':>16}")
+    for threshold in args.thresholds:
+        print(
+            f"{threshold:>10.2f}{hit_rate(PARAPHRASES, threshold):>17.0%}"
+            f"{hit_rate(UNRELATED, threshold):>12.0%}{hit_rate(NEAR_MISSES, threshold):>16.0%}"
+        )
+
+    print(f"\n{'entries':>10}{'lookup p50 (us)':>17}{'p99 (us)':>10}")
+    for entries in args.entries:
+        cache = SemanticCache(max_entries=entries)
+        for i in range(entries):
+            cache.set("m", "default", None, f"question {i} about topic {i % 97}", ["answer"])
+        samples = []
+        for i in range(200):
+            start = time.perf_counter()
+            cache.get("m", "default", None, f"question {i * 7} about topic {i % 89}")
+            samples.append((time.perf_counter() - start) * 1e6)
+        samples.sort()
+        print(f"{entries:>10}{statistics.median(samples):>17.1f}{samples[int(len(samples) * 0.99)]:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+Run the API against a stub upstream, for load tests:
+
+    python -m benchmarks.stub_openai --port 9000 --ttft 0.2 --token-delay 0.01 &
+    python -m benchmarks.serve --upstream http://127.0.0.1:9000/v1 --port 7861 --pid-file /tmp/chat.pid
+"""
+import argparse
+import os
+
+import uvicorn
+
+
+def main():
+    parser = argparse.ArgumentParser(description="run the API against a stub upstream")
+    parser.add_argument("--upstream", default="http://127.0.0.1:9000/v1")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7861)
+    parser.add_argument("--pid-file", help="write the server pid here (RSS sampling)")
+    args = parser.parse_args()
+
+    from app.configs import ONLINE_LLM_MODEL, MODEL_PRIVIDER
+
+    ONLINE_LLM_MODEL[MODEL_PRIVIDER]["api_base_url"] = args.upstream
+    ONLINE_LLM_MODEL[MODEL_PRIVIDER]["api_key"] = "EMPTY"
+
+    # tiktoken would download its encoding, count words instead
+    from langchain_community.chat_models import ChatOpenAI
+
+    ChatOpenAI.get_num_tokens = lambda self, text: len(text.split())
+
+    if args.pid_file:
+        with open(args.pid_file, "w") as f:
+            f.write(str(os.getpid()))
+
+    from app.main import app
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+A deterministic local OpenAI-compatible server for benchmarks.
+
+    python -m benchmarks.stub_openai --port 9000 --ttft 0.2 --token-delay 0.01 --tokens 200 --error-rate 0.01
+
+Point ONLINE_LLM_MODEL[...]["api_base_url"] at http://127.0.0.1:9000/v1
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def create_app(
+    ttft: float = 0.0,
+    token_delay: float = 0.0,
+    tokens: int = 50,
+    error_rate: float = 0.0,
+    error_status: int = 500,
+    seed: int = 0,
+) -> FastAPI:
+    app = FastAPI()
+    # seeded, so a run sees the same sequence of failures every time
+    rng = random.Random(seed)
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": "stub", "object": "model"}]}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        if error_rate and rng.random() < error_rate:
+            await asyncio.sleep(ttft)
+            return JSONResponse(
+                {"error": {"message": "injected error", "type": "server_error"}},
+                status_code=error_status,
+            )
+        model = body.get("model", "stub")
+        n_tokens = min(tokens, body.get("max_tokens") or tokens)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        words = [f"tok{i} " for i in range(n_tokens)]
+
+        def chunk(delta, finish_reason=None):
+            return {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+            }
+
+        if body.get("stream"):
+
+            async def event_stream():
+                await asyncio.sleep(ttft)
+                yield f"data: {json.dumps(chunk({'role': 'assistant', 'content': ''}))}\n\n"
+                for i, word in enumerate(words):
+                    if i and token_delay:
+                        await asyncio.sleep(token_delay)
+                    yield f"data: {json.dumps(chunk({'content': word}))}\n\n"
+                yield f"data: {json.dumps(chunk({}, 'stop'))}\n\n"
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+        await asyncio.sleep(ttft + token_delay * max(n_tokens - 1, 0))
+        return JSONResponse(
+            {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "".join(words)},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": 0,
+                    "completion_tokens": n_tokens,
+                    "total_tokens": n_tokens,
+                },
+            }
+        )
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="local OpenAI-compatible stub server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--ttft", type=float, default=0.0, help="seconds before the first token")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="seconds between tokens")
+    parser.add_argument("--tokens", type=int, default=50, help="tokens per answer")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=500, help="status code of a failed request")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    app = create_app(
+        args.ttft,
+        args.token_delay,
+        args.tokens,
+        args.error_rate,
+        args.error_status,
+        args.seed,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
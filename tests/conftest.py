@@ -0,0 +1,113 @@
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytest
+
+import app.configs
+
+# Point the app at a throwaway database before anything binds the engine,
+# importing app.main resets the tables of the configured one
+_db_dir = tempfile.mkdtemp(prefix="chatapp-tests-")
+app.configs.SQLALCHEMY_DATABASE_URL = f"sqlite:///{os.path.join(_db_dir, 'app.db')}"
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def db():
+    """
+    empty tables for every model
+    """
+    import app.main  # noqa: F401, registers every model with Base
+    from app.db.utlis import create_tables, reset_tables
+
+    reset_tables()
+    create_tables()
+    yield
+
+
+@pytest.fixture(autouse=True)
+def upstream_clients():
+    """
+    pooled upstream clients are bound to the event loop that opened their connections,
+    every test runs its own loops
+    """
+    from app.upstream import upstream_clients
+
+    yield upstream_clients
+    upstream_clients._clients.clear()
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_stub(*args: str) -> "tuple[subprocess.Popen, str]":
+    """
+    run benchmarks/stub_openai.py on a free port, return the process and its api_base_url
+    """
+    port = _free_port()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.stub_openai", "--port", str(port), *args],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc, f"http://127.0.0.1:{port}/v1"
+        except OSError:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.1)
+    proc.kill()
+    pytest.skip("stub model server did not start")
+
+
+@pytest.fixture
+def start_stub_model():
+    """
+    start extra stub models with other options, stopped after the test
+    """
+    procs = []
+
+    def start(*args: str) -> str:
+        proc, url = start_stub(*args)
+        procs.append(proc)
+        return url
+
+    yield start
+    for proc in procs:
+        proc.terminate()
+        proc.wait()
+
+
+@pytest.fixture(scope="session")
+def stub_model():
+    """
+    api_base_url of a local stub model answering every completion with 20 tokens
+    """
+    proc, url = start_stub("--tokens", "20", "--token-delay", "0.001")
+    yield url
+    proc.terminate()
+    proc.wait()
+
+
+@pytest.fixture
+def online_model(monkeypatch, stub_model):
+    """
+    route the default model provider to the stub model
+    """
+    from app.configs import ONLINE_LLM_MODEL, MODEL_PRIVIDER
+
+    monkeypatch.setitem(ONLINE_LLM_MODEL[MODEL_PRIVIDER], "api_base_url", stub_model)
+    monkeypatch.setitem(ONLINE_LLM_MODEL[MODEL_PRIVIDER], "api_key", "EMPTY")
+    return MODEL_PRIVIDER
@@ -0,0 +1,51 @@
+import sys
+
+from fastapi.testclient import TestClient
+
+from app.configs import ONLINE_LLM_MODEL
+from app.memory.context_budget import context_budgeter
+
+
+def test_history_trimmed_to_nothing_is_not_loaded_from_the_db(db, online_model, monkeypatch):
+    from app.main import app
+
+    chat_module = sys.modules["app.chat.chat"]
+    build_chat_prompt = chat_module.build_chat_prompt
+    built = []
+
+    def spy(*args, **kwargs):
+        chat_prompt, memory = build_chat_prompt(*args, **kwargs)
+        built.append(memory)
+        return chat_prompt, memory
+
+    monkeypatch.setattr(chat_module, "build_chat_prompt", spy)
+    monkeypatch.setattr(context_budgeter, "enabled", True)
+    monkeypatch.setitem(ONLINE_LLM_MODEL[online_model], "context_length", 1200)
+
+    history = [
+        {"role": "user", "content": "lorem ipsum " * 1500},
+        {"role": "assistant", "content": "dolor sit " * 1500},
+    ]
+    r = TestClient(app).post(
+        "/chat",
+        json={
+            "query": "hello",
+            "conversation_id": "budget-c1",
+            "history_len": 10,
+            "history": history,
+            "max_tokens": 100,
+            "stream": False,
+        },
+    )
+    assert r.status_code == 200
+    assert r.json()["budget"]["history_dropped"] == 2
+    assert built == [None]
+
+
+def test_unknown_prompt_name_is_a_client_error(db, online_model, monkeypatch):
+    from app.main import app
+
+    monkeypatch.setattr(context_budgeter, "enabled", True)
+    r = TestClient(app).post("/chat", json={"query": "hello", "prompt_name": "no-such-prompt", "stream": False})
+    assert r.status_code == 400
+    assert "no-such-prompt" in r.json()["msg"]
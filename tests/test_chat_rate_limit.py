@@ -0,0 +1,28 @@
+from fastapi.testclient import TestClient
+
+from app.configs import ONLINE_LLM_MODEL
+from app.upstream import rate_limiter, model_router
+from app.upstream.rate_limiter import LocalBucketStore
+
+
+def test_model_budget_does_not_depend_on_the_picked_backend(db, online_model, monkeypatch):
+    from app.main import app
+
+    second = dict(ONLINE_LLM_MODEL[online_model], rpm=3)
+    monkeypatch.setitem(ONLINE_LLM_MODEL, "second-api", second)
+    monkeypatch.setitem(ONLINE_LLM_MODEL[online_model], "rpm", 2)
+    model_name = ONLINE_LLM_MODEL[online_model]["model_name"]
+    monkeypatch.setitem(model_router.routes, model_name, [online_model, "second-api"])
+    monkeypatch.setattr(rate_limiter, "enabled", True)
+    monkeypatch.setattr(rate_limiter, "store", LocalBucketStore())
+
+    client = TestClient(app)
+    statuses = []
+    for i in range(6):
+        r = client.post("/chat", json={"query": f"hello {i}", "stream": False, "model_name": model_name})
+        statuses.append(r.status_code)
+        # a different backend may be preferred for every call
+        model_router.backend_stats("second-api").ewma_ttft = 0.0 if i % 2 else 10.0
+
+    assert statuses == [200] * 5 + [503]
+    assert rate_limiter.stats()["buckets"][f"model:{model_name}:rpm"]["per_minute"] == 5
@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+from app.cache.history_cache import HistoryCache, history_cache
+from app.db.repository.conversation_version_repository import bump_conversation_version
+from app.db.repository.message_repository import add_message_to_db, afilter_message, update_message
+from app.db.session import with_session
+
+
+def row(id: str, response: str = "answer") -> dict:
+    return {"id": id, "query": f"query {id}", "response": response, "query_tokens": 3, "response_tokens": 1}
+
+
+def newest_first(*ids: str) -> list:
+    return [row(id) for id in reversed(ids)]
+
+
+def test_window_is_served_at_its_version_only():
+    cache = HistoryCache(enabled=True, window=10)
+    cache.put("c", newest_first("m1", "m2", "m3"), 10, version=3)
+    assert [r["id"] for r in cache.get("c", 2, version=3)] == ["m3", "m2"]
+    # another writer committed since
+    assert cache.get("c", 2, version=4) is None
+    assert cache.stats()["stale"] == 1
+    # the stale window is gone
+    assert cache.get("c", 2, version=3) is None
+
+
+def test_writes_advance_the_window_one_version_at_a_time():
+    cache = HistoryCache(enabled=True, window=10)
+    cache.put("c", newest_first("m1"), 10, version=1)
+    cache.add("c", row("m2", response=""))
+    cache.advance("c", 2, ["m2"])
+    # unanswered rows are kept but not served
+    assert [r["id"] for r in cache.get("c", 5, version=2)] == ["m1"]
+    cache.set_response("m2", "later", 1)
+    cache.advance("c", 3, ["m2"])
+    assert [r["id"] for r in cache.get("c", 5, version=3)] == ["m2", "m1"]
+
+    # version 4 was written by someone else, this write is version 5
+    cache.add("c", row("m3"))
+    cache.advance("c", 5, ["m3"])
+    assert cache.get("c", 5, version=5) is None
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_advance_with_a_row_the_window_does_not_hold_drops_it():
+    cache = HistoryCache(enabled=True, window=10)
+    cache.put("c", newest_first("m1"), 10, version=1)
+    cache.advance("c", 2, ["unknown"])
+    assert cache.get("c", 1, version=2) is None
+
+
+def test_partial_windows_only_serve_what_they_hold():
+    cache = HistoryCache(enabled=True, window=2)
+    # a full window of a longer conversation
+    cache.put("long", newest_first("m1", "m2"), 2, version=1)
+    assert cache.get("long", 3, version=1) is None
+    # a conversation shorter than the window is complete
+    cache.put("short", newest_first("m1x"), 2, version=1)
+    assert [r["id"] for r in cache.get("short", 3, version=1)] == ["m1x"]
+
+
+def test_older_loads_do_not_replace_newer_windows():
+    cache = HistoryCache(enabled=True, window=10)
+    cache.put("c", newest_first("m1", "m2"), 10, version=2)
+    cache.put("c", newest_first("m1"), 10, version=1)
+    assert [r["id"] for r in cache.get("c", 5, version=2)] == ["m2", "m1"]
+
+
+def test_least_recently_used_windows_are_evicted():
+    one_window = len(newest_first("m1", "m2")) * (len("query m1") + len("answer") + 512)
+    cache = HistoryCache(enabled=True, max_bytes=int(one_window * 2.5), window=10)
+    for cid in ("a", "b", "c"):
+        cache.put(cid, newest_first(f"{cid}1", f"{cid}2"), 10, version=1)
+        if cid == "b":
+            cache.get("a", 1, version=1)
+    assert cache.get("b", 1, version=1) is None
+    assert cache.get("a", 1, version=1) is not None and cache.get("c", 1, version=1) is not None
+    assert cache.stats()["evictions"] == 1
+
+
+@with_session
+def write_from_another_worker(session, conversation_id: str) -> None:
+    bump_conversation_version(session, conversation_id)
+
+
+@pytest.fixture
+def enabled_history_cache(monkeypatch):
+    monkeypatch.setattr(history_cache, "enabled", True)
+    yield history_cache
+    history_cache._windows.clear()
+    history_cache._owners.clear()
+    history_cache._bytes = 0
+
+
+def test_history_is_cached_in_front_of_the_db(db, enabled_history_cache):
+    cache = enabled_history_cache
+    add_message_to_db(conversation_id="h1", chat_type="llm_chat", query="q1", response="a1", message_id="m1")
+
+    async def history():
+        return [m["id"] for m in await afilter_message("h1", 10)]
+
+    assert asyncio.run(history()) == ["m1"]
+    hits = cache.hits
+    assert asyncio.run(history()) == ["m1"]
+    assert cache.hits == hits + 1
+
+    # writes of this worker go through to the cached window
+    add_message_to_db(conversation_id="h1", chat_type="llm_chat", query="q2", response="", message_id="m2")
+    update_message(message_id="m2", response="a2")
+    assert asyncio.run(history()) == ["m2", "m1"]
+    assert cache.hits == hits + 2
+
+    # a write the cache did not see makes the window stale
+    write_from_another_worker(conversation_id="h1")
+    stale = cache.stale
+    # reloaded from the db, where rows of the same second have no order
+    assert set(asyncio.run(history())) == {"m1", "m2"}
+    assert cache.stale == stale + 1
@@ -0,0 +1,43 @@
+import asyncio
+
+import httpx
+
+from app.profiling.watchdog import LoopWatchdog
+
+# generous for a shared CI machine, a blocking db commit or tokenizer call on the
+# loop takes far longer once the table or the text grows
+MAX_LAG = 0.25
+
+
+def test_chat_hot_path_does_not_block_the_event_loop(db, online_model):
+    from app.main import app
+
+    watchdog = LoopWatchdog(enabled=True, interval=0.005, threshold=0.05)
+
+    async def chat(client, i, stream):
+        r = await client.post(
+            "/chat",
+            json={
+                "query": f"question {i}",
+                "conversation_id": f"watchdog-{i % 3}",
+                "history_len": 5,
+                "stream": stream,
+            },
+        )
+        assert r.status_code == 200
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            # first calls pay for imports and client setup
+            await chat(client, 0, False)
+            watchdog.start()
+            try:
+                for round in range(3):
+                    await asyncio.gather(*(chat(client, i, i % 2 == 0) for i in range(round * 8, round * 8 + 8)))
+            finally:
+                watchdog.stop()
+
+    asyncio.run(run())
+    assert watchdog.probes > 0
+    watchdog.check(MAX_LAG)
@@ -0,0 +1,86 @@
+import asyncio
+
+from app.db.repository.message_repository import add_message_to_db, filter_message
+from app.db.repository.message_write_queue import MessageWriteQueue
+
+
+def new_queue(**kwargs) -> MessageWriteQueue:
+    # nothing is flushed in the background, the tests flush
+    return MessageWriteQueue(enabled=True, batch_size=1000, flush_interval=3600, **kwargs)
+
+
+def test_rows_are_written_in_one_flush(db):
+    async def run():
+        queue = new_queue()
+        ids = [queue.add_message("c1", "llm_chat", f"query {i}", f"response {i}") for i in range(3)]
+        queue.update_message(ids[0], response="edited")
+        assert queue.is_pending(ids[0])
+        await queue.flush()
+        assert not queue.is_pending()
+        await queue.close()
+        return queue, ids
+
+    queue, ids = asyncio.run(run())
+    assert queue.stats()["flushes"] == 1 and queue.stats()["rows_flushed"] == 3
+    rows = filter_message(conversation_id="c1", limit=10)
+    assert {r["id"] for r in rows} == set(ids)
+    assert {r["response"] for r in rows} == {"edited", "response 1", "response 2"}
+    assert all(r["query_tokens"] and r["response_tokens"] for r in rows)
+
+
+def test_a_bad_row_does_not_block_the_others(db):
+    add_message_to_db(conversation_id="c2", chat_type="llm_chat", query="q", response="r", message_id="taken")
+
+    async def run():
+        queue = new_queue(max_attempts=2, retry_backoff=3600)
+        good = queue.add_message("c2", "llm_chat", "good", "answer")
+        # same primary key as a committed row, the insert can never succeed
+        queue.add_message("c2", "llm_chat", "bad", "answer", message_id="taken")
+
+        await queue.flush()
+        assert queue.stats()["flush_errors"] == 1
+        assert not queue.is_pending(good) and queue.is_pending("taken")
+        # waiting for its retry
+        await queue.flush()
+        assert queue.stats()["flush_errors"] == 1
+        later = queue.add_message("c2", "llm_chat", "later", "answer")
+        await queue.flush()
+        assert not queue.is_pending(later)
+        return queue
+
+    queue = asyncio.run(run())
+    assert queue.stats()["rows_failed"] == 1
+    assert {r["query"] for r in filter_message(conversation_id="c2", limit=10)} == {"q", "good", "later"}
+
+
+def test_failing_rows_are_dead_lettered(db):
+    add_message_to_db(conversation_id="c3", chat_type="llm_chat", query="q", response="r", message_id="taken")
+
+    async def run():
+        queue = new_queue(max_attempts=3, retry_backoff=0)
+        queue.add_message("c3", "llm_chat", "bad", "answer", message_id="taken")
+        for _ in range(3):
+            await queue.flush()
+        return queue
+
+    queue = asyncio.run(run())
+    assert not queue.is_pending()
+    assert queue.stats()["rows_dropped"] == 1
+    assert [(r["id"], r["query"]) for r in queue.dead_letters] == [("taken", "bad")]
+    assert queue.dead_letters[0]["error"].startswith("IntegrityError")
+
+
+def test_close_writes_everything_it_can(db):
+    add_message_to_db(conversation_id="c4", chat_type="llm_chat", query="q", response="r", message_id="taken")
+
+    async def run():
+        queue = new_queue(max_attempts=3, retry_backoff=3600)
+        queue.add_message("c4", "llm_chat", "bad", "answer", message_id="taken")
+        ids = [queue.add_message("c4", "llm_chat", f"query {i}", "answer") for i in range(3)]
+        await queue.close()
+        return queue, ids
+
+    queue, ids = asyncio.run(run())
+    assert not queue.is_pending()
+    assert queue.stats()["rows_dropped"] == 1
+    assert {r["id"] for r in filter_message(conversation_id="c4", limit=10)} >= set(ids)
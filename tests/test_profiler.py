@@ -0,0 +1,55 @@
+import asyncio
+import threading
+
+import pytest
+
+from app.profiling.profiler import ProfileBusy, Profiler
+
+
+def test_memory_diff_is_taken_off_the_event_loop():
+    profiler = Profiler(enabled=True)
+    loop_thread = threading.get_ident()
+    snapshot_threads = []
+    stop_memory = profiler._stop_memory
+
+    def spy(*args):
+        snapshot_threads.append(threading.get_ident())
+        return stop_memory(*args)
+
+    profiler._stop_memory = spy
+
+    async def run():
+        profiler.start_memory()
+        kept = [bytearray(1024) for _ in range(1000)]
+        stop = asyncio.ensure_future(profiler.stop_memory(top=5))
+        await asyncio.sleep(0)
+        # the session stays taken until the diff is stored
+        assert profiler.session == "memory_stop"
+        with pytest.raises(ProfileBusy):
+            profiler.start_memory()
+        with pytest.raises(ProfileBusy):
+            await profiler.stop_memory()
+        result = await stop
+        del kept
+        return result
+
+    result = asyncio.run(run())
+    assert snapshot_threads and snapshot_threads[0] != loop_thread
+    assert profiler.session is None
+    assert result["kind"] == "memory" and len(result["top"]) == 5
+    assert result["top"][0]["size_diff_kb"] > 0
+
+
+def test_expired_memory_profile_is_stored():
+    profiler = Profiler(enabled=True, max_duration=0.05)
+
+    async def run():
+        profiler.start_memory()
+        for _ in range(50):
+            await asyncio.sleep(0.01)
+            if profiler.session is None and profiler.results:
+                return
+
+    asyncio.run(run())
+    assert profiler.session is None
+    assert [r["kind"] for r in profiler.results] == ["memory"]
@@ -0,0 +1,107 @@
+import asyncio
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+from app.upstream.rate_limiter import (
+    LocalBucketStore,
+    RateLimiter,
+    RateLimitExceeded,
+    SQLiteBucketStore,
+)
+from app.upstream.scheduler import get_flow_id
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_resized_bucket_keeps_its_fill():
+    store = LocalBucketStore()
+    assert run(store.take([("model:m:tpm", 10, 8)])) == (None, 0.0)
+    # another caller sizing the same bucket differently must not refill it
+    name, wait = run(store.take([("model:m:tpm", 20, 5)]))
+    assert name == "model:m:tpm" and wait > 0
+    assert store._buckets["model:m:tpm"].capacity == 20
+
+
+def test_charges_are_all_or_nothing():
+    store = LocalBucketStore()
+    run(store.take([("b", 10, 8)]))
+    name, _ = run(store.take([("a", 10, 5), ("b", 10, 5)]))
+    assert name == "b"
+    assert run(store.take([("a", 10, 10)])) == (None, 0.0)
+
+
+def test_model_budget_is_the_sum_over_backends():
+    limiter = RateLimiter(enabled=True, models={"pinned": {"rpm": 1}})
+    assert limiter.model_limits("m", [{"rpm": 2, "tpm": 100}, {"rpm": 3, "tpm": 50}]) == {"rpm": 5, "tpm": 150}
+    # one backend without a tpm limit leaves the model's tpm unlimited
+    assert limiter.model_limits("m", [{"rpm": 2, "tpm": 100}, {"rpm": 3}]) == {"rpm": 5}
+    assert limiter.model_limits("pinned", [{"rpm": 2}]) == {"rpm": 1}
+
+
+def key_flow(api_key: str) -> str:
+    return get_flow_id({"x-api-key": api_key})
+
+
+def test_model_and_key_budgets():
+    limiter = RateLimiter(enabled=True, keys={"key:a": {"rpm": 1}})
+    run(limiter.reserve("m", {"rpm": 2}, key_flow("a"), 10))
+    with pytest.raises(RateLimitExceeded) as e:
+        run(limiter.reserve("m", {"rpm": 2}, key_flow("a"), 10))
+    assert e.value.status_code == 429
+    run(limiter.reserve("m", {"rpm": 2}, key_flow("b"), 10))
+    with pytest.raises(RateLimitExceeded) as e:
+        run(limiter.reserve("m", {"rpm": 2}, key_flow("c"), 10))
+    assert e.value.status_code == 503 and e.value.retry_after >= 1
+    assert limiter.rejected == 2
+
+
+def test_settle_refunds_unused_tokens():
+    limiter = RateLimiter(enabled=True)
+    reservation = run(limiter.reserve("m", {"tpm": 1000}, "ip:x", 100, max_tokens=500))
+    assert limiter.stats()["buckets"]["model:m:tpm"]["available"] == pytest.approx(400, abs=1)
+    run(reservation.settle(150))
+    run(reservation.settle(0))  # settling twice is a no-op
+    assert limiter.stats()["buckets"]["model:m:tpm"]["available"] == pytest.approx(850, abs=1)
+
+
+def test_sqlite_buckets_are_shared(tmp_path):
+    path = str(tmp_path / "rl.sqlite")
+    first, second = SQLiteBucketStore(path), SQLiteBucketStore(path)
+    assert run(first.take([("model:m:rpm", 2, 1)])) == (None, 0.0)
+    assert run(second.take([("model:m:rpm", 2, 1)])) == (None, 0.0)
+    name, wait = run(first.take([("model:m:rpm", 4, 1)]))
+    assert name == "model:m:rpm" and wait > 0
+
+
+def test_api_keys_are_not_shown_in_stats():
+    flow = get_flow_id({"authorization": "Bearer sk-secret-key"})
+    assert flow == key_flow("sk-secret-key") and "sk-secret-key" not in flow
+    limiter = RateLimiter(enabled=True, keys={"key:sk-secret-key": {"rpm": 5}})
+    run(limiter.reserve("m", {}, flow, 10))
+    assert limiter.stats()["buckets"] == {f"{flow}:rpm": {"available": 4.0, "per_minute": 5}}
+    assert "sk-secret-key" not in str(limiter.stats())
+
+
+def test_idle_refilled_buckets_are_dropped(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    # app.upstream.rate_limiter is shadowed by the limiter instance of the package
+    monkeypatch.setattr(sys.modules["app.upstream.rate_limiter"], "time", SimpleNamespace(time=lambda: clock.now))
+    store = LocalBucketStore(idle_ttl=60)
+    run(store.take([("client:a:rpm", 60, 1)]))
+    run(store.take([("client:b:tpm", 60, 10)]))
+    run(store.adjust("client:b:tpm", 60, 200))  # settled far over its estimate
+
+    clock.now += 61
+    run(store.take([("client:c:rpm", 60, 1)]))
+    # b is still paying back, a new bucket would forgive it
+    assert set(store._buckets) == {"client:b:tpm", "client:c:rpm"}
+    assert store.evicted == 1
+
+    clock.now += 300
+    run(store.take([("client:d:rpm", 60, 1)]))
+    assert set(store._buckets) == {"client:d:rpm"}
+    assert store.evicted == 3
@@ -0,0 +1,70 @@
+import asyncio
+import threading
+import uuid
+
+from app.db.repository.message_repository import add_message_to_db
+from app.memory.conversation_retrieval_db_memory import ConversationRetrievalDBMemory
+from app.memory.embeddings import embedder
+from app.memory.retrieval_index import ConversationIndex, ConversationIndexStore, conversation_indexes
+from app.utils import get_ChatOpenAI
+
+
+def turn(query: str, response: str = "an answer of some length") -> dict:
+    return {"id": uuid.uuid4().hex, "query": query, "response": response}
+
+
+def loaded_bytes(store: ConversationIndexStore) -> int:
+    return sum(index.nbytes for index in store._indexes.values())
+
+
+def test_the_byte_total_follows_adds_evictions_and_invalidations():
+    store = ConversationIndexStore()
+    for conversation_id in ("a", "b", "c"):
+        index = ConversationIndex(conversation_id, embedder.dim)
+        index.add_turns([turn(f"question {i} of {conversation_id}") for i in range(3)])
+        store._store(index)
+    assert store._bytes == loaded_bytes(store)
+
+    store.on_write("a", turn("one more question"))
+    store.on_write("unloaded", turn("not indexed"))
+    assert store._bytes == loaded_bytes(store)
+
+    store.get("a")
+    store.max_bytes = store._bytes - 1
+    store.add_turns(store.get("c"), [turn("and another")])
+    # "b" was the least recently used
+    assert list(store._indexes) == ["a", "c"] and store.evictions == 1
+    assert store._bytes == loaded_bytes(store) <= store.max_bytes
+
+    store.invalidate("c")
+    store.invalidate("c")
+    assert store._bytes == loaded_bytes(store) == store._indexes["a"].nbytes
+
+
+def test_the_query_is_embedded_off_the_event_loop(db, online_model, monkeypatch):
+    for query in ("how do I bake sourdough bread", "what is the capital of france", "hello"):
+        add_message_to_db(conversation_id="r1", chat_type="llm_chat", query=query, response="answer")
+    memory = ConversationRetrievalDBMemory(
+        conversation_id="r1",
+        llm=get_ChatOpenAI(model_name=online_model, temperature=0),
+        recent_turns=0,
+        top_k=1,
+    )
+    threads = []
+    embed_one = embedder.embed_one
+
+    def spy(text):
+        threads.append(threading.get_ident())
+        return embed_one(text)
+
+    monkeypatch.setattr(embedder, "embed_one", spy)
+
+    async def run():
+        return threading.get_ident(), await memory.abuffer("sourdough bread recipe")
+
+    try:
+        loop_thread, buffer = asyncio.run(run())
+    finally:
+        conversation_indexes.invalidate("r1")
+    assert threads and loop_thread not in threads
+    assert [m.content for m in buffer][0] == "how do I bake sourdough bread"
@@ -0,0 +1,138 @@
+import asyncio
+import time
+
+import pytest
+
+from app.configs import ONLINE_LLM_MODEL
+from app.upstream.router import ModelRouter, NoBackendAvailable, model_router
+from app.utils import get_model_worker_config
+
+
+class Tokens:
+    """
+    the request's callback, collects the streamed tokens
+    """
+
+    def __init__(self):
+        self.tokens = []
+
+    async def on_llm_new_token(self, token: str, **kwargs) -> None:
+        self.tokens.append(token)
+
+
+def stub_backends(**behaviours):
+    """
+    a `call` serving each backend by its behaviour: ("answer", first token delay) or
+    ("fail", delay). Returns the call and the log of (backend, outcome).
+    """
+    log = []
+
+    async def call(backend, callbacks):
+        kind, delay = behaviours[backend]
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            log.append((backend, "cancelled"))
+            raise
+        if kind == "fail":
+            log.append((backend, "failed"))
+            raise ConnectionError(f"{backend} is down")
+        for token in (f"{backend}-1", f"{backend}-2"):
+            for callback in callbacks:
+                await callback.on_llm_new_token(token)
+        log.append((backend, "answered"))
+        return backend
+
+    return call, log
+
+
+def router(**kwargs) -> ModelRouter:
+    return ModelRouter(routes={"m": ["a", "b"]}, **kwargs)
+
+
+def test_the_backend_with_the_best_ewma_is_picked():
+    r = router(ewma_alpha=0.5)
+    # backends without samples come first, in configured order
+    assert r.pick("m") == "a"
+    r.backend_stats("a").record_ttft(1.0)
+    assert r.pick("m") == "b"
+    r.backend_stats("b").record_ttft(0.2)
+    r.backend_stats("b").record_ttft(2.0)
+    assert r.backend_stats("b").ewma_ttft == pytest.approx(1.1)
+    assert r.pick("m") == "a"
+    # requests in flight and errors weigh against a backend
+    r.backend_stats("a").in_flight = 1
+    assert r.pick("m") == "b"
+    r.backend_stats("a").in_flight = 0
+    r.backend_stats("a").record_failure()
+    assert r.pick("m") == "b"
+    assert r.pick("m", exclude=["b"]) == "a"
+
+
+def test_the_breaker_opens_probes_once_and_closes():
+    r = router(failure_threshold=2, cooldown=0.05)
+    stats = r.backend_stats("a")
+    assert stats.record_failure() is None and stats.state == "closed"
+    assert stats.record_failure() == "open"
+    assert r.pick("m") == "b"
+    assert r.pick("m", exclude=["b"]) is None
+
+    time.sleep(0.06)
+    # looking up the config of the model does not take the probe
+    assert r.preferred("m") == "b" and stats.state == "open"
+    assert r.pick("m", exclude=["b"]) == "a" and stats.state == "half_open"
+    stats.in_flight = 1
+    assert r.pick("m", exclude=["b"]) is None
+    stats.in_flight = 0
+    # a failed probe opens the breaker again, a successful one closes it
+    assert stats.record_failure() == "open"
+    time.sleep(0.06)
+    assert r.pick("m", exclude=["b"]) == "a"
+    assert stats.record_success() == "closed" and stats.state == "closed"
+
+
+def test_model_config_lookups_do_not_take_the_probe(monkeypatch):
+    for name in ("a", "b"):
+        monkeypatch.setitem(ONLINE_LLM_MODEL, name, {"model_name": name, "api_base_url": f"http://{name}"})
+    monkeypatch.setattr(model_router, "routes", {"m": ["a", "b"]})
+    monkeypatch.setattr(model_router, "_stats", {})
+    stats = model_router.backend_stats("a")
+    stats.state, stats.opened_at = "open", time.monotonic() - model_router.cooldown
+    assert get_model_worker_config("m")["model_name"] == "b"
+    assert stats.state == "open"
+    stats.state = "closed"
+    assert get_model_worker_config("m")["model_name"] == "a"
+
+
+def test_a_failed_call_fails_over_to_the_next_backend():
+    r = router()
+    call, log = stub_backends(a=("fail", 0), b=("answer", 0))
+    tokens = Tokens()
+    assert asyncio.run(r.acall("m", call, tokens)) == "b"
+    assert log == [("a", "failed"), ("b", "answered")]
+    assert tokens.tokens == ["b-1", "b-2"]
+    assert r.failovers == 1 and r.backend_stats("a").failures == 1
+
+
+def test_every_backend_failing_raises_the_last_error():
+    r = router(failure_threshold=1)
+    call, _ = stub_backends(a=("fail", 0), b=("fail", 0))
+    with pytest.raises(ConnectionError):
+        asyncio.run(r.acall("m", call, Tokens()))
+    # both are ejected now
+    with pytest.raises(NoBackendAvailable):
+        asyncio.run(r.acall("m", call, Tokens()))
+
+
+def test_a_hedge_that_answers_first_cancels_the_slow_call():
+    r = router(hedge=True, hedge_min_delay=0.05)
+    call, log = stub_backends(a=("answer", 5), b=("answer", 0))
+    tokens = Tokens()
+    start = time.monotonic()
+    assert asyncio.run(r.acall("m", call, tokens)) == "b"
+    assert time.monotonic() - start < 1
+    assert log == [("b", "answered"), ("a", "cancelled")]
+    assert tokens.tokens == ["b-1", "b-2"]
+    assert r.hedges == 1 and r.hedges_won == 1
+    # the loser is charged the time it had taken so far
+    assert r.backend_stats("a").ewma_ttft >= 0.05
@@ -0,0 +1,128 @@
+import asyncio
+
+import pytest
+
+from app.upstream.scheduler import ChatScheduler, SchedulerRejected, get_flow_id
+
+
+def scheduler(**kwargs) -> ChatScheduler:
+    return ChatScheduler(enabled=True, max_concurrency={"default": 1}, **kwargs)
+
+
+async def queue_behind_a_running_request(s: ChatScheduler, requests):
+    """
+    hold the only slot, queue `requests` (flow, lane) and release it: return the order
+    the queued requests were granted in
+    """
+    running = await s.acquire("m", "holder")
+    granted = []
+
+    async def request(flow, lane):
+        ticket = await s.acquire("m", flow, lane)
+        granted.append(flow)
+        ticket.release()
+
+    tasks = [asyncio.ensure_future(request(flow, lane)) for flow, lane in requests]
+    await asyncio.sleep(0)
+    running.release()
+    await asyncio.gather(*tasks)
+    return granted
+
+
+def test_flows_share_the_model_by_their_weights():
+    s = scheduler(flow_weights={"key:heavy": 3})
+    heavy = get_flow_id({"x-api-key": "heavy"})
+    requests = [(heavy, "interactive")] * 6 + [("light", "interactive")] * 2
+    granted = asyncio.run(queue_behind_a_running_request(s, requests))
+    # three heavy requests for every light one, although all heavy ones queued first
+    assert granted == [heavy] * 3 + ["light"] + [heavy] * 3 + ["light"]
+
+
+def test_lanes_share_the_model_by_their_weights():
+    s = scheduler(lanes={"interactive": 2, "batch": 1})
+    requests = [("batch", "batch")] * 3 + [("chat", "interactive")] * 4
+    granted = asyncio.run(queue_behind_a_running_request(s, requests))
+    # two interactive requests for every batch one, batch ones queued first
+    assert granted == ["chat", "batch", "chat", "chat", "batch", "chat", "batch"]
+
+
+def test_queues_are_capped_per_flow_and_per_model():
+    s = scheduler(max_queue=3, max_queue_per_flow=2)
+
+    async def run():
+        await s.acquire("m", "holder")
+        waiting = [asyncio.ensure_future(s.acquire("m", "a")) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerRejected) as per_flow:
+            await s.acquire("m", "a")
+        waiting.append(asyncio.ensure_future(s.acquire("m", "b")))
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerRejected) as per_model:
+            await s.acquire("m", "c")
+        for w in waiting:
+            w.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+        return per_flow.value, per_model.value
+
+    per_flow, per_model = asyncio.run(run())
+    assert per_flow.status_code == 429 and per_model.status_code == 503
+    assert per_model.retry_after >= 1
+    assert s.rejected == {429: 1, 503: 1}
+
+
+def test_a_cancelled_waiter_gives_up_its_place():
+    s = scheduler(max_queue_per_flow=1)
+
+    async def run():
+        running = await s.acquire("m", "holder")
+        waiter = asyncio.ensure_future(s.acquire("m", "a"))
+        await asyncio.sleep(0)
+        assert s._models["m"].queued == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        mq = s._models["m"]
+        assert mq.queued == 0 and not mq.flow_queued
+        # the flow may queue again, and the slot goes to it, not to the cancelled ticket
+        again = asyncio.ensure_future(s.acquire("m", "a"))
+        await asyncio.sleep(0)
+        running.release()
+        ticket = await again
+        assert mq.in_use == 1
+        ticket.release()
+        return mq
+
+    mq = asyncio.run(run())
+    assert mq.in_use == 0 and mq.queued == 0
+
+
+def test_a_waiter_cancelled_once_granted_releases_its_slot():
+    s = scheduler()
+
+    async def run():
+        running = await s.acquire("m", "holder")
+        waiter = asyncio.ensure_future(s.acquire("m", "a"))
+        await asyncio.sleep(0)
+        # granted, but cancelled before it could resume
+        running.release()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        return s._models["m"]
+
+    mq = asyncio.run(run())
+    assert mq.in_use == 0 and mq.queued == 0
+
+
+def test_requests_past_their_deadline_are_dropped():
+    s = scheduler()
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        running = await s.acquire("m", "holder")
+        with pytest.raises(SchedulerRejected) as expired:
+            await s.acquire("m", "a", deadline=loop.time() + 0.02)
+        running.release()
+        return expired.value
+
+    expired = asyncio.run(run())
+    assert expired.status_code == 503 and s.expired == 1
+    assert s._models["m"].queued == 0
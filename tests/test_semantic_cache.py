@@ -0,0 +1,116 @@
+import asyncio
+import sys
+import threading
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.cache.semantic_cache import SemanticCache, embedder, semantic_cache
+from app.configs import SEMANTIC_CACHE
+from app.memory.embeddings import Embedder
+
+TOKENS = ["cached", " answer"]
+
+
+@pytest.fixture
+def embed_threads(monkeypatch):
+    threads = []
+    embed_one = embedder.embed_one
+
+    def spy(text):
+        threads.append(threading.get_ident())
+        return embed_one(text)
+
+    monkeypatch.setattr(embedder, "embed_one", spy)
+    return threads
+
+
+def test_prompts_are_embedded_off_the_event_loop(embed_threads):
+    cache = SemanticCache(threshold=0.99)
+    loop_threads = []
+
+    async def run():
+        loop_threads.append(threading.get_ident())
+        await cache.aset("m", "default", 100, "what is the capital of france", TOKENS)
+        return await cache.aget("m", "default", 100, "what is the capital of france")
+
+    hit = asyncio.run(run())
+    assert hit["tokens"] == tuple(TOKENS) and hit["score"] >= 0.99
+    assert len(embed_threads) == 2 and loop_threads[0] not in embed_threads
+
+
+def test_the_hashing_embedder_does_not_enable_the_cache(monkeypatch):
+    assert not SemanticCache(enabled=True).enabled
+
+    class ModelEmbedder(Embedder):
+        dim = 8
+
+    # app.cache.semantic_cache is shadowed by the cache instance of the package
+    monkeypatch.setattr(sys.modules["app.cache.semantic_cache"], "embedder", ModelEmbedder())
+    assert SemanticCache(enabled=True).enabled
+
+
+@pytest.mark.parametrize(
+    "cached, query",
+    [
+        ("write a function to add two numbers", "write a function to multiply two numbers"),
+        ("what is the capital of france", "what is the capital of spain"),
+        ("how do I reset my password", "how do I reset my username"),
+    ],
+)
+def test_near_misses_do_not_hit(cached, query):
+    cache = SemanticCache(threshold=SEMANTIC_CACHE["threshold"])
+    cache.set("m", "py", None, cache.query_text(cached), TOKENS)
+    assert cache.get("m", "py", None, cache.query_text(query)) is None
+
+
+def test_answers_are_scoped_to_model_prompt_and_max_tokens():
+    cache = SemanticCache(threshold=0.99)
+    cache.set("m", "default", 100, "what is the capital of france", TOKENS)
+    assert cache.get("m", "default", 100, "what is the capital of france") is not None
+    assert cache.get("other", "default", 100, "what is the capital of france") is None
+    assert cache.get("m", "other", 100, "what is the capital of france") is None
+    assert cache.get("m", "default", 200, "what is the capital of france") is None
+    assert cache.get("m", "default", 100, "how do magnets work") is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 4
+
+
+def test_expired_and_evicted_entries_are_not_served():
+    cache = SemanticCache(threshold=0.99, ttl=0.05, max_entries=2)
+    for text in ("first question", "second question", "third question"):
+        cache.set("m", "default", None, text, TOKENS)
+    assert cache.get("m", "default", None, "first question") is None
+    assert cache.get("m", "default", None, "third question") is not None
+    assert cache.evictions == 1
+    time.sleep(0.06)
+    assert cache.get("m", "default", None, "third question") is None
+    assert cache.expirations == 2
+
+
+def test_false_hits_drop_the_entry_and_raise_the_suggested_threshold():
+    cache = SemanticCache(threshold=0.3)
+    cache.set("m", "default", None, "what is the capital of france", TOKENS)
+    hit = cache.get("m", "default", None, "what is the capital of spain")
+    assert hit is not None and hit["score"] < 1
+    assert cache.false_hit(hit["hit_id"])["false_hit"]
+    assert cache.get("m", "default", None, "what is the capital of france") is None
+    review = cache.stats()["templates"]["default"]
+    assert review["false_hits"] == 1 and review["suggested_threshold"] > hit["score"]
+
+
+def test_chat_answers_a_repeated_prompt_from_the_cache(db, online_model, monkeypatch, embed_threads):
+    from app.main import app
+
+    monkeypatch.setattr(semantic_cache, "enabled", True)
+    client = TestClient(app)
+    request = {"query": "What is the capital of France?", "temperature": 0, "max_tokens": 20, "stream": False}
+    try:
+        first = client.post("/chat", json=request)
+        second = client.post("/chat", json=dict(request, query="what is the capital of  france"))
+    finally:
+        semantic_cache.clear()
+    assert first.status_code == 200 and first.json()["semantic_cache"] is None
+    assert second.status_code == 200 and second.json()["semantic_cache"]["score"] >= 0.99
+    assert second.json()["text"] == first.json()["text"]
+    assert len(embed_threads) == 3
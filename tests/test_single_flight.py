@@ -0,0 +1,136 @@
+import asyncio
+
+from langchain.callbacks import AsyncIteratorCallbackHandler
+
+from app.cache.inflight import SingleFlight
+
+TOKENS = ["one", " two", " three", " four"]
+
+
+class Upstream:
+    """
+    a stub model call streaming TOKENS into its callback, counts its calls
+    """
+
+    def __init__(self, token_delay: float = 0.01):
+        self.token_delay = token_delay
+        self.calls = 0
+        self.cancelled = False
+
+    async def generate(self, callback: AsyncIteratorCallbackHandler) -> None:
+        self.calls += 1
+        try:
+            for token in TOKENS:
+                await asyncio.sleep(self.token_delay)
+                await callback.on_llm_new_token(token)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+
+    def start(self, flight: SingleFlight, key: str):
+        callback = AsyncIteratorCallbackHandler()
+        return flight.start(key, self.generate(callback), callback)
+
+
+async def request(flight: SingleFlight, upstream: Upstream, key: str = "prompt") -> str:
+    """
+    what /chat does: join the running generation or start one, then stream it
+    """
+    generation = flight.join(key) or upstream.start(flight, key)
+    return "".join([token async for token in generation.aiter()])
+
+
+def test_identical_requests_share_one_generation():
+    flight = SingleFlight(enabled=True)
+    upstream = Upstream()
+
+    async def run():
+        return await asyncio.gather(*(request(flight, upstream) for _ in range(5)))
+
+    answers = asyncio.run(run())
+    assert answers == ["".join(TOKENS)] * 5
+    assert upstream.calls == 1
+    assert flight.leaders == 1 and flight.followers == 4
+
+
+def test_late_followers_get_the_tokens_generated_before_they_joined():
+    flight = SingleFlight(enabled=True)
+    upstream = Upstream()
+
+    async def run():
+        leader = asyncio.ensure_future(request(flight, upstream))
+        await asyncio.sleep(0.025)
+        return await asyncio.gather(leader, request(flight, upstream))
+
+    assert asyncio.run(run()) == ["".join(TOKENS)] * 2
+    assert upstream.calls == 1
+
+
+def test_a_cancelled_leader_does_not_cancel_its_followers():
+    flight = SingleFlight(enabled=True)
+    upstream = Upstream()
+
+    async def run():
+        leader = asyncio.ensure_future(request(flight, upstream))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(request(flight, upstream))
+        await asyncio.sleep(0.015)
+        leader.cancel()
+        await asyncio.gather(leader, return_exceptions=True)
+        return await follower
+
+    assert asyncio.run(run()) == "".join(TOKENS)
+    assert upstream.calls == 1 and not upstream.cancelled
+
+
+def test_the_generation_is_cancelled_when_every_subscriber_is_gone():
+    flight = SingleFlight(enabled=True)
+    upstream = Upstream()
+
+    async def run():
+        generation = upstream.start(flight, "prompt")
+        generation.grace_period = 0
+        client = asyncio.ensure_future(request(flight, upstream))
+        await asyncio.sleep(0.015)
+        client.cancel()
+        await asyncio.gather(client, return_exceptions=True)
+        await asyncio.sleep(0.01)
+        return generation
+
+    generation = asyncio.run(run())
+    assert upstream.cancelled
+    assert generation.done and not generation.ok
+    assert generation.finish_reason == "client_disconnected"
+    assert generation.tokens == TOKENS[: len(generation.tokens)] and len(generation.tokens) < len(TOKENS)
+
+
+def test_finished_generations_are_forgotten():
+    flight = SingleFlight(enabled=True)
+    upstream = Upstream(token_delay=0)
+
+    async def run():
+        generation = upstream.start(flight, "prompt")
+        assert flight.stats()["in_flight"] == 1
+        await request(flight, upstream)
+        await asyncio.sleep(0)
+        assert flight.join("prompt") is None
+        # the next identical request starts a new generation
+        await request(flight, upstream)
+        await asyncio.sleep(0)
+        return generation
+
+    generation = asyncio.run(run())
+    assert generation.ok and generation.finish_reason == "stop"
+    assert flight.stats()["in_flight"] == 0
+    assert upstream.calls == 2 and flight.leaders == 2
+
+
+def test_nothing_is_shared_when_disabled():
+    flight = SingleFlight()
+    upstream = Upstream(token_delay=0)
+
+    async def run():
+        return await asyncio.gather(*(request(flight, upstream) for _ in range(3)))
+
+    assert asyncio.run(run()) == ["".join(TOKENS)] * 3
+    assert upstream.calls == 3 and flight.stats()["in_flight"] == 0
@@ -0,0 +1,80 @@
+import asyncio
+import json
+
+from fastapi.testclient import TestClient
+from sqlalchemy.exc import OperationalError
+
+from app.cache import InflightGeneration
+from app.chat import stream_log
+from app.chat.stream_log import MessageStreamLog
+from app.db.repository.message_chunk_repository import get_message_text
+
+TOKENS = [f"tok{i} " for i in range(10)]
+
+
+def sse_text(body: str) -> str:
+    text = ""
+    for frame in body.split("\n\n"):
+        lines = frame.splitlines()
+        if lines and not any(line.startswith("event:") for line in lines):
+            text += json.loads(lines[-1][len("data: "):])["text"]
+    return text
+
+
+def record(log: MessageStreamLog, generation: InflightGeneration) -> None:
+    async def run():
+        task = asyncio.create_task(log.record())
+        for token in TOKENS:
+            generation.publish(token)
+            await asyncio.sleep(0)
+        generation.finish(True)
+        await task
+
+    asyncio.run(run())
+
+
+def test_failed_checkpoint_keeps_its_text_for_resume(db, monkeypatch):
+    add_chunk = stream_log.aadd_message_chunk
+    calls = []
+
+    async def flaky_add_chunk(message_id, seq, text):
+        calls.append(text)
+        if len(calls) == 2:
+            raise OperationalError("INSERT", {}, Exception("database is locked"))
+        return await add_chunk(message_id, seq, text)
+
+    monkeypatch.setattr(stream_log, "aadd_message_chunk", flaky_add_chunk)
+    log = MessageStreamLog("m-flaky", InflightGeneration(), checkpoint_interval=0, checkpoint_bytes=1)
+    record(log, log.generation)
+
+    full = "".join(TOKENS)
+    assert len(calls) > 2
+    assert get_message_text(message_id="m-flaky") == full
+
+    from app.main import app
+
+    offset = len(TOKENS[0]) + 2
+    r = TestClient(app).get("/chat/stream/m-flaky", headers={"Last-Event-ID": str(offset)})
+    assert r.status_code == 200
+    assert sse_text(r.text) == full[offset:]
+
+
+def test_final_checkpoint_is_retried(db, monkeypatch):
+    add_chunk = stream_log.aadd_message_chunk
+    failures = []
+
+    async def failing_once(message_id, seq, text):
+        if not failures:
+            failures.append(text)
+            raise OperationalError("INSERT", {}, Exception("database is locked"))
+        return await add_chunk(message_id, seq, text)
+
+    monkeypatch.setattr(stream_log, "aadd_message_chunk", failing_once)
+    # only the final checkpoint writes
+    log = MessageStreamLog(
+        "m-final", InflightGeneration(), checkpoint_interval=3600, checkpoint_bytes=1 << 20, retry_delay=0
+    )
+    record(log, log.generation)
+
+    assert failures == ["".join(TOKENS)]
+    assert get_message_text(message_id="m-final") == "".join(TOKENS)
@@ -0,0 +1,152 @@
+import asyncio
+import datetime
+import uuid
+
+import pytest
+
+from app.configs import ONLINE_LLM_MODEL
+from app.db.models.message_model import MessageModel
+from app.db.repository.conversation_summary_repository import aget_summary, get_summary, save_summary
+from app.db.session import with_session
+from app.memory.conversation_summary_db_memory import ConversationSummaryDBMemory
+from app.memory.summarizer import ConversationSummarizer, conversation_summarizer, summary_runs
+from app.utils import get_ChatOpenAI
+
+T0 = datetime.datetime(2026, 1, 1)
+
+
+@with_session
+def add_turns(session, conversation_id: str, n: int, start: int = 0):
+    """
+    `n` answered turns a second apart, create_time only has second resolution
+    """
+    ids = []
+    for i in range(start, start + n):
+        ids.append(uuid.uuid4().hex)
+        session.add(
+            MessageModel(
+                id=ids[-1],
+                conversation_id=conversation_id,
+                chat_type="llm_chat",
+                query=f"question {i}",
+                response=f"answer {i}",
+                query_tokens=3,
+                response_tokens=3,
+                create_time=T0 + datetime.timedelta(seconds=i),
+            )
+        )
+    return ids
+
+
+def turns(n: int):
+    return [
+        {"id": uuid.uuid4().hex, "query": f"question {i}", "response": f"answer {i}"}
+        for i in range(n)
+    ]
+
+
+async def summarize(summarizer, conversation_id, summary, tail) -> None:
+    assert summarizer.maybe_schedule(conversation_id, "unused", summary, tail, 10_000)
+    await summarizer.wait(conversation_id)
+
+
+def model_entry(monkeypatch, name: str, api_base_url: str) -> None:
+    monkeypatch.setitem(
+        ONLINE_LLM_MODEL, name, {"model_name": name, "api_base_url": api_base_url, "api_key": "EMPTY"}
+    )
+
+
+@pytest.fixture
+def summarizer(monkeypatch, stub_model):
+    model_entry(monkeypatch, "summary-stub", stub_model)
+    return ConversationSummarizer(tail_token_threshold=100, keep_turns=1, summary_model="summary-stub")
+
+
+def test_summaries_are_stored_and_extended(db, summarizer):
+    first_ids = add_turns("s1", 3)
+    second_ids = []
+
+    async def run():
+        await summarize(summarizer, "s1", None, turns(3))
+        first = await aget_summary("s1")
+        # pooled clients belong to one event loop, the turns are added in between
+        second_ids.extend(add_turns("s1", 3, start=3))
+        await summarize(summarizer, "s1", first, turns(4))
+        return first, await aget_summary("s1")
+
+    first, second = asyncio.run(run())
+    assert first["summary"].startswith("tok0")
+    assert first["covered_message_id"] == first_ids[1] and first["covered_messages"] == 2
+    assert second["covered_message_id"] == second_ids[1] and second["covered_messages"] == 5
+    assert summarizer.stats()["stored"] == 2 and summarizer.stats()["conflicts"] == 0
+
+
+def test_short_tails_are_not_summarized(db, summarizer):
+    async def run():
+        assert not summarizer.maybe_schedule("s2", "unused", None, turns(3), 100)
+        assert not summarizer.maybe_schedule("s2", "unused", None, turns(1), 10_000)
+        assert not summarizer.maybe_schedule("s2", "unused", None, turns(1), 100, truncated=True)
+        assert summarizer.maybe_schedule("s2", "unused", None, turns(3), 100, truncated=True)
+        await summarizer.wait("s2")
+
+    asyncio.run(run())
+
+
+def test_summary_built_from_an_outdated_one_is_discarded(db, summarizer):
+    add_turns("s3", 4)
+    stored = dict(summary="newer", summary_tokens=1, covered_message_id="m9", covered_messages=9)
+    assert save_summary(conversation_id="s3", expected_message_id=None, **stored)
+    # a second first summary, or one replacing a summary that is gone, loses
+    assert not save_summary(conversation_id="s3", expected_message_id=None, **stored)
+    assert not save_summary(conversation_id="s3", expected_message_id="m1", **dict(stored, summary="older"))
+
+    outdated = dict(stored, summary="older", covered_message_id="m1", covered_messages=1)
+    asyncio.run(summarize(summarizer, "s3", outdated, turns(3)))
+    assert summarizer.stats()["conflicts"] == 1 and summarizer.stats()["stored"] == 0
+    assert get_summary(conversation_id="s3")["summary"] == "newer"
+
+
+def test_model_errors_are_counted(db, monkeypatch, start_stub_model):
+    model_entry(monkeypatch, "failing-stub", start_stub_model("--error-rate", "1", "--error-status", "400"))
+    summarizer = ConversationSummarizer(tail_token_threshold=100, keep_turns=1, summary_model="failing-stub")
+    add_turns("s4", 3)
+    errors = summary_runs._merged().get(("error",), 0)
+    asyncio.run(summarize(summarizer, "s4", None, turns(3)))
+    assert summarizer.stats()["errors"] == 1
+    assert summary_runs._merged()[("error",)] == errors + 1
+    assert get_summary(conversation_id="s4") is None
+
+
+def test_short_turns_past_the_window_are_summarized_without_a_gap(db, monkeypatch, stub_model):
+    # the summaries are made by the request's model_name, the llm only knows the provider's
+    monkeypatch.setitem(
+        ONLINE_LLM_MODEL,
+        "summary-stub",
+        {"model_name": "provider-model", "api_base_url": stub_model, "api_key": "EMPTY"},
+    )
+    limit, keep = conversation_summarizer.message_limit, conversation_summarizer.keep_turns
+    llm = get_ChatOpenAI(model_name="summary-stub", temperature=0)
+    assert llm.model_name == "provider-model"
+    memory = ConversationSummaryDBMemory(conversation_id="s5", llm=llm, model_name="summary-stub")
+
+    async def load():
+        await memory.abuffer()
+        await conversation_summarizer.wait("s5")
+        return get_summary(conversation_id="s5")
+
+    async def run():
+        # far below the tail token threshold, but more turns than the window holds
+        ids = add_turns("s5", limit + 5)
+        summary = await load()
+        assert summary["covered_messages"] == limit and summary["covered_message_id"] == ids[limit - 1]
+
+        # the tail since the summary fits the window, nothing to do
+        assert (await load())["covered_messages"] == limit
+
+        # the summarized turns fell out of the window: the next ones are read from the db
+        ids += add_turns("s5", limit, start=limit + 5)
+        summary = await load()
+        assert summary["covered_messages"] == 2 * limit and summary["covered_message_id"] == ids[2 * limit - 1]
+        assert len(ids) - summary["covered_messages"] > keep
+
+    asyncio.run(run())
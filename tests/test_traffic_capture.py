@@ -0,0 +1,39 @@
+import json
+import logging
+
+from app.middleware.traffic_capture import TrafficCapture
+
+
+def capture_record(i: int) -> dict:
+    return {
+        "request_id": f"r{i}",
+        "raw_body": json.dumps({"query": f"q{i}", "api_key": "secret"}).encode(),
+        "headers": {"authorization": "Bearer x", "user-agent": "test"},
+    }
+
+
+def test_a_failing_record_does_not_stop_the_writer(tmp_path, monkeypatch):
+    monkeypatch.setattr(logging, "raiseExceptions", False)
+    capture = TrafficCapture(enabled=True, path=str(tmp_path / "capture.jsonl"), redact_fields=["api_key"])
+
+    def redactor(record):
+        if record["request_id"] == "r1":
+            raise ValueError("broken redactor")
+        if record["request_id"] == "r2":
+            record["unserializable"] = object()
+        if record["request_id"] == "r3":
+            return None
+        return record
+
+    capture.add_redactor(redactor)
+    capture.start()
+    for i in range(6):
+        capture.record(capture_record(i))
+    capture.stop()
+
+    lines = [json.loads(line) for line in (tmp_path / "capture.jsonl").read_text().splitlines()]
+    assert [line["request_id"] for line in lines] == ["r0", "r4", "r5"]
+    assert lines[0]["body"]["api_key"] == "[REDACTED]"
+    assert lines[0]["headers"]["authorization"] == "[REDACTED]"
+    stats = capture.stats()
+    assert stats["failed"] == 2 and stats["redacted"] == 1 and stats["dropped"] == 0